@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# Copyright (c) The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+Benchmarks for message selectors.
+
+Generates a synthetic set of subscription selectors and a stream of message
+headers, then measures:
+
+ - the time to parse (compile) each selector,
+ - the time to evaluate a selector against one message, with
+   :func:`~plasma.flex.messaging.selector.parser.evaluate` and with a
+   compiled selector,
+ - the time to match a LIKE pattern,
+ - fan-out throughput, i.e. how many messages per second can be matched
+   against all subscriptions, with a loop over the selectors and with a
+   :class:`~plasma.flex.messaging.selector.index.SelectorIndex`,
+ - column-wise evaluation of one selector over all the messages.
+
+Results can be saved as JSON and compared with a previous run to catch
+regressions::
+
+    python benchmarks/bench_selector.py --save before.json
+    (apply changes)
+    python benchmarks/bench_selector.py --compare before.json
+"""
+
+import os.path
+import random
+import sys
+from optparse import OptionParser
+from timeit import default_timer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from plasma.flex.messaging.selector import parser, matcher, ParseError
+from plasma.flex.messaging.selector.index import SelectorIndex
+from plasma.flex.messaging.selector.matcher import Matcher, compile_pattern
+
+REGIONS = ['EU', 'US', 'APAC', 'LATAM', 'MEA']
+SYMBOLS = ['AAPL', 'GOOG', 'MSFT', 'ORCL', 'IBM', 'INTC', 'CSCO', 'ADBE']
+
+TEMPLATES = [
+    "region = '%(region)s'",
+    "symbol = '%(symbol)s' AND priority > %(priority)d",
+    "region IN ('%(region)s', '%(region2)s') AND price > %(price)d",
+    "(price BETWEEN %(price)d AND %(price2)d) AND symbol = '%(symbol)s'",
+    "priority >= %(priority)d AND (name LIKE '%(prefix)s%%')",
+    "region = '%(region)s' OR priority > %(priority)d",
+    "price * quantity > %(total)d",
+    "symbol <> '%(symbol)s' AND expires IS NULL",
+]
+
+
+def generate_selectors(count, rnd):
+    selectors = []
+    for i in range(count):
+        values = {
+            'region': rnd.choice(REGIONS),
+            'region2': rnd.choice(REGIONS),
+            'symbol': rnd.choice(SYMBOLS),
+            'priority': rnd.randint(0, 9),
+            'price': rnd.randint(10, 500),
+            'prefix': rnd.choice(SYMBOLS)[:2].lower(),
+            'total': rnd.randint(1000, 50000),
+        }
+        values['price2'] = values['price'] + rnd.randint(10, 100)
+        selectors.append(TEMPLATES[i % len(TEMPLATES)] % values)
+    return selectors
+
+
+def generate_messages(count, rnd):
+    messages = []
+    for i in range(count):
+        headers = {
+            'region': rnd.choice(REGIONS),
+            'symbol': rnd.choice(SYMBOLS),
+            'priority': rnd.randint(0, 9),
+            'price': rnd.randint(10, 600),
+            'quantity': rnd.randint(1, 100),
+            'name': rnd.choice(SYMBOLS).lower() + str(rnd.randint(0, 99)),
+        }
+        if rnd.random() < 0.2:
+            headers['expires'] = rnd.randint(1, 1000)
+        messages.append(headers)
+    return messages
+
+
+def best_of(repeat, func, setup=None):
+    """
+    Returns the best wall clock time of `repeat` calls to `func`, after an
+    untimed call that warms up caches and lazy imports. `setup`, if given,
+    is called before each call to `func`, and is not timed.
+    """
+    func()
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = default_timer()
+        func()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _matches(selector, headers):
+    try:
+        return selector.matches(headers)
+    except (ParseError, ZeroDivisionError):
+        return False
+
+
+def run(options):
+    rnd = random.Random(options.seed)
+    expressions = generate_selectors(options.subscriptions, rnd)
+    messages = generate_messages(options.messages, rnd)
+    repeat = options.repeat
+    results = {}
+
+    # Parsing, with the compiled selector and LIKE pattern caches emptied
+    # before each run
+    def clear_caches():
+        parser.cache.clear()
+        matcher._cache.clear()
+    maxsize = parser.cache.maxsize
+    parser.cache.maxsize = 0
+    try:
+        elapsed = best_of(repeat,
+                          lambda: [parser.compile(e) for e in expressions],
+                          clear_caches)
+    finally:
+        parser.cache.maxsize = maxsize
+    results['parse (us/expression)'] = elapsed / len(expressions) * 1e6
+
+    selectors = [parser.compile(e) for e in expressions]
+    sample = messages[:min(len(messages), 200)]
+    evaluations = len(sample) * len(TEMPLATES)
+
+    def evaluate_strings():
+        for headers in sample:
+            for expression in expressions[:len(TEMPLATES)]:
+                try:
+                    parser.evaluate(expression, headers)
+                except (ParseError, ZeroDivisionError):
+                    pass
+    elapsed = best_of(repeat, evaluate_strings)
+    results['evaluate() (us/message)'] = elapsed / evaluations * 1e6
+
+    def evaluate_compiled():
+        for headers in sample:
+            for selector in selectors[:len(TEMPLATES)]:
+                _matches(selector, headers)
+    elapsed = best_of(repeat, evaluate_compiled)
+    results['compiled matches() (us/message)'] = elapsed / evaluations * 1e6
+
+    names = [headers['name'] for headers in messages]
+    elapsed = best_of(repeat, lambda: [Matcher(n, 'goo%', '\\').matches()
+                                       for n in names])
+    results['Matcher.matches() (us/match)'] = elapsed / len(names) * 1e6
+    pattern = compile_pattern('%o_g%1', '\\')
+    elapsed = best_of(repeat, lambda: [pattern.matches(n) for n in names])
+    results['Pattern.matches() (us/match)'] = elapsed / len(names) * 1e6
+
+    fanout = messages[:min(len(messages), 100)]
+
+    def fanout_loop():
+        for headers in fanout:
+            [s for s in selectors if _matches(s, headers)]
+    elapsed = best_of(repeat, fanout_loop)
+    results['fan-out, loop (messages/s)'] = len(fanout) / elapsed
+
+    index = SelectorIndex()
+    for i, expression in enumerate(expressions):
+        index.add(i, expression)
+
+    def fanout_index():
+        for headers in messages:
+            index.match(headers)
+    elapsed = best_of(repeat, fanout_index)
+    results['fan-out, SelectorIndex (messages/s)'] = len(messages) / elapsed
+
+    columns = {}
+    for name in ('symbol', 'priority', 'price', 'quantity'):
+        columns[name] = [headers[name] for headers in messages]
+    batch = parser.compile(TEMPLATES[1] % {'symbol': 'GOOG', 'priority': 4})
+    elapsed = best_of(repeat, lambda: batch.evaluate_columns(columns))
+    results['evaluate_columns() (us/message)'] = \
+        elapsed / len(messages) * 1e6
+
+    return results
+
+
+def report(results, previous=None, threshold=0.1):
+    """
+    Prints the results, compared with a previous run if given.
+
+    :return: the names of the results that regressed by more than
+        `threshold`
+    """
+    regressions = []
+    width = max([len(name) for name in results])
+    for name in sorted(results):
+        value = results[name]
+        line = '%-*s %14.2f' % (width, name, value)
+        if previous and name in previous:
+            # throughput results are better when higher, timings when lower
+            if name.endswith('/s)'):
+                change = previous[name] / value - 1
+            else:
+                change = value / previous[name] - 1
+            line += '  %+7.1f%%' % (change * 100)
+            if change > threshold:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print line
+    return regressions
+
+
+def main(args=None):
+    option_parser = OptionParser(usage='%prog [options]')
+    option_parser.add_option('-s', '--subscriptions', type='int',
+                             default=1000,
+                             help='number of subscriptions [%default]')
+    option_parser.add_option('-m', '--messages', type='int', default=2000,
+                             help='number of messages [%default]')
+    option_parser.add_option('-r', '--repeat', type='int', default=5,
+                             help='repeat each measurement [%default]')
+    option_parser.add_option('--seed', type='int', default=0,
+                             help='random seed for the workload [%default]')
+    option_parser.add_option('--save', metavar='FILE',
+                             help='save the results as JSON')
+    option_parser.add_option('--compare', metavar='FILE',
+                             help='compare with results saved by --save')
+    option_parser.add_option('--threshold', type='float', default=0.1,
+                             help='relative slowdown reported as a '
+                                  'regression [%default]')
+    options, args = option_parser.parse_args(args)
+
+    results = run(options)
+
+    previous = None
+    if options.compare:
+        previous = json.load(open(options.compare))['results']
+    regressions = report(results, previous, options.threshold)
+
+    if options.save:
+        data = {'options': options.__dict__, 'results': results}
+        json.dump(data, open(options.save, 'w'), indent=2)
+
+    if regressions:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,652 @@
+# Copyright The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+Remoting client for asyncio_ event loops.
+
+:class:`AsyncioRemotingService` has the same interface as
+:class:`~plasma.client.HTTPRemotingService`, but runs on an asyncio event
+loop instead of the Twisted reactor. The result of every call is an
+:class:`asyncio.Future`, which can be awaited, or cancelled to drop the call.
+
+On Python 2, the `trollius`_ backport of asyncio is used. The module can be
+imported without either, and :class:`ConnectionPool` and the HTTP protocol
+then work with any object that provides the used event loop methods.
+
+.. _asyncio: https://docs.python.org/3/library/asyncio.html
+.. _trollius: https://pypi.python.org/pypi/trollius
+"""
+
+from collections import deque
+import zlib
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+from pyamf import remoting
+import pyamf
+
+from plasma.service import RemotingServiceBase, EnvelopeDecoder
+from plasma.version import version
+
+
+def _create_future(loop):
+    try:
+        return loop.create_future()
+    except AttributeError:
+        return asyncio.Future(loop=loop)
+
+
+def _ensure_future(connecting, loop):
+    if hasattr(connecting, 'add_done_callback'):
+        return connecting
+    return asyncio.ensure_future(connecting, loop=loop)
+
+
+if asyncio is None:
+    _Protocol = object
+else:
+    _Protocol = asyncio.Protocol
+
+
+class _HTTPProtocol(_Protocol):
+    """
+    A minimal HTTP/1.1 client connection. Sends one request at a time and
+    passes the response to a handler with `headersReceived`, `dataReceived`,
+    `finished` and `failed` methods.
+
+    Responses with a Content-Length, with chunked transfer encoding and
+    delimited by the end of the connection are supported. A malformed
+    response aborts the connection and fails the handler.
+
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.handler = None
+        self.closed = False
+
+        self._buffer = b''
+        self._state = None
+        self._remaining = 0
+        self._persistent = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def request(self, data, handler):
+        """
+        Sends a request.
+
+        :param data: the request line, the headers and the body
+        :type data: `bytes`
+
+        """
+        self.handler = handler
+        self._buffer = b''
+        self._state = 'status'
+        self.transport.write(data)
+
+    def abort(self):
+        self.transport.abort()
+
+    def data_received(self, data):
+        if self.handler is None:
+            # unexpected bytes between responses
+            self.abort()
+            return
+        self._buffer += data
+        try:
+            self._parse()
+        except ValueError as e:
+            self._fail(remoting.RemotingError('Malformed HTTP response: %s'
+                                              % (e,)))
+
+    def connection_lost(self, exc):
+        self.closed = True
+        handler = self.handler
+        if handler is None:
+            return
+        self.handler = None
+
+        if self._state == 'until-close' and exc is None:
+            handler.finished(False)
+        else:
+            if exc is None:
+                exc = remoting.RemotingError('Connection closed before the '
+                                             'end of the response')
+            handler.failed(exc)
+
+    def _parse(self):
+        while self.handler is not None and self._buffer:
+            if self._state == 'status':
+                end = self._buffer.find(b'\r\n\r\n')
+                if end == -1:
+                    return
+                head = self._buffer[:end]
+                self._buffer = self._buffer[end + 4:]
+                self._parseHead(head)
+            elif self._state == 'length':
+                data = self._buffer[:self._remaining]
+                self._buffer = self._buffer[len(data):]
+                self._remaining -= len(data)
+                self.handler.dataReceived(data)
+                if self._remaining == 0:
+                    self._finish()
+            elif self._state == 'until-close':
+                data = self._buffer
+                self._buffer = b''
+                self.handler.dataReceived(data)
+            elif self._state == 'chunk-size':
+                end = self._buffer.find(b'\r\n')
+                if end == -1:
+                    return
+                line = self._buffer[:end].split(b';', 1)[0].strip()
+                self._buffer = self._buffer[end + 2:]
+                self._remaining = int(line, 16)
+                if self._remaining < 0:
+                    raise ValueError('negative chunk size')
+                if self._remaining == 0:
+                    self._state = 'trailer'
+                else:
+                    self._state = 'chunk-data'
+            elif self._state == 'chunk-data':
+                data = self._buffer[:self._remaining]
+                self._buffer = self._buffer[len(data):]
+                self._remaining -= len(data)
+                self.handler.dataReceived(data)
+                if self._remaining == 0:
+                    self._state = 'chunk-end'
+            elif self._state == 'chunk-end':
+                if len(self._buffer) < 2:
+                    return
+                if self._buffer[:2] != b'\r\n':
+                    raise ValueError('chunk is longer than its size')
+                self._buffer = self._buffer[2:]
+                self._state = 'chunk-size'
+            elif self._state == 'trailer':
+                end = self._buffer.find(b'\r\n')
+                if end == -1:
+                    return
+                line = self._buffer[:end]
+                self._buffer = self._buffer[end + 2:]
+                if not line:
+                    self._finish()
+
+    def _parseHead(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        http_version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+
+        connection = headers.get('connection', '').lower()
+        self._persistent = ((http_version == 'HTTP/1.1' and
+                             connection != 'close') or
+                            connection == 'keep-alive')
+
+        self.handler.headersReceived(int(status), reason, headers)
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            self._state = 'chunk-size'
+        elif 'content-length' in headers:
+            self._remaining = int(headers['content-length'])
+            if self._remaining < 0:
+                raise ValueError('negative Content-Length')
+            self._state = 'length'
+            if self._remaining == 0:
+                self._finish()
+        else:
+            self._persistent = False
+            self._state = 'until-close'
+
+    def _finish(self):
+        handler = self.handler
+        self.handler = None
+        self._state = None
+        handler.finished(self._persistent and not self.closed)
+
+    def _fail(self, exc):
+        handler = self.handler
+        self.handler = None
+        self._state = None
+        self.abort()
+        handler.failed(exc)
+
+
+class ConnectionPool(object):
+    """
+    Keeps HTTP/1.1 connections to remoting gateways open for reuse.
+
+    At most `max_connections` connections per host are open at the same time.
+    Requests for more connections wait until one is released. Idle
+    connections are closed after `idle_timeout` seconds, and connections
+    closed by the gateway are discarded.
+
+    :ivar max_connections: The maximum number of connections per host.
+    :type max_connections: `int`
+    :ivar idle_timeout: The number of seconds after which an idle connection
+        is closed.
+    :type idle_timeout: `float`
+
+    """
+
+    def __init__(self, loop=None, max_connections=2, idle_timeout=240):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        self._idle = {}
+        self._open = {}
+        self._waiting = {}
+
+    def acquire(self, key):
+        """
+        Returns a :class:`asyncio.Future` that resolves to a connection.
+
+        :param key: the `(host, port, ssl)` of the gateway
+        :type key: `tuple`
+
+        """
+        idle = self._idle.get(key)
+        while idle:
+            protocol, timer = idle.pop()
+            timer.cancel()
+            if not protocol.closed:
+                future = _create_future(self.loop)
+                future.set_result(protocol)
+                return future
+            self._open[key] -= 1
+
+        future = _create_future(self.loop)
+        if self._open.get(key, 0) < self.max_connections:
+            self._connect(key, future)
+        else:
+            self._waiting.setdefault(key, deque()).append(future)
+        return future
+
+    def release(self, key, protocol, reusable):
+        """
+        Returns a connection to the pool. The connection is closed if it
+        can not be reused.
+
+        """
+        waiting = self._waiting.get(key)
+        while waiting:
+            future = waiting.popleft()
+            if future.done():
+                continue
+            if reusable:
+                future.set_result(protocol)
+            else:
+                protocol.transport.close()
+                self._open[key] -= 1
+                self._connect(key, future)
+            return
+
+        if reusable:
+            timer = self.loop.call_later(self.idle_timeout, self._expire,
+                                         key, protocol)
+            self._idle.setdefault(key, []).append((protocol, timer))
+        else:
+            protocol.transport.close()
+            self._open[key] -= 1
+
+    def close(self):
+        """
+        Closes the idle connections.
+
+        """
+        for key, idle in self._idle.items():
+            for protocol, timer in idle:
+                timer.cancel()
+                protocol.transport.close()
+                self._open[key] -= 1
+        self._idle.clear()
+
+    def _connect(self, key, future):
+        host, port, ssl = key
+        self._open[key] = self._open.get(key, 0) + 1
+        connecting = _ensure_future(
+            self.loop.create_connection(_HTTPProtocol, host, port, ssl=ssl),
+            self.loop)
+        connecting.add_done_callback(
+            lambda connecting: self._connected(key, future, connecting))
+
+    def _connected(self, key, future, connecting):
+        if connecting.cancelled() or connecting.exception() is not None:
+            self._open[key] -= 1
+            if not future.done():
+                if connecting.cancelled():
+                    future.cancel()
+                else:
+                    future.set_exception(connecting.exception())
+            # let a waiting request try again
+            waiting = self._waiting.get(key)
+            if waiting:
+                self._connect(key, waiting.popleft())
+            return
+
+        transport, protocol = connecting.result()
+        if future.done():
+            # the request was cancelled while connecting
+            self.release(key, protocol, True)
+        else:
+            future.set_result(protocol)
+
+    def _expire(self, key, protocol):
+        idle = self._idle.get(key, [])
+        for item in idle:
+            if item[0] is protocol:
+                idle.remove(item)
+                protocol.transport.close()
+                self._open[key] -= 1
+                return
+
+
+class _ResponseHandler(object):
+    """
+    Decodes the response to one envelope and delivers the results.
+
+    """
+
+    def __init__(self, service, key, protocol, requests):
+        self.service = service
+        self.key = key
+        self.protocol = protocol
+        self.requests = requests
+        self.pending = dict([(request.id, request) for request in requests])
+        self.futures = set([request.deferred for request in requests])
+        self.held = []
+        self.error = None
+        self.decoder = None
+        self.decompressor = None
+
+    def headersReceived(self, status, reason, headers):
+        if not 200 <= status < 300:
+            self.error = remoting.RemotingError(
+                'HTTP Gateway reported status %s %s' % (status, reason))
+            return
+
+        content_type = headers.get('content-type')
+        if content_type != remoting.CONTENT_TYPE:
+            self.error = remoting.RemotingError(
+                'Incorrect MIME type received. (got: %s)' % content_type)
+            return
+
+        content_encoding = headers.get('content-encoding')
+        if content_encoding in ('gzip', 'x-gzip', 'deflate'):
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        elif content_encoding not in (None, 'identity'):
+            self.error = remoting.RemotingError(
+                'Unsupported Content-Encoding received. (got: %s)' %
+                content_encoding)
+            return
+
+        self.decoder = EnvelopeDecoder(self.service._handleAMFHeaders,
+                                       self.bodyReceived, self.service.strict,
+                                       self.service.logger)
+
+    def bodyReceived(self, request_id, message):
+        if self.decoder.complete:
+            self.held.append((request_id, message))
+        else:
+            self.service._dispatchResponse(self.pending, request_id, message)
+
+    def dataReceived(self, data):
+        if self.decoder is None:
+            return
+        try:
+            if self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+            self.decoder.feed(data)
+        except Exception as e:
+            self.decoder = None
+            self.error = e
+            self.protocol.abort()
+
+    def finished(self, reusable):
+        try:
+            if self.decoder is not None:
+                if self.decompressor is not None:
+                    self.decoder.feed(self.decompressor.flush())
+                self.decoder.finish()
+        except Exception as e:
+            self.error = e
+            reusable = False
+
+        self.service.pool.release(self.key, self.protocol, reusable)
+        self.service._batches.discard(self)
+
+        if self.error is not None:
+            self.service._handleAMFError(self.error, self.requests)
+            return
+        for request_id, message in self.held:
+            self.service._dispatchResponse(self.pending, request_id, message)
+        self.service._handleMissingResponses(self.pending)
+
+    def failed(self, exc):
+        self.service.pool.release(self.key, self.protocol, False)
+        self.service._batches.discard(self)
+        self.service._handleAMFError(self.error or exc, self.requests)
+
+    def cancelled(self):
+        """
+        Called when the result of a request of the envelope was cancelled.
+        Aborts the connection once no result is awaited any more.
+
+        """
+        for request in self.requests:
+            if not self.service._isDelivered(request):
+                return
+        self.protocol.abort()
+
+
+class AsyncioRemotingService(RemotingServiceBase):
+    """
+    Remoting service for asyncio event loops, using persistent HTTP/1.1
+    connections.
+
+    The results of calls are :class:`asyncio.Future` objects. Cancelling the
+    future of a call that was not sent yet removes it from the pending
+    requests. Once all the calls of a sent envelope are cancelled, its
+    connection is aborted.
+
+    :ivar pool: the pool of persistent connections
+    :type pool: :class:`ConnectionPool`
+
+    """
+
+    BASE_HTTP_HEADERS = {'Content-Type': remoting.CONTENT_TYPE}
+
+    user_agent = 'Plasma/%s' % version
+
+    def __init__(self, url, amf_version=pyamf.AMF0, user_agent=None,
+                 loop=None, pool=None, max_connections=2, idle_timeout=240,
+                 **kwargs):
+        """
+        :param loop: the event loop, the current event loop by default
+        :param pool: a connection pool to share with other services
+        :type pool: :class:`ConnectionPool`
+        :param max_connections: the maximum number of connections, and
+            thus of envelopes in flight, per host. Ignored if `pool` is
+            given.
+        :type max_connections: `int`
+        :param idle_timeout: the number of seconds after which an idle
+            connection is closed. Ignored if `pool` is given.
+
+        """
+        RemotingServiceBase.__init__(self, amf_version, **kwargs)
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.url = urlparse(url)
+        self.http_headers = self.BASE_HTTP_HEADERS.copy()
+        if user_agent:
+            self.user_agent = user_agent
+
+        if pool is None:
+            pool = ConnectionPool(loop, max_connections, idle_timeout)
+        self.pool = pool
+        self._batches = set()
+
+    def addHTTPHeader(self, name, value):
+        """
+        Adds a header to the underlying HTTP connection.
+
+        """
+        self.http_headers[name] = value
+
+    def removeHTTPHeader(self, name):
+        """
+        Deletes an HTTP header.
+
+        """
+        del self.http_headers[name]
+
+    def callLater(self, delay, func, *args):
+        return self.loop.call_later(delay, func, *args)
+
+    def close(self):
+        """
+        Closes the idle connections to the gateway.
+
+        """
+        self.pool.close()
+
+    def _createDeferred(self):
+        future = _create_future(self.loop)
+        future.add_done_callback(self._futureDone)
+        return future
+
+    def _fireResult(self, future, result):
+        future.set_result(result)
+
+    def _fireError(self, future, error):
+        future.set_exception(error)
+
+    def _isFired(self, future):
+        return future.done()
+
+    def _futureDone(self, future):
+        if not future.cancelled():
+            return
+        try:
+            self.removeRequest(future)
+        except LookupError:
+            # the request was already sent
+            for batch in list(self._batches):
+                if future in batch.futures:
+                    batch.cancelled()
+
+    def _connectionKey(self):
+        url = self.url
+        ssl = url.scheme == 'https'
+        port = url.port or (ssl and 443 or 80)
+        return (url.hostname, port, ssl)
+
+    def _createHTTPRequest(self, body):
+        url = self.url
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        host = url.hostname
+        if url.port:
+            host = '%s:%d' % (host, url.port)
+
+        headers = [('Host', host),
+                   ('User-Agent', self.user_agent),
+                   ('Accept-Encoding', 'gzip, deflate'),
+                   ('Content-Length', str(len(body)))]
+        headers.extend(self.http_headers.items())
+        lines = ['POST %s HTTP/1.1' % (path,)]
+        lines.extend(['%s: %s' % header for header in headers])
+        head = '\r\n'.join(lines) + '\r\n\r\n'
+        if not isinstance(head, bytes):
+            head = head.encode('latin-1')
+        return head + body
+
+    def execute(self):
+        """
+        Builds and sends an envelope with all the pending requests. If all
+        the connections to the gateway are busy, the envelope waits for one
+        to be released.
+
+        :return: a :class:`asyncio.Future` that resolves when the envelope
+            is dispatched, or at once if no request is pending
+
+        """
+        if self.logger:
+            self.logger.debug('Sending POST request to %s', self.url.geturl())
+
+        # Make sure these requests won't get added to another batch. The
+        # callbacks of cancelled futures may not have removed them yet.
+        requests = [request for request in self._takeRequests()
+                    if not self._isDelivered(request)]
+        dispatched = _create_future(self.loop)
+        if not requests:
+            dispatched.set_result(None)
+            return dispatched
+
+        start = self.seconds()
+        body = b''.join(self._encodeAMFRequest(requests))
+        self._recordEnvelope(requests, self.seconds() - start)
+        self.metrics.observe('request_bytes', len(body))
+        data = self._createHTTPRequest(body)
+
+        key = self._connectionKey()
+        connecting = self.pool.acquire(key)
+        connecting.add_done_callback(
+            lambda connecting: self._send(connecting, dispatched, key, data,
+                                          requests))
+        return dispatched
+
+    def _send(self, connecting, dispatched, key, data, requests):
+        if connecting.cancelled() or connecting.exception() is not None:
+            if connecting.cancelled():
+                error = asyncio.CancelledError()
+            else:
+                error = connecting.exception()
+            self._handleAMFError(error, requests)
+            if not dispatched.done():
+                dispatched.set_exception(error)
+            return
+
+        protocol = connecting.result()
+        for request in requests:
+            if not self._isDelivered(request):
+                break
+        else:
+            # every call was cancelled while waiting for a connection
+            self.pool.release(key, protocol, True)
+            if not dispatched.done():
+                dispatched.cancel()
+            return
+
+        handler = _ResponseHandler(self, key, protocol, requests)
+        self._batches.add(handler)
+        protocol.request(data, handler)
+        if not dispatched.done():
+            dispatched.set_result(None)
+
+    def _handleAMFHeaders(self, envelope):
+        if remoting.APPEND_TO_GATEWAY_URL in envelope.headers:
+            url_extension = envelope.headers[remoting.APPEND_TO_GATEWAY_URL]
+            self.url = urlparse(self.url.geturl() + url_extension)
+        elif remoting.REPLACE_GATEWAY_URL in envelope.headers:
+            new_url = envelope.headers[remoting.REPLACE_GATEWAY_URL]
+            self.url = urlparse(new_url)
+        RemotingServiceBase._handleAMFHeaders(self, envelope)
@@ -4,316 +4,1358 @@
 """
 Remoting client implementation.
 
+The classes that do not depend on Twisted are defined in
+:mod:`plasma.service`, and are available from this module too.
+
 """
 
+import httplib
+import random
+import select
+import socket
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from collections import deque
+from itertools import chain
 from urlparse import urlparse
 
-from twisted.web.client import HTTPClientFactory
-from twisted.internet import reactor
-from twisted.internet.defer import Deferred
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from zope.interface import implements
+from twisted.web.client import (Agent, HTTPConnectionPool, FileBodyProducer,
+    ResponseDone, ResponseFailed, ResponseNeverReceived,
+    RequestTransmissionFailed, readBody)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+from twisted.internet import reactor, task
+from twisted.internet.error import ConnectError
+from twisted.internet.defer import Deferred, CancelledError, succeed
+from twisted.python.failure import Failure
+from twisted.internet.protocol import Protocol
 
 from pyamf import remoting
-from pyamf.remoting import get_exception_from_fault
 import pyamf
 
+from plasma.flex.messaging.messages import CommandMessage, operations
+from plasma.flex.messaging.messages.headers import RETRYABLE_ERROR_HINT
+from plasma.service import (RequestTimeoutError, ServiceMethodProxy,
+    ServiceProxy, RequestWrapper, RequestQueue, ResultCache,
+    RemotingMetrics, Histogram, HistogramMetrics, RemotingServiceBase,
+    EncodedHeaders, iter_encode, gzip_pieces, EnvelopeDecoder)
 from plasma.version import version
 
 
-class ServiceMethodProxy(object):
+class EnvelopeProducer(object):
+    """
+    Writes the pieces of an encoded envelope to an HTTP request body, one
+    piece per iteration of a cooperative task. The length of the body is
+    unknown, so it is sent with chunked transfer encoding.
+
+    .. seealso:: :func:`iter_encode`
+
+    """
+
+    implements(IBodyProducer)
+
+    length = UNKNOWN_LENGTH
+
+    def __init__(self, pieces, cooperator=task):
+        self._pieces = pieces
+        self._cooperate = cooperator.cooperate
+        self._task = None
+
+    def startProducing(self, consumer):
+        self._task = self._cooperate(self._writeTo(consumer))
+        d = self._task.whenDone()
+        d.addCallbacks(lambda ignored: None, self._maybeStopped)
+        return d
+
+    def _writeTo(self, consumer):
+        for piece in self._pieces:
+            consumer.write(piece)
+            yield None
+
+    def _maybeStopped(self, failure):
+        if failure.check(CancelledError):
+            self.stopProducing()
+        elif not failure.check(task.TaskStopped):
+            return failure
+        # the Deferred of startProducing must not fire once stopped
+        return Deferred()
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        self._task.stop()
+
+
+class _TimedProducer(object):
+    """
+    Wraps the producer of a request body, to record when the body starts to
+    be written and how many bytes it holds.
+
+    :ivar started: the time the body started to be written, or `None`
+    :ivar size: the number of bytes written so far
+    :type size: `int`
+
+    """
+
+    implements(IBodyProducer)
+
+    def __init__(self, producer, seconds=time.time):
+        self._producer = producer
+        self.length = producer.length
+        self.seconds = seconds
+        self.started = None
+        self.size = 0
+        self._consumer = None
+
+    def startProducing(self, consumer):
+        self.started = self.seconds()
+        self._consumer = consumer
+        return self._producer.startProducing(self)
+
+    def write(self, data):
+        self.size += len(data)
+        self._consumer.write(data)
+
+    def pauseProducing(self):
+        self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._producer.resumeProducing()
+
+    def stopProducing(self):
+        self._producer.stopProducing()
+
+
+class _EnvelopeReceiver(Protocol):
+    """
+    Feeds the body of an HTTP response to an :class:`EnvelopeDecoder`.
+
+    :ivar finished: fires with the number of bytes received once the
+        envelope has been decoded
+    :type finished: :class:`Deferred`
+    :ivar decompressor: decompresses the body if it has a content encoding
+    :type decompressor: a :func:`zlib.decompressobj`
+    :ivar decode_time: the time spent decompressing and decoding the body,
+        in seconds, including the callbacks of the decoder
+    :type decode_time: `float`
+
     """
-    Serves as a proxy for calling a service method.
 
-    :ivar service: the parent service
-    :type service: :class:`~ServiceProxy`
-    :ivar name: the name of the method
-    :type name: `str` or `None`
+    def __init__(self, decoder, finished, decompressor=None,
+                 seconds=time.time):
+        self.decoder = decoder
+        self.finished = finished
+        self.decompressor = decompressor
+        self.seconds = seconds
+        self.size = 0
+        self.decode_time = 0.0
+        self.failed = False
+
+    def abort(self):
+        """
+        Stops receiving the body, and closes the connection.
 
-    .. seealso:: :meth:`ServiceProxy.__getattr__`
+        """
+        if not self.failed:
+            self.failed = True
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.failed:
+            return
+        self.size += len(data)
+        start = self.seconds()
+        try:
+            if self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+            self.decoder.feed(data)
+        except:
+            self.failed = True
+            self.finished.errback()
+            self.transport.stopProducing()
+        self.decode_time += self.seconds() - start
+
+    def connectionLost(self, reason):
+        if self.failed:
+            return
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.errback(reason)
+            return
+        start = self.seconds()
+        try:
+            if self.decompressor is not None:
+                self.decoder.feed(self.decompressor.flush())
+            self.decoder.finish()
+        except:
+            self.finished.errback()
+        else:
+            self.decode_time += self.seconds() - start
+            self.finished.callback(self.size)
+
+
+class DispatchQueue(object):
+    """
+    Limits the number of envelopes in flight to a gateway. Envelopes that
+    are sent while the limit is reached wait in a first in, first out queue.
+
+    The queue can be shared between services that talk to the same gateway.
+
+    :ivar limit: The maximum number of envelopes in flight, or `None` for no
+        limit.
+    :type limit: `int`
+    :ivar in_flight: The number of envelopes in flight.
+    :type in_flight: `int`
+    :ivar dispatched: The number of envelopes dispatched so far.
+    :type dispatched: `int`
+    :ivar max_depth: The largest number of envelopes that were waiting at
+        the same time.
+    :type max_depth: `int`
+    :ivar total_wait: The total time in seconds that the dispatched envelopes
+        spent waiting.
+    :type total_wait: `float`
+    :ivar max_wait: The longest time in seconds that an envelope waited.
+    :type max_wait: `float`
 
     """
 
-    def __init__(self, service, name):
-        self.service = service
-        self.name = name
+    def __init__(self, limit=None, seconds=time.time):
+        self.limit = limit
+        self.seconds = seconds
+        self.in_flight = 0
+        self.dispatched = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._waiting = deque()
+
+    def __len__(self):
+        """
+        Returns the number of envelopes waiting to be dispatched.
 
-    def __call__(self, *args):
         """
-        Inform the proxied service that this function has been called.
+        return len(self._waiting)
+
+    def acquire(self):
         """
-        return self.service._call(self, *args)
+        Reserves a slot for an envelope.
+
+        :return: a :class:`Deferred` that fires with the time spent waiting,
+            in seconds, when the envelope can be sent. Cancelling the
+            :class:`Deferred` removes the envelope from the queue.
 
-    def __str__(self):
         """
-        Returns the full service name, including the method name if there is
-        one.
+        if self.limit is None or self.in_flight < self.limit:
+            self._dispatch(0.0)
+            return succeed(0.0)
 
+        d = Deferred(self._cancel)
+        self._waiting.append((d, self.seconds()))
+        self.max_depth = max(self.max_depth, len(self._waiting))
+        return d
+
+    def release(self):
         """
-        service_name = str(self.service)
+        Frees the slot of an envelope that is no longer in flight, and
+        dispatches the next waiting envelope.
 
-        if self.name is not None:
-            service_name = '%s.%s' % (service_name, self.name)
+        """
+        self.in_flight -= 1
+        if self._waiting and (self.limit is None or
+                              self.in_flight < self.limit):
+            d, queued = self._waiting.popleft()
+            wait = self.seconds() - queued
+            self._dispatch(wait)
+            d.callback(wait)
+
+    def averageWait(self):
+        """
+        Returns the average time in seconds that the dispatched envelopes
+        spent waiting.
 
-        return service_name
+        """
+        if not self.dispatched:
+            return 0.0
+        return self.total_wait / self.dispatched
+
+    def _dispatch(self, wait):
+        self.in_flight += 1
+        self.dispatched += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def _cancel(self, d):
+        for item in self._waiting:
+            if item[0] is d:
+                self._waiting.remove(item)
+                return
 
 
-class ServiceProxy(object):
+class RetryPolicy(object):
     """
-    Serves as a service object proxy for RPC calls. Generates
-    :class:`~ServiceMethodProxy` objects for method calls.
+    Describes how a :class:`HTTPRemotingService` sends requests again.
+
+    Requests are sent again when the connection to the gateway fails, or
+    when the gateway answers them with a Flex error message that has the
+    `DSRetryableErrorHint` header. Only the requests of the envelope that
+    failed are sent again, in a new envelope. If it is unknown whether the
+    gateway received the envelope, only the idempotent requests are sent
+    again.
+
+    The delay before the next attempt grows exponentially with the number
+    of attempts, up to `max_delay`. Each delay is reduced by a random
+    fraction of up to `jitter`, so that clients that failed together do not
+    reconnect together.
+
+    :ivar max_attempts: the maximum number of times a request is sent
+    :type max_attempts: `int`
+    :ivar initial_delay: the delay in seconds after the first attempt
+    :type initial_delay: `float`
+    :ivar max_delay: the maximum delay in seconds
+    :type max_delay: `float`
+    :ivar multiplier: the factor applied to the delay after each attempt
+    :type multiplier: `float`
+    :ivar jitter: the maximum fraction of the delay that is randomly
+        removed, between 0 and 1
+    :type jitter: `float`
 
-    .. seealso:: :class:`~RequestWrapper` for more info.
+    """
 
-    :ivar _gw: The parent gateway
-    :type _gw: :class:`~RemotingService`
-    :ivar _name: The name of the service
-    :type _name: `str`
-    :ivar _auto_execute: If set to `True`, when a service method is called,
-        the AMF request is immediately sent to the remote gateway and a
-        response is returned. If set to `False`, a :class:`~RequestWrapper` is
-        returned, waiting for the underlying gateway to fire the
-        :meth:`RemotingService.execute` method.
+    def __init__(self, max_attempts=3, initial_delay=0.1, max_delay=30,
+                 multiplier=2, jitter=0.5, random=random.random):
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.random = random
 
+    def getDelay(self, attempts):
+        """
+        Returns the number of seconds to wait before sending requests again
+        after `attempts` failed attempts.
+
+        """
+        delay = min(self.max_delay,
+                    self.initial_delay * self.multiplier ** (attempts - 1))
+        return delay * (1 - self.jitter * self.random())
+
+
+class Endpoint(object):
     """
+    A gateway url, and the health of the gateway as seen by the client.
+
+    :ivar url: The url of the gateway in parsed form
+    :type url: :class:`~urlparse.ParseResult`
+    :ivar latency: The moving average of the time in seconds until the
+        gateway starts to answer, or `None` if it has not answered yet.
+    :type latency: `float`
+    :ivar error_rate: The moving average of the fraction of envelopes that
+        failed, between 0 and 1.
+    :type error_rate: `float`
+    :ivar failures: The number of envelopes that failed in a row.
+    :type failures: `int`
+    :ivar down_until: The time until which the gateway is not used because
+        it could not be reached, or `None`.
+    :type down_until: `float`
+
+    """
+
+    def __init__(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        self.url = urlparse(url)
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.down_until = None
 
-    def __init__(self, gw, name, auto_execute=True):
-        self._gw = gw
-        self._name = name
-        self._auto_execute = auto_execute
+    def __repr__(self):
+        return '<%s %s latency=%r error_rate=%.2f>' % (
+            self.__class__.__name__, self.url.geturl(), self.latency,
+            self.error_rate)
 
-    def __getattr__(self, name):
-        return ServiceMethodProxy(self, name)
+    def isDown(self, now):
+        return self.down_until is not None and now < self.down_until
 
-    def _call(self, method_proxy, *args):
+
+class EndpointSelector(object):
+    """
+    Chooses the gateway that receives the next envelope among several
+    gateways that provide the same services.
+
+    The gateways are chosen at random, weighted by their health: a gateway
+    that answers twice as fast receives about twice as many envelopes, and
+    the share of a gateway drops with its error rate. Gateways that have not
+    answered yet are assumed to be as fast as the fastest one. A gateway
+    that could not be reached is not used for `cooldown` seconds, a delay
+    that doubles with each failure in a row up to `max_cooldown`. If all
+    the gateways are down, the one that comes back first is used.
+
+    :ivar endpoints: The gateways, in the order they were given.
+    :type endpoints: `list` of :class:`Endpoint`
+    :ivar decay: The weight of the latest measure in the moving averages,
+        between 0 and 1.
+    :type decay: `float`
+    :ivar cooldown: The number of seconds a gateway that could not be
+        reached is not used.
+    :type cooldown: `float`
+    :ivar max_cooldown: The maximum number of seconds a gateway is not used.
+    :type max_cooldown: `float`
+
+    """
+
+    #: The smallest share of envelopes a gateway receives, relative to its
+    #: latency, whatever its error rate. It lets failing gateways recover.
+    min_weight = 0.05
+
+    def __init__(self, urls, seconds=time.time, random=random.random,
+                 decay=0.3, cooldown=5, max_cooldown=60):
+        if isinstance(urls, basestring):
+            urls = [urls]
+        if not urls:
+            raise ValueError('At least one url is required')
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.seconds = seconds
+        self.random = random
+        self.decay = decay
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def __iter__(self):
+        return iter(self.endpoints)
+
+    def update(self, urls):
         """
-        Executed when a :class:`~ServiceMethodProxy` is called.
-        Adds a request to the underlying gateway. If `_auto_execute` is set to
-        `True`, then the request is immediately called on the remote gateway.
+        Replaces the gateways with those of `urls`. The health of the
+        gateways that were known already is kept.
 
         """
-        d = self._gw.addRequest(method_proxy, *args)
-        if self._auto_execute:
-            self._gw.execute()
-        return d
+        if not urls:
+            raise ValueError('At least one url is required')
+        known = dict([(endpoint.url.geturl(), endpoint)
+                      for endpoint in self.endpoints])
+        endpoints = []
+        for url in urls:
+            endpoint = known.pop(url, None)
+            if endpoint is None:
+                endpoint = Endpoint(url)
+            endpoints.append(endpoint)
+        self.endpoints = endpoints
+
+    def available(self, exclude=()):
+        """
+        Returns the gateways that are not down and not in `exclude`.
 
-    def __call__(self, *args):
+        :rtype: `list` of :class:`Endpoint`
+
+        """
+        now = self.seconds()
+        return [endpoint for endpoint in self.endpoints
+                if endpoint not in exclude and not endpoint.isDown(now)]
+
+    def select(self, exclude=()):
         """
-        This allows services to be 'called' without a method name.
+        Returns the gateway to send the next envelope to. The gateways in
+        `exclude` are only used if there is no other one.
+
+        :rtype: :class:`Endpoint`
 
         """
-        return self._call(ServiceMethodProxy(self, None), *args)
+        candidates = self.available(exclude)
+        if not candidates:
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint not in exclude] or self.endpoints
+            return min(candidates,
+                       key=lambda endpoint: endpoint.down_until or 0)
+        if len(candidates) == 1:
+            return candidates[0]
+
+        latencies = [endpoint.latency for endpoint in candidates
+                     if endpoint.latency is not None]
+        if latencies:
+            default = min(latencies)
+        else:
+            default = 1.0
+        weights = []
+        for endpoint in candidates:
+            latency = endpoint.latency
+            if latency is None:
+                latency = default
+            weights.append(max(self.min_weight, 1 - endpoint.error_rate) /
+                           max(latency, 1e-6))
+
+        point = self.random() * sum(weights)
+        for endpoint, weight in zip(candidates, weights):
+            point -= weight
+            if point < 0:
+                return endpoint
+        return candidates[-1]
+
+    def recordSuccess(self, endpoint, latency):
+        """
+        Records that `endpoint` started to answer after `latency` seconds.
 
-    def __str__(self):
         """
-        Returns a string representation of the name of the service.
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency += self.decay * (latency - endpoint.latency)
+        endpoint.error_rate -= self.decay * endpoint.error_rate
+        endpoint.failures = 0
+        endpoint.down_until = None
+
+    def recordFailure(self, endpoint, down=False):
+        """
+        Records that an envelope sent to `endpoint` failed.
+
+        :param down: whether the gateway could not be reached at all
+        :type down: `bool`
 
         """
-        return self._name
+        endpoint.error_rate += self.decay * (1 - endpoint.error_rate)
+        endpoint.failures += 1
+        if down:
+            cooldown = min(self.max_cooldown,
+                           self.cooldown * 2 ** (endpoint.failures - 1))
+            endpoint.down_until = self.seconds() + cooldown
 
 
-class RequestWrapper(object):
+class _Batch(object):
     """
-    A container object that wraps a service method request.
-
-    :ivar id: The id of the request.
-    :type id: `str`
-    :ivar service: The service proxy.
-    :type service: :class:`~ServiceProxy`
-    :ivar args: The args used to invoke the call.
-    :type args: `list`
+    The requests of an envelope sent by a :class:`HTTPRemotingService`,
+    until its response has been handled.
+
+    :ivar deadline: the deadline of the whole envelope, if any
+    :ivar dispatched: fires when the envelope is dispatched
+    :type dispatched: :class:`Deferred`
+    :ivar slot: whether the envelope holds a slot of the dispatch queue
+    :ivar sent: fires with the response to the HTTP request, once sent
+    :type sent: :class:`Deferred`
+    :ivar timer: the call that expires the requests at the next deadline
+    :ivar retry: the requests to send again once the response is handled
+    :type retry: `list`
+    :ivar tried: the endpoints the requests were sent to, this one included
+    :type tried: `set`
+    :ivar endpoint: the endpoint the envelope is sent to
+    :type endpoint: :class:`Endpoint`
+    :ivar sent_at: the time the envelope was sent
+    :ivar failover: whether the requests to send again can be sent to
+        another endpoint immediately
+    :ivar timed_out: whether the envelope was abandoned because its
+        requests timed out
+    :ivar producer: the producer of the request body
+    :type producer: :class:`_TimedProducer`
+    :ivar response_at: the time the response headers were received
 
     """
 
-    def __init__(self, id_, service, *args):
-        self.id = id_
-        self.service = service
-        self.args = args
-        self.deferred = Deferred()
+    def __init__(self, requests, deadline=None, tried=None):
+        self.requests = requests
+        self.deadline = deadline
+        self.dispatched = None
+        self.slot = False
+        self.sent = None
+        self.timer = None
+        self.retry = []
+        self.tried = set(tried or ())
+        self.endpoint = None
+        self.sent_at = None
+        self.failover = False
+        self.timed_out = False
+        self.producer = None
+        self.response_at = None
+
+    def waiting(self, ignored=None):
+        """
+        Returns whether a request, other than the one of the `ignored`
+        :class:`Deferred`, still awaits its result.
+
+        """
+        for request in self.requests:
+            for deferred in [request.deferred] + (request.followers or []):
+                if deferred is not ignored and not deferred.called:
+                    return True
+        return False
+
+    def abort(self):
+        """
+        Abandons the envelope. It is removed from the dispatch queue if it
+        was not sent yet, otherwise its connection is closed.
+
+        """
+        if self.sent is not None:
+            self.sent.cancel()
+        elif self.dispatched is not None:
+            self.dispatched.cancel()
 
 
-class RemotingServiceBase(object):
+class HTTPRemotingService(RemotingServiceBase):
     """
-    Acts as a client for AMF calls.
-
-    :ivar requests: The list of pending requests to process.
-    :type requests: `list`
-    :ivar request_number: A unique identifier for tracking the number of
-        requests.
-    :ivar amf_version: The AMF version to use.
-        See :data:`ENCODING_TYPES <pyamf.ENCODING_TYPES>`.
-    :type amf_version: `int`
-    :ivar headers: A list of persistent headers to send with each request.
-    :type headers: :class:`~pyamf.remoting.HeaderCollection`
-    :ivar strict: Whether to use strict AMF en/decoding or not.
-    :type strict: `bool`
+    Remoting service using HTTP/1.1 requests. Sends one request, or a batch
+    of requests to the remote server, and invokes all the callbacks when it
+    receives a reply.
+
+    Connections to the gateway are kept alive and reused by later calls to
+    :meth:`execute`. Cached connections that the gateway has closed are
+    discarded before they are reused, and idle connections are closed after
+    `idle_timeout` seconds.
+
+    Requests that are not answered before their deadline fail with a
+    :class:`RequestTimeoutError`, and cancelling the :class:`Deferred` of a
+    request fails it with a :class:`CancelledError`. The other requests of
+    the envelope are not affected. Once no request of a sent envelope
+    awaits its result, the connection is closed.
+
+    The service can be given the urls of several gateways that provide the
+    same services. Each envelope is sent to one of them, chosen by
+    :attr:`endpoints` from their latency and error rate. When a gateway
+    cannot be reached, or a gateway fails before answering idempotent
+    requests, the requests are sent to another gateway immediately.
+    :meth:`discoverEndpoints` asks the gateway for the urls of the other
+    members of its cluster.
+
+    :ivar endpoints: the gateways the envelopes are sent to
+    :type endpoints: :class:`EndpointSelector`
+    :ivar pool: the pool of persistent connections
+    :type pool: :class:`~twisted.web.client.HTTPConnectionPool`
+    :ivar dispatcher: the queue that limits the number of envelopes in
+        flight
+    :type dispatcher: :class:`DispatchQueue`
+    :ivar stream_threshold: Envelopes larger than this number of bytes are
+        encoded while they are sent, with chunked transfer encoding, instead
+        of being encoded in memory first. `None` disables streaming, as
+        some gateways do not accept chunked request bodies.
+    :type stream_threshold: `int`
+    :ivar compress_threshold: Envelopes of at least this number of bytes are
+        sent compressed with gzip. `None` disables request compression, as
+        most gateways do not accept compressed request bodies.
+    :type compress_threshold: `int`
+    :ivar accept_compressed: Whether to ask the gateway for compressed
+        responses. gzip and deflate responses are decompressed as they
+        arrive.
+    :type accept_compressed: `bool`
+    :ivar retry_policy: How requests that failed are sent again, or `None`
+        to never send them again.
+    :type retry_policy: :class:`RetryPolicy`
 
     """
 
-    def __init__(self, amf_version=pyamf.AMF0, strict=False, logger=None):
-        self.amf_version = amf_version
+    BASE_HTTP_HEADERS = {'Content-Type': remoting.CONTENT_TYPE}
 
-        self.requests = []
-        self.request_number = 1
-        self.headers = remoting.HeaderCollection()
-        self.strict = strict
-        self.logger = logger
+    user_agent = 'Plasma/%s' % version
 
-    def addHeader(self, name, value, must_understand=False):
+    def __init__(self, url, amf_version=pyamf.AMF0,
+                 user_agent=None, pool=None, max_connections=2,
+                 idle_timeout=240, dispatcher=None, max_in_flight=None,
+                 stream_threshold=None, compress_threshold=None,
+                 accept_compressed=True, retry_policy=None, **kwargs):
         """
-        Sets a persistent AMF header to send with each request.
+        :param url: The url of the remote gateway, or a list of the urls of
+            equivalent gateways
+        :type url: `str` or `list`
+        :ivar user_agent: The User-Agent header to pass to the server
+            (defaults to "Plasma/x.xx")
+        :type user_agent: `str`
+        :param pool: a connection pool to share with other services. If not
+            given, the service creates its own pool.
+        :type pool: :class:`~twisted.web.client.HTTPConnectionPool`
+        :param max_connections: the maximum number of idle connections to
+            keep open per host. Ignored if `pool` is given.
+        :type max_connections: `int`
+        :param idle_timeout: the number of seconds after which an idle
+            connection is closed. Ignored if `pool` is given.
+        :type idle_timeout: `int`
+        :param dispatcher: a dispatch queue to share with other services.
+        :type dispatcher: :class:`DispatchQueue`
+        :param max_in_flight: the maximum number of envelopes sent
+            concurrently, or `None` for no limit. Ignored if `dispatcher` is
+            given.
+        :type max_in_flight: `int`
+
+        """
+        RemotingServiceBase.__init__(self, amf_version, **kwargs)
+        self.endpoints = EndpointSelector(url, reactor.seconds)
+        self.http_headers = self.BASE_HTTP_HEADERS.copy()
+        if user_agent:
+            self.user_agent = user_agent
+
+        if pool is None:
+            pool = HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost = max_connections
+            pool.cachedConnectionTimeout = idle_timeout
+        self.pool = pool
+        self._agent = Agent(reactor, pool=pool)
+
+        if dispatcher is None:
+            dispatcher = DispatchQueue(max_in_flight, reactor.seconds)
+        self.dispatcher = dispatcher
+        self.stream_threshold = stream_threshold
+        self.compress_threshold = compress_threshold
+        self.accept_compressed = accept_compressed
+        self.retry_policy = retry_policy
+        self._batches = {}
 
-        :param name: Header name.
-        :type name: `str`
-        :param must_understand: Default is `False`.
-        :type must_understand: `bool`
+    def _getURL(self):
+        return self.endpoints.endpoints[0].url
 
+    def _setURL(self, url):
+        self.endpoints.endpoints[0].url = url
+
+    url = property(_getURL, _setURL, doc="""
+        The url of the first gateway in parsed form.
+
+        :type: :class:`~urlparse.ParseResult`
+        """)
+
+    def addHTTPHeader(self, name, value):
         """
-        self.headers[name] = value
-        self.headers.set_required(name, must_understand)
+        Adds a header to the underlying HTTP connection.
 
-    def getService(self, name, auto_execute=True):
         """
-        Returns a :class:`~ServiceProxy` for the supplied name. Sets up an
-        object that can have method calls made to it that build the AMF
-        requests.
+        self.http_headers[name] = value
 
-        :param auto_execute: Default is `True`.
-        :type auto_execute: `bool`
-        :raise TypeError: `string` type required for `name`.
-        :rtype: :class:`ServiceProxy`
+    def removeHTTPHeader(self, name):
+        """
+        Deletes an HTTP header.
 
         """
-        if not isinstance(name, basestring):
-            raise TypeError('string type required')
+        del self.http_headers[name]
+
+    def callLater(self, delay, func, *args):
+        return reactor.callLater(delay, func, *args)
+
+    def seconds(self):
+        return reactor.seconds()
 
-        return ServiceProxy(self, name, auto_execute)
+    def _createDeferred(self):
+        return Deferred(self._cancelRequest)
 
-    def addRequest(self, service, *args):
+    def _cancelRequest(self, deferred):
         """
-        Adds a request to be sent to the remoting gateway.
+        Removes a cancelled request that was not sent yet. If it was sent,
+        its envelope is abandoned once no other request of it awaits its
+        result.
+
+        """
+        try:
+            self.removeRequest(deferred)
+        except LookupError:
+            batch = self._batches.get(deferred)
+            if batch is not None and not batch.waiting(deferred):
+                batch.abort()
+
+    def close(self):
+        """
+        Closes the idle connections to the gateway.
 
-        :return: a :class:`Deferred` that will callback when the invocation
-                 result is available
+        :return: a :class:`Deferred` that fires when the connections are
+            closed
 
         """
-        request = RequestWrapper('/%d' % self.request_number, service, *args)
+        return self.pool.closeCachedConnections()
+
+    def _getRequestHeaders(self, content_encoding=None):
+        headers = Headers({'User-Agent': [self.user_agent]})
+        if self.accept_compressed:
+            headers.setRawHeaders('Accept-Encoding', ['gzip, deflate'])
+        if content_encoding is not None:
+            headers.setRawHeaders('Content-Encoding', [content_encoding])
+        for key, value in self.http_headers.iteritems():
+            headers.setRawHeaders(key, [value])
+        return headers
+
+    def execute(self, timeout=None):
+        """
+        Builds and sends an envelope with all the pending requests. If the
+        maximum number of envelopes is in flight, the envelope is queued
+        until another one completes.
 
-        self.request_number += 1
-        self.requests.append(request)
+        :param timeout: the number of seconds after which all the requests
+            of the envelope time out, or `None`
+        :type timeout: `float`
+        :return: a :class:`Deferred` that fires when the envelope is
+            dispatched, or abandoned
 
+        """
         if self.logger:
-            self.logger.debug('Adding request %s%r', request.service, args)
+            self.logger.debug('User-Agent: %s', self.user_agent)
+            for key, value in self.http_headers.iteritems():
+                self.logger.debug('%s: %s', key, value)
 
-        return request.deferred
+        # Make sure these requests won't get added to another batch
+        requests = self._takeRequests()
+        deadline = None
+        if timeout is not None:
+            deadline = self.seconds() + timeout
+        return self._dispatch(requests, deadline)
 
-    def removeRequest(self, deferred):
+    def _dispatch(self, requests, deadline=None, tried=None):
         """
-        Removes a request from the pending request list.
+        Encodes an envelope with the requests, and sends it once the
+        dispatch queue allows it.
 
-        :raise LookupError: Request not found.
+        :param deadline: the deadline of the whole envelope, if any
+        :param tried: the endpoints the requests were just sent to, and
+            that failed
+        :return: a :class:`Deferred` that fires when the envelope is
+            dispatched, or abandoned
 
         """
-        for index, request in enumerate(self.requests):
-            if request.deferred == deferred:
-                if self.logger:
-                    self.logger.debug('Removing request: %s', request)
-                del self.requests[index]
-                return
+        for request in requests:
+            request.attempts += 1
+
+        start = self.seconds()
+        body = self._createBodyProducer(
+            self._encodeAMFRequest(requests, deadline))
+        self._recordEnvelope(requests, self.seconds() - start)
+
+        batch = _Batch(requests, deadline, tried)
+        for request in requests:
+            self._batches[request.deferred] = batch
+        self._watchDeadline(batch)
 
-        raise LookupError("Request not found")
+        batch.dispatched = dispatched = self.dispatcher.acquire()
+        dispatched.addCallback(self._acquireSlot, batch)
+        dispatched.addCallback(self._logDispatch, requests)
+        dispatched.addCallback(self._send, body, batch)
+        dispatched.addErrback(self._handleDispatchError, batch)
+        return dispatched
 
-    def _createAMFRequest(self, requests):
+    def _watchDeadline(self, batch):
         """
-        Builds an AMF request :class:`~pyamf.remoting.Envelope` from the
-        stored list of requests.
+        Schedules the expiry of the requests of the batch at the next
+        deadline, if any.
 
-        :rtype: :class:`~pyamf.remoting.Envelope`
+        """
+        deadline = self._getDeadline(batch.requests, batch.deadline)
+        if deadline is not None:
+            batch.timer = self.callLater(max(0, deadline - self.seconds()),
+                                         self._expireRequests, batch)
+
+    def _expireRequests(self, batch):
+        """
+        Fails the requests of the batch that have reached their deadline,
+        and abandons the envelope if no request awaits its result any more.
 
         """
-        envelope = remoting.Envelope(self.amf_version)
+        batch.timer = None
+        now = self.seconds()
+        for request in batch.requests:
+            if self._isDelivered(request):
+                continue
+            deadline = self._getDeadline([request], batch.deadline)
+            if deadline is not None and deadline <= now:
+                if self.logger:
+                    self.logger.debug('Request %s timed out', request.id)
+                self.metrics.increment('timeouts')
+                self._deliverError(request, RequestTimeoutError(
+                    'Request %s timed out' % request.id))
+
+        if batch.waiting():
+            self._watchDeadline(batch)
+        else:
+            batch.timed_out = True
+            batch.abort()
+
+    def _forgetBatch(self, result, batch):
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        for request in batch.requests:
+            self._batches.pop(request.deferred, None)
+        if batch.retry:
+            if batch.failover:
+                self._retry(batch.retry, batch.deadline, batch.tried)
+            else:
+                self._retryLater(batch.retry, batch.deadline)
+            batch.retry = []
+        return result
+
+    def _canRetry(self, request):
+        return (self.retry_policy is not None and
+                not self._isDelivered(request) and
+                request.attempts < self.retry_policy.max_attempts)
+
+    def _retryLater(self, requests, deadline=None):
+        """
+        Sends the requests again in a new envelope, after the delay of the
+        retry policy.
 
+        """
+        attempts = max([request.attempts for request in requests])
+        delay = self.retry_policy.getDelay(attempts)
         if self.logger:
-            self.logger.debug('AMF version: %s', self.amf_version)
+            self.logger.debug('Sending %d request(s) again in %.3fs',
+                              len(requests), delay)
+        self.callLater(delay, self._retry, requests, deadline)
 
+    def _retry(self, requests, deadline=None, tried=None):
+        now = self.seconds()
+        retry = []
         for request in requests:
-            service = request.service
-            args = list(request.args)
-            envelope[request.id] = remoting.Request(str(service), args)
+            # the request may have been cancelled in the meantime
+            if self._isDelivered(request):
+                continue
+            request_deadline = self._getDeadline([request], deadline)
+            if request_deadline is not None and request_deadline <= now:
+                self.metrics.increment('timeouts')
+                self._deliverError(request, RequestTimeoutError(
+                    'Request %s timed out' % request.id))
+            else:
+                retry.append(request)
+        if retry:
+            self.metrics.increment('retries', len(retry))
+            self._dispatch(retry, deadline, tried)
+
+    def _handleSendError(self, failure, batch):
+        """
+        Fails the requests of an envelope whose response could not be
+        received, or keeps them to be sent again if another endpoint is
+        available or the retry policy allows it.
+
+        """
+        if failure.check(ConnectError, RequestTransmissionFailed):
+            # the gateway did not receive the envelope
+            retryable = lambda request: True
+        elif failure.check(ResponseNeverReceived, ResponseFailed):
+            retryable = lambda request: request.idempotent
+        else:
+            retryable = lambda request: False
+
+        batch.failover = bool(self.endpoints.available(batch.tried))
+        for request in batch.requests:
+            if self._isDelivered(request):
+                continue
+            if retryable(request) and (batch.failover or
+                                       self._canRetry(request)):
+                batch.retry.append(request)
+            else:
+                self._deliverError(request, failure)
+
+    def _dispatchResponse(self, pending, request_id, response):
+        request = pending.get(request_id)
+        if (request is not None and
+            response.status == remoting.STATUS_ERROR and
+            self._isRetryableFault(response.body)):
+            batch = self._batches.get(request.deferred)
+            if batch is not None and self._canRetry(request):
+                del pending[request_id]
+                batch.retry.append(request)
+                return
+        RemotingServiceBase._dispatchResponse(self, pending, request_id,
+                                              response)
+
+    @staticmethod
+    def _isRetryableFault(fault):
+        headers = getattr(fault, 'headers', None)
+        if not isinstance(headers, dict):
+            return False
+        return bool(headers.get(RETRYABLE_ERROR_HINT.value))
 
-        envelope.headers = self.headers
-        return envelope
+    def _handleDispatchError(self, failure, batch):
+        """
+        Fails the requests of an envelope that could not be sent, or that
+        was abandoned before it was sent. Its slot in the dispatch queue is
+        released if it was acquired.
 
-    def _handleAMFResponse(self, envelope, requests):
         """
-        Handles the AMF response from the server.
+        self._releaseSlot(None, batch)
+        self._forgetBatch(None, batch)
+        self._handleAMFError(failure, batch.requests)
+
+    def _logDispatch(self, wait, requests):
+        self.metrics.observe('queue_wait', wait)
+        if self.logger:
+            self.logger.debug('Dispatching %d request(s) after waiting %.3fs',
+                              len(requests), wait)
 
-        :type response: :class:`~pyamf.remoting.Envelope`
+    def _createBodyProducer(self, pieces):
+        """
+        Returns the producer for the body of a request. Pieces of the
+        encoded envelope are buffered up to `stream_threshold` bytes, or
+        until it is known whether the envelope reaches `compress_threshold`
+        bytes. If the envelope is larger, the rest is encoded while the
+        request is sent. The body is compressed if it reaches
+        `compress_threshold` bytes.
+
+        :param pieces: an iterator over the pieces of the encoded envelope
+        :return: the producer and the content encoding of the body, or
+            `None` if it is not compressed
+        :rtype: `tuple`
 
         """
+        buffered = []
+        size = 0
+        streamed = False
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            if (self.stream_threshold is not None and
+                size > self.stream_threshold and
+                (self.compress_threshold is None or
+                 size >= self.compress_threshold)):
+                streamed = True
+                break
+
+        if streamed:
+            pieces = chain(buffered, pieces)
+        else:
+            pieces = buffered
+
+        content_encoding = None
+        if (self.compress_threshold is not None and
+            size >= self.compress_threshold):
+            pieces = gzip_pieces(pieces)
+            content_encoding = 'gzip'
+
+        if streamed:
+            if self.logger:
+                self.logger.debug('Streaming the request body')
+            return EnvelopeProducer(pieces), content_encoding
+        return FileBodyProducer(StringIO(''.join(pieces))), content_encoding
+
+    def _send(self, result, body, batch):
+        producer, content_encoding = body
+        batch.endpoint = endpoint = self.endpoints.select(batch.tried)
+        batch.tried.add(endpoint)
+        url = endpoint.url.geturl()
         if self.logger:
-            self.logger.debug('Response: %s' % envelope)
+            self.logger.debug('Sending POST request to %s', url)
+
+        batch.producer = producer = _TimedProducer(producer, self.seconds)
+        batch.sent_at = self.seconds()
+        batch.sent = d = self._agent.request('POST', url,
+            self._getRequestHeaders(content_encoding), producer)
+        pending = dict([(request.id, request) for request in batch.requests])
+        d.addBoth(self._recordHealth, batch)
+        d.addCallback(self._recordFirstByte, batch)
+        d.addCallback(self._handleHTTPResponse, pending, endpoint, batch)
+        d.addBoth(self._releaseSlot, batch)
+        d.addCallbacks(self._handleResponseEnd, self._handleSendError,
+                       [pending], errbackArgs=[batch])
+        d.addBoth(self._forgetBatch, batch)
+
+    def _acquireSlot(self, wait, batch):
+        batch.slot = True
+        return wait
+
+    def _releaseSlot(self, result, batch):
+        if batch.slot:
+            batch.slot = False
+            self.dispatcher.release()
+        return result
+
+    def _recordHealth(self, result, batch):
+        """
+        Records the latency of the endpoint the batch was sent to, or that
+        it failed. Envelopes cancelled by the caller do not count.
 
-        if remoting.REQUEST_PERSISTENT_HEADER in envelope.headers:
-            data = envelope.headers[remoting.REQUEST_PERSISTENT_HEADER]
-            for k, v in data.iteritems():
-                self.headers[k] = v
+        """
+        if isinstance(result, Failure):
+            if result.check(CancelledError) and not batch.timed_out:
+                return result
+            self.metrics.increment('envelope_errors')
+            self.endpoints.recordFailure(batch.endpoint,
+                                         down=bool(result.check(ConnectError)))
+        elif result.code >= 500:
+            self.metrics.increment('envelope_errors')
+            self.endpoints.recordFailure(batch.endpoint)
+        else:
+            self.endpoints.recordSuccess(batch.endpoint,
+                                         self.seconds() - batch.sent_at)
+        return result
+
+    def _recordFirstByte(self, response, batch):
+        batch.response_at = now = self.seconds()
+        started = batch.producer.started
+        if started is not None:
+            self.metrics.observe('connect', started - batch.sent_at)
+            self.metrics.observe('first_byte', now - started)
+        return response
 
-        for request in requests:
-            response = envelope[request.id]
-            if response.status == remoting.STATUS_OK:
-                request.deferred.callback(response.body)
-            elif response.status == remoting.STATUS_ERROR:
-                exc_class = get_exception_from_fault(response.body)
-                exception = exc_class(response.body.description)
-                request.deferred.errback(exception)
-
-    def _handleAMFError(self, failure, requests):
-        for request in requests:
-            request.deferred.errback(failure)
+    @staticmethod
+    def _getHTTPHeader(http_headers, key):
+        values = http_headers.getRawHeaders(key)
+        if values:
+            return values[0]
 
-    def execute(self):
+    def _handleHTTPResponse(self, response, pending, endpoint=None,
+                            batch=None):
         """
-        Builds, sends and handles the responses to all requests listed in
-        `self.requests`.
+        Handles the HTTP response from the remote gateway. The body is
+        decoded as it arrives, and the :class:`Deferred` of each request
+        fires as soon as its response has been decoded. Only the last
+        response is held back until the whole HTTP response has been read,
+        so that the connection is available again when its callbacks run.
+
+        :param pending: the requests that are not answered yet, by id
+        :type pending: `dict`
+        :param endpoint: the endpoint that answers, or the first one
+        :type endpoint: :class:`Endpoint`
+        :param batch: the batch the response answers, if any
+        :type batch: :class:`_Batch`
+        :return: a :class:`Deferred` that fires with the held back responses
+            when the whole HTTP response has been read
+        :raise RemotingError: HTTP Gateway reported error status
+        :raise RemotingError: Incorrect MIME type received
 
         """
-        raise NotImplementedError
+        if not 200 <= response.code < 300:
+            # The body is read anyway, so that the connection can be reused
+            d = readBody(response)
+            d.addBoth(self._handleHTTPError, response)
+            return d
+
+        # Check content type
+        content_type = self._getHTTPHeader(response.headers, 'content-type')
+        if content_type != remoting.CONTENT_TYPE:
+            if self.logger:
+                self.logger.debug('Content-Type: %s', content_type)
+            d = readBody(response)
+            d.addBoth(self._raiseError, remoting.RemotingError(
+                'Incorrect MIME type received. (got: %s)' % content_type))
+            return d
+
+        content_encoding = self._getHTTPHeader(response.headers,
+                                               'content-encoding')
+        if content_encoding in (None, 'identity'):
+            decompressor = None
+        elif content_encoding in ('gzip', 'x-gzip', 'deflate'):
+            # accepts both the gzip and the zlib format
+            decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        else:
+            d = readBody(response)
+            d.addBoth(self._raiseError, remoting.RemotingError(
+                'Unsupported Content-Encoding received. (got: %s)' %
+                content_encoding))
+            return d
+
+        if self.logger:
+            self.logger.debug('Content-Length: %s',
+                self._getHTTPHeader(response.headers, 'content-length'))
+            self.logger.debug('Content-Encoding: %s', content_encoding)
+            self.logger.debug('Server: %s',
+                self._getHTTPHeader(response.headers, 'server'))
+
+        held = []
+        # the time spent in the callbacks of the decoder
+        dispatch_time = [0.0]
+
+        def body_received(request_id, message):
+            if decoder.complete:
+                held.append((request_id, message))
+            else:
+                start = self.seconds()
+                self._dispatchResponse(pending, request_id, message)
+                dispatch_time[0] += self.seconds() - start
+
+        decoder = EnvelopeDecoder(
+            lambda envelope: self._handleAMFHeaders(envelope, endpoint),
+            body_received, self.strict, self.logger)
+        d = Deferred(lambda d: receiver.abort())
+        receiver = _EnvelopeReceiver(decoder, d, decompressor, self.seconds)
+        response.deliverBody(receiver)
+        d.addCallback(self._recordResponse, held, receiver, dispatch_time,
+                      batch)
+        return d
+
+    def _recordResponse(self, size, held, receiver, dispatch_time,
+                         batch=None):
+        if self.logger:
+            self.logger.debug('Read %d bytes for the response', size)
+        metrics = self.metrics
+        metrics.observe('response_bytes', size)
+        metrics.observe('decode', receiver.decode_time - dispatch_time[0])
+        if batch is not None:
+            metrics.observe('request_bytes', batch.producer.size)
+            metrics.observe('transfer', self.seconds() - batch.response_at)
+        return held
+
+    def _handleResponseEnd(self, held, pending):
+        for request_id, message in held:
+            self._dispatchResponse(pending, request_id, message)
+        self._handleMissingResponses(pending)
 
-    def setCredentials(self, username, password):
+    @staticmethod
+    def _raiseError(result, error):
+        raise error
+
+    def _handleHTTPError(self, result, response):
+        raise remoting.RemotingError('HTTP Gateway reported status %s %s' %
+                                     (response.code, response.phrase))
+
+    def _handleAMFHeaders(self, envelope, endpoint=None):
+        if endpoint is None:
+            endpoint = self.endpoints.endpoints[0]
+        if remoting.APPEND_TO_GATEWAY_URL in envelope.headers:
+            url_extension = envelope.headers[remoting.APPEND_TO_GATEWAY_URL]
+            endpoint.url = urlparse(endpoint.url.geturl() + url_extension)
+        elif remoting.REPLACE_GATEWAY_URL in envelope.headers:
+            new_url = envelope.headers[remoting.REPLACE_GATEWAY_URL]
+            endpoint.url = urlparse(new_url)
+        RemotingServiceBase._handleAMFHeaders(self, envelope)
+
+    def discoverEndpoints(self):
         """
-        Sets authentication credentials for accessing the remote gateway.
+        Asks the gateway for the urls of the members of its cluster, and
+        sends the next envelopes to them. Urls that are not HTTP urls are
+        ignored. If the gateway does not know of any, the endpoints are
+        left as they are.
+
+        :return: a :class:`Deferred` that fires with the list of urls
+            received
 
         """
-        self.addHeader('Credentials', dict(userid=unicode(username),
-            password=unicode(password)), True)
+        message = CommandMessage(operation=operations.cluster_request,
+                                 messageId=str(uuid.uuid4()).upper())
+        d = self.getService('null')(message)
+        d.addCallback(self._handleClusterResponse)
+        return d
+
+    def _handleClusterResponse(self, message):
+        body = getattr(message, 'body', message)
+        if isinstance(body, (basestring, dict)):
+            body = [body]
+
+        urls = []
+        for item in body or []:
+            if isinstance(item, dict):
+                candidates = item.values()
+            else:
+                candidates = [item]
+            for url in candidates:
+                if (isinstance(url, basestring) and
+                    urlparse(url).scheme in ('http', 'https') and
+                    url not in urls):
+                    urls.append(url)
+
+        if urls:
+            if self.logger:
+                self.logger.debug('Cluster endpoints: %s', ', '.join(urls))
+            self.endpoints.update(urls)
+        return urls
 
 
-class HTTPRemotingService(RemotingServiceBase):
+class CallResult(object):
     """
-    Remoting service using standard HTTP/1.0 requests. Sends one request, or
-    a batch of requests to the remote server, and invokes all the callbacks
-    when it receives a reply.
+    Receives the result of a call made with a
+    :class:`BlockingRemotingService`. Any thread can wait for it.
 
     """
 
-    BASE_HTTP_HEADERS = {'Content-Type': remoting.CONTENT_TYPE}
+    def __init__(self):
+        self._event = threading.Event()
+        self._value = None
+        self._error = None
 
-    user_agent = 'Plasma/%s' % version
+    def done(self):
+        """
+        Returns whether the result of the call has been received.
 
-    def __init__(self, url, amf_version=pyamf.AMF0,
-                 user_agent=None, **kwargs):
         """
-        :ivar url: The url of the remote gateway in parsed form
-        :type url: :class:`~urlparse.ParseResult`
-        :ivar user_agent: The User-Agent header to pass to the server
-            (defaults to "Plasma/x.xx")
-        :type user_agent: `str`
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """
+        Waits for the result of the call.
+
+        :param timeout: the maximum number of seconds to wait, or `None` to
+            wait until the result is received
+        :return: the result of the call
+        :raise RemotingError: No result was received within `timeout`
+            seconds.
+        :raise Exception: the error of the call
+
+        """
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return self._value
 
+    def exception(self, timeout=None):
         """
+        Waits for the result of the call.
+
+        :return: the error of the call, or `None` if it succeeded
+        :raise RemotingError: No result was received within `timeout`
+            seconds.
+
+        """
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise remoting.RemotingError(
+                'No result received within %s seconds' % (timeout,))
+        return self._error
+
+    def _setResult(self, value):
+        self._value = value
+        self._event.set()
+
+    def _setError(self, error):
+        self._error = error
+        self._event.set()
+
+
+class BlockingRemotingService(RemotingServiceBase):
+    """
+    Remoting service using blocking HTTP/1.1 requests, for scripts and
+    worker processes that do not run a reactor.
+
+    Calls made through an auto executing :class:`ServiceProxy` return their
+    result, or raise their error. Other calls return a :class:`CallResult`,
+    and are sent together by :meth:`execute`.
+
+    Each thread uses its own persistent connection to the gateway, so that
+    a service can be shared by the threads of a pool. A connection that the
+    gateway closed while it was idle is opened again, and the envelope is
+    sent once more.
+
+    :ivar timeout: the timeout of the socket operations in seconds, or
+        `None` for the default socket timeout
+    :type timeout: `float`
+    :ivar accept_compressed: Whether to ask the gateway for compressed
+        responses.
+    :type accept_compressed: `bool`
+
+    """
+
+    BASE_HTTP_HEADERS = {'Content-Type': remoting.CONTENT_TYPE}
+
+    user_agent = 'Plasma/%s' % version
+
+    #: the number of bytes of the response read at a time
+    read_size = 65536
+
+    def __init__(self, url, amf_version=pyamf.AMF0, user_agent=None,
+                 timeout=None, accept_compressed=True, **kwargs):
         RemotingServiceBase.__init__(self, amf_version, **kwargs)
         self.url = urlparse(url)
         self.http_headers = self.BASE_HTTP_HEADERS.copy()
         if user_agent:
             self.user_agent = user_agent
+        self.timeout = timeout
+        self.accept_compressed = accept_compressed
+
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._connections = weakref.WeakKeyDictionary()
 
     def addHTTPHeader(self, name, value):
         """
@@ -329,75 +1371,357 @@ class HTTPRemotingService(RemotingServiceBase):
         """
         del self.http_headers[name]
 
+    def addHeader(self, name, value, must_understand=False):
+        self._lock.acquire()
+        try:
+            RemotingServiceBase.addHeader(self, name, value, must_understand)
+        finally:
+            self._lock.release()
+
+    def callLater(self, delay, func, *args):
+        timer = threading.Timer(delay, func, args)
+        timer.setDaemon(True)
+        timer.start()
+        return timer
+
+    def close(self):
+        """
+        Closes the connections to the gateway. They are opened again by the
+        next calls.
+
+        """
+        self._lock.acquire()
+        try:
+            connections = self._connections.keys()
+        finally:
+            self._lock.release()
+        for connection in connections:
+            connection.close()
+
+    def addRequest(self, service, *args, **kwargs):
+        """
+        Adds a request to be sent to the remoting gateway.
+
+        :return: a :class:`CallResult` that receives the invocation result
+
+        """
+        self._lock.acquire()
+        try:
+            return RemotingServiceBase.addRequest(self, service, *args,
+                                                  **kwargs)
+        finally:
+            self._lock.release()
+
+    def removeRequest(self, result):
+        self._lock.acquire()
+        try:
+            RemotingServiceBase.removeRequest(self, result)
+        finally:
+            self._lock.release()
+
+    def _takeRequests(self):
+        self._lock.acquire()
+        try:
+            return RemotingServiceBase._takeRequests(self)
+        finally:
+            self._lock.release()
+
+    def _autoExecute(self, result):
+        """
+        Sends the pending requests, or schedules them, like
+        :meth:`RemotingServiceBase._autoExecute`, then waits for the result
+        of the call. Another thread may send the request with its own.
+
+        """
+        self._lock.acquire()
+        try:
+            # the result may have been shared with another call
+            ready = bool(self.requests) and self._batchReady()
+            if (self.requests and not ready and
+                self._batch_call is None):
+                self._batch_call = self.callLater(self.batch_window,
+                                                  self._executeBatch)
+        finally:
+            self._lock.release()
+
+        if ready:
+            self.execute()
+        return result.result()
+
+    def _createDeferred(self):
+        return CallResult()
+
+    def _fireResult(self, result, value):
+        result._setResult(value)
+
+    def _fireError(self, result, error):
+        result._setError(error)
+
+    def _isFired(self, result):
+        return result.done()
+
+    def _deliverResult(self, request, result):
+        # identical calls may share the result of the request
+        self._lock.acquire()
+        try:
+            RemotingServiceBase._deliverResult(self, request, result)
+        finally:
+            self._lock.release()
+
+    def _deliverError(self, request, error):
+        self._lock.acquire()
+        try:
+            RemotingServiceBase._deliverError(self, request, error)
+        finally:
+            self._lock.release()
+
     def execute(self):
+        """
+        Builds and sends an envelope with all the pending requests, and
+        waits for the responses. The result of each request is delivered to
+        its :class:`CallResult`.
+
+        """
+        requests = self._takeRequests()
+        if not requests:
+            return
+
+        # the response read by another thread may change the url
+        self._lock.acquire()
+        try:
+            url = self.url
+        finally:
+            self._lock.release()
+
         if self.logger:
-            self.logger.debug('Sending POST request to %s', self.url.geturl())
-            self.logger.debug('User-Agent: %s', self.user_agent)
-            for key, value in self.http_headers.iteritems():
-                self.logger.debug('%s: %s', key, value)
+            self.logger.debug('Sending POST request to %s', url.geturl())
+
+        pending = dict([(request.id, request) for request in requests])
+        try:
+            start = self.seconds()
+            body = ''.join(self._encodeAMFRequest(requests))
+            self._recordEnvelope(requests, self.seconds() - start)
+            self.metrics.observe('request_bytes', len(body))
+            idempotent = True
+            for request in requests:
+                idempotent = idempotent and request.idempotent
+            response = self._send(url, body, idempotent)
+            try:
+                self._handleHTTPResponse(response, pending)
+            finally:
+                if response.will_close or not response.isclosed():
+                    self._local.connection.close()
+        except Exception, e:
+            self.metrics.increment('envelope_errors')
+            self._handleAMFError(e, requests)
+
+    def _encodeAMFRequest(self, requests, deadline=None):
+        """
+        Like :meth:`RemotingServiceBase._encodeAMFRequest`, but the envelope
+        is built from a copy of the persistent headers, taken under the
+        lock, as the response read by another thread may change them.
 
-        # Make sure these requests won't get added to another batch
-        requests = self.requests
-        self.requests = []
-
-        port = self.url.port or 80
-        body = remoting.encode(self._createAMFRequest(requests),
-                                   strict=self.strict).getvalue()
-
-        factory = HTTPClientFactory(self.url.geturl(), 'POST', body,
-                                    self.http_headers, self.user_agent)
-        factory.deferred.addCallbacks(self._handleHTTPResponse,
-                                      self._handleHTTPError,
-                                      [factory],
-                                      errbackArgs=[factory])
-        factory.deferred.addCallback(remoting.decode, strict=self.strict)
-        factory.deferred.addCallbacks(self._handleAMFResponse,
-                                      self._handleAMFError,
-                                      [requests],
-                                      errbackArgs=[requests])
-        reactor.connectTCP(self.url.hostname, port, factory)
+        """
+        self._lock.acquire()
+        try:
+            envelope = self._createAMFRequest(requests, deadline)
+            if envelope.headers is self.headers:
+                headers = remoting.HeaderCollection()
+                headers.update(self.headers)
+                headers.required = list(self.headers.required)
+                envelope.headers = headers
+            encoded_headers = self._getEncodedHeaders()
+        finally:
+            self._lock.release()
+        return iter_encode(envelope, self.strict, encoded_headers)
+
+    def _getConnection(self, url):
+        """
+        Returns the connection of the calling thread to the gateway at
+        `url`.
+
+        :rtype: :class:`httplib.HTTPConnection`
+
+        """
+        key = (url.scheme, url.hostname, url.port)
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            if self._local.key == key:
+                return connection
+            connection.close()
+
+        if url.scheme == 'https':
+            factory = httplib.HTTPSConnection
+        else:
+            factory = httplib.HTTPConnection
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        connection = factory(url.hostname, url.port, **kwargs)
+
+        self._local.connection = connection
+        self._local.key = key
+        self._lock.acquire()
+        try:
+            self._connections[connection] = None
+        finally:
+            self._lock.release()
+        return connection
+
+    def _getRequestHeaders(self):
+        headers = {'User-Agent': self.user_agent}
+        if self.accept_compressed:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        headers.update(self.http_headers)
+        return headers
+
+    def _send(self, url, body, idempotent=False):
+        """
+        Sends the encoded envelope to `url`, and returns the response once
+        its headers have been read.
+
+        If a reused connection turns out to be closed, the envelope is sent
+        again on a new connection, unless the gateway may have received it
+        and some of its requests are not idempotent.
+
+        :param idempotent: whether all the requests of the envelope are
+            idempotent
+        :type idempotent: `bool`
+        :rtype: :class:`httplib.HTTPResponse`
+
+        """
+        path = url.path or '/'
+        if url.query:
+            path += '?' + url.query
+        headers = self._getRequestHeaders()
+
+        connection = self._getConnection(url)
+        if connection.sock is not None and self._isDropped(connection.sock):
+            connection.close()
+        # the socket of a connection that was used before is still open
+        reused = connection.sock is not None
+        written = False
+        try:
+            if not reused:
+                start = self.seconds()
+                connection.connect()
+                self.metrics.observe('connect', self.seconds() - start)
+            start = self.seconds()
+            connection.request('POST', path, body, headers)
+            written = True
+            response = connection.getresponse()
+            self.metrics.observe('first_byte', self.seconds() - start)
+            return response
+        except socket.timeout:
+            connection.close()
+            raise
+        except (httplib.BadStatusLine, socket.error):
+            connection.close()
+            if not reused or (written and not idempotent):
+                raise
+            # the gateway closed the connection while it was idle
+            if self.logger:
+                self.logger.debug('Reconnecting to %s', url.hostname)
+            connection.request('POST', path, body, headers)
+            return connection.getresponse()
 
     @staticmethod
-    def _getHTTPHeader(http_headers, key):
-        if key in http_headers:
-            return http_headers[key][0]
+    def _isDropped(sock):
+        """
+        Returns whether the gateway closed an idle connection. An idle
+        connection has nothing to read, unless it was closed.
+
+        """
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (select.error, socket.error, ValueError):
+            return True
 
-    def _handleHTTPResponse(self, response_body, factory):
+    def _handleHTTPResponse(self, response, pending):
         """
-        Handles the HTTP response from the remote gateway.
+        Reads the HTTP response from the remote gateway. The body is decoded
+        as it is read, and the result of each request is delivered as soon
+        as its response has been decoded.
 
+        :param pending: the requests that are not answered yet, by id
+        :type pending: `dict`
         :raise RemotingError: HTTP Gateway reported error status
         :raise RemotingError: Incorrect MIME type received
 
         """
-        response_headers = factory.response_headers
+        if not 200 <= response.status < 300:
+            # The body is read anyway, so that the connection can be reused
+            response.read()
+            raise remoting.RemotingError(
+                'HTTP Gateway reported status %s %s' %
+                (response.status, response.reason))
 
-        # Check content type
-        content_type = self._getHTTPHeader(response_headers, 'content-type')
+        content_type = response.getheader('content-type')
         if content_type != remoting.CONTENT_TYPE:
-            if self.logger:
-                self.logger.debug('Content-Type: %s', content_type)
+            response.read()
             raise remoting.RemotingError(
                 'Incorrect MIME type received. (got: %s)' % content_type)
 
-        if self.logger:
-            self.logger.debug('Content-Length: %s',
-                self._getHTTPHeader(response_headers, 'content-length'))
-            self.logger.debug('Server: %s',
-                self._getHTTPHeader(response_headers, 'server'))
-            self.logger.debug('Read %d bytes for the response',
-                              len(response_body))
-        return response_body
+        content_encoding = response.getheader('content-encoding')
+        if content_encoding in (None, 'identity'):
+            decompressor = None
+        elif content_encoding in ('gzip', 'x-gzip', 'deflate'):
+            decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        else:
+            response.read()
+            raise remoting.RemotingError(
+                'Unsupported Content-Encoding received. (got: %s)' %
+                content_encoding)
+
+        # the time spent in the callbacks of the decoder
+        dispatch_time = [0.0]
+
+        def body_received(request_id, message):
+            start = self.seconds()
+            self._dispatchResponse(pending, request_id, message)
+            dispatch_time[0] += self.seconds() - start
+
+        decoder = EnvelopeDecoder(self._handleAMFHeaders, body_received,
+                                  self.strict, self.logger)
+        size = 0
+        decode_time = 0.0
+        started = self.seconds()
+        while True:
+            data = response.read(self.read_size)
+            if not data:
+                break
+            size += len(data)
+            start = self.seconds()
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            decoder.feed(data)
+            decode_time += self.seconds() - start
+        start = self.seconds()
+        if decompressor is not None:
+            decoder.feed(decompressor.flush())
+        decoder.finish()
+        now = self.seconds()
+        decode_time += now - start
 
-    def _handleHTTPError(self, error, factory):
-        raise remoting.RemotingError('HTTP Gateway reported status %s %s' %
-                                     (factory.status, factory.message))
-
-    def _handleAMFResponse(self, response, requests):
-        if remoting.APPEND_TO_GATEWAY_URL in response.headers:
-            url_extension = response.headers[remoting.APPEND_TO_GATEWAY_URL]
-            self.url = urlparse(self.url.geturl() + url_extension)
-        elif remoting.REPLACE_GATEWAY_URL in response.headers:
-            new_url = response.headers[remoting.REPLACE_GATEWAY_URL]
-            self.url = urlparse(new_url)
-        RemotingServiceBase._handleAMFResponse(self, response, requests)
+        if self.logger:
+            self.logger.debug('Read %d bytes for the response', size)
+        metrics = self.metrics
+        metrics.observe('response_bytes', size)
+        metrics.observe('transfer', now - started)
+        metrics.observe('decode', decode_time - dispatch_time[0])
+        self._handleMissingResponses(pending)
+
+    def _handleAMFHeaders(self, envelope):
+        # other threads may be building envelopes
+        self._lock.acquire()
+        try:
+            if remoting.APPEND_TO_GATEWAY_URL in envelope.headers:
+                url_extension = envelope.headers[
+                    remoting.APPEND_TO_GATEWAY_URL]
+                self.url = urlparse(self.url.geturl() + url_extension)
+            elif remoting.REPLACE_GATEWAY_URL in envelope.headers:
+                new_url = envelope.headers[remoting.REPLACE_GATEWAY_URL]
+                self.url = urlparse(new_url)
+            RemotingServiceBase._handleAMFHeaders(self, envelope)
+        finally:
+            self._lock.release()
@@ -0,0 +1,282 @@
+# Copyright (c) The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+Static analysis of selector expressions.
+
+:func:`analyze` extracts the simple constraints on message headers that every
+selected message must satisfy. A message store can use them to narrow an
+index scan, and only has to evaluate the selector on the messages that the
+scan returns.
+
+For example, `region = 'EU' AND priority BETWEEN 3 AND 5` yields an
+:class:`Equals` constraint on `region` and a :class:`Range` constraint on
+`priority`.
+"""
+
+from plasma.flex.messaging.selector import nodes, parser
+
+
+class Constraint(object):
+    """
+    Base class for a constraint on a single header.
+
+    :ivar name: the name of the header
+    :type name: `str`
+    :ivar node: the expression node the constraint was extracted from
+    :type node: :class:`~plasma.flex.messaging.selector.nodes.Node`
+    """
+
+    def __init__(self, name, node=None):
+        self.name = name
+        self.node = node
+
+    def __eq__(self, other):
+        return (self.__class__ is other.__class__ and
+                self._key() == other._key())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((self.__class__, self._key()))
+
+    def _key(self):
+        return (self.name,)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            ' '.join([repr(x) for x in self._key()]))
+
+
+class Equals(Constraint):
+    """
+    The header must be equal to `value`.
+    """
+
+    def __init__(self, name, value, node=None):
+        Constraint.__init__(self, name, node)
+        self.value = value
+
+    def _key(self):
+        return (self.name, self.value)
+
+
+class OneOf(Constraint):
+    """
+    The header must be equal to one of `values`.
+
+    :ivar values: the allowed values, in the order of the expression
+    :type values: `tuple`
+    """
+
+    def __init__(self, name, values, node=None):
+        Constraint.__init__(self, name, node)
+        self.values = tuple(values)
+
+    def _key(self):
+        return (self.name, self.values)
+
+
+class Range(Constraint):
+    """
+    The header must be a number within the given bounds. A bound of `None`
+    means that the range is unbounded on that side.
+    """
+
+    def __init__(self, name, low=None, high=None, low_inclusive=True,
+                 high_inclusive=True, node=None):
+        Constraint.__init__(self, name, node)
+        self.low = low
+        self.high = high
+        self.low_inclusive = low_inclusive
+        self.high_inclusive = high_inclusive
+
+    def _key(self):
+        return (self.name, self.low, self.high, self.low_inclusive,
+                self.high_inclusive)
+
+    def contains(self, value):
+        """
+        Returns whether `value` lies within the range.
+        """
+        if self.low is not None:
+            if self.low_inclusive:
+                if value < self.low:
+                    return False
+            elif value <= self.low:
+                return False
+        if self.high is not None:
+            if self.high_inclusive:
+                return value <= self.high
+            return value < self.high
+        return True
+
+
+class Null(Constraint):
+    """
+    The header must not be set (`IS NULL`).
+    """
+
+
+class NotNull(Constraint):
+    """
+    The header must be set (`IS NOT NULL`).
+    """
+
+
+def _conjuncts(node):
+    """
+    Splits an expression tree on its top level `AND` operators.
+    """
+    if isinstance(node, nodes.Logical) and node.operator == 'AND':
+        return _conjuncts(node.left) + _conjuncts(node.right)
+    return [node]
+
+
+def _variable_and_literal(left, right):
+    if isinstance(left, nodes.Variable) and isinstance(right, nodes.Literal):
+        return left.name, right.value, False
+    if isinstance(left, nodes.Literal) and isinstance(right, nodes.Variable):
+        return right.name, left.value, True
+    return None
+
+
+def constraint(node):
+    """
+    Returns the constraint expressed by a single expression node, or `None`
+    if the node is not a simple constraint on a header.
+
+    :rtype: :class:`Constraint`
+    """
+    if isinstance(node, nodes.Equality) and node.operator == '=':
+        found = _variable_and_literal(node.left, node.right)
+        if found is not None:
+            return Equals(found[0], found[1], node)
+
+    elif isinstance(node, nodes.In) and not node.negated:
+        if not isinstance(node.operand, nodes.Variable):
+            return None
+        for item in node.items:
+            if not isinstance(item, nodes.Literal):
+                return None
+        return OneOf(node.operand.name, [x.value for x in node.items], node)
+
+    elif isinstance(node, nodes.Between) and not node.negated:
+        if (isinstance(node.operand, nodes.Variable) and
+            isinstance(node.low, nodes.Literal) and
+            isinstance(node.high, nodes.Literal)):
+            return Range(node.operand.name, node.low.value, node.high.value,
+                         node=node)
+
+    elif isinstance(node, nodes.Comparison):
+        found = _variable_and_literal(node.left, node.right)
+        if found is None or not isinstance(found[1], nodes.NUMBER_TYPES):
+            return None
+        name, value, swapped = found
+        operator = node.operator
+        if swapped:
+            # `3 < x` is the same as `x > 3`
+            operator = {'>': '<', '>=': '<=', '<': '>', '<=': '>='}[operator]
+        if operator == '>':
+            return Range(name, low=value, low_inclusive=False, node=node)
+        elif operator == '>=':
+            return Range(name, low=value, node=node)
+        elif operator == '<':
+            return Range(name, high=value, high_inclusive=False, node=node)
+        return Range(name, high=value, node=node)
+
+    elif isinstance(node, nodes.IsNull):
+        if node.negated:
+            return NotNull(node.name, node)
+        return Null(node.name, node)
+
+    return None
+
+
+class Analysis(object):
+    """
+    The result of analyzing a selector expression.
+
+    :ivar selector: the compiled selector
+    :type selector: :class:`~plasma.flex.messaging.selector.parser.Selector`
+    :ivar conjuncts: the operands of the top level `AND` operators of the
+        expression, in order. An expression without a top level `AND` has a
+        single conjunct.
+    :type conjuncts: `list`
+    :ivar constraints: the constraints extracted from the conjuncts. A message
+        can only be selected if it satisfies all of them.
+    :type constraints: `list` of :class:`Constraint`
+    :ivar residual: the conjuncts that are not simple constraints, combined
+        with `AND`, or `None` if every conjunct is a constraint.
+    :type residual: :class:`~plasma.flex.messaging.selector.nodes.Node`
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.conjuncts = _conjuncts(selector.tree)
+        self.constraints = []
+
+        rest = []
+        for node in self.conjuncts:
+            found = constraint(node)
+            if found is None:
+                rest.append(node)
+            else:
+                self.constraints.append(found)
+        self.residual = combine(rest)
+
+    def exact(self):
+        """
+        Returns whether the constraints describe the expression completely,
+        i.e. whether a message that satisfies all the constraints is always
+        selected.
+        """
+        return self.residual is None
+
+    def variables(self):
+        """
+        Returns the names of the constrained headers.
+
+        :rtype: `set`
+        """
+        return set([c.name for c in self.constraints])
+
+    def constraints_for(self, name):
+        """
+        Returns the constraints on the given header.
+
+        :rtype: `list`
+        """
+        return [c for c in self.constraints if c.name == name]
+
+
+def combine(conjuncts):
+    """
+    Combines expression nodes with `AND` operators.
+
+    :return: the combined node, or `None` if `conjuncts` is empty
+    """
+    result = None
+    for node in conjuncts:
+        if result is None:
+            result = node
+        else:
+            result = nodes.Logical('AND', result, node)
+    return result
+
+
+def analyze(expression):
+    """
+    Extracts the header constraints from a selector expression.
+
+    :param expression: a BlazeDS-compatible SQL92 boolean expression, or a
+        compiled selector
+    :type expression: `str` or
+        :class:`~plasma.flex.messaging.selector.parser.Selector`
+    :rtype: :class:`Analysis`
+    :raise ParseError: the expression could not be compiled
+    """
+    if not isinstance(expression, parser.Selector):
+        expression = parser.compile(expression)
+    return Analysis(expression)
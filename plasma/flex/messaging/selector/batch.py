@@ -0,0 +1,510 @@
+# Copyright (c) The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+Column-wise evaluation of compiled selectors.
+
+Instead of evaluating an expression once per message, the expression tree is
+walked once and every operator is applied to whole columns of header values.
+This is much faster when a single selector has to be checked against a large
+number of stored messages.
+
+Columns can be lists (or any other sequence) or, when NumPy_ is available,
+NumPy arrays. When all the columns used by an expression are NumPy arrays of
+a non-object type, the operators are evaluated with NumPy. Otherwise the
+columns are evaluated as lists.
+
+In list columns `None` marks a message that does not have the header.
+
+The messages are selected as if the expression was evaluated for each of
+them with :meth:`Selector.evaluate
+<plasma.flex.messaging.selector.parser.Selector.evaluate>`. Messages for
+which it fails, because a header is missing or has the wrong type, or a
+divisor is zero, are not selected, just as :meth:`SelectorIndex.match
+<plasma.flex.messaging.selector.index.SelectorIndex.match>` skips them. As
+in :meth:`Selector.evaluate
+<plasma.flex.messaging.selector.parser.Selector.evaluate>`, the right operand
+of `AND` and `OR`, and the remaining items of `IN`, only count when the
+result is not decided yet.
+
+.. _NumPy: http://numpy.scipy.org
+"""
+
+import operator
+from itertools import izip
+
+from plasma.flex.messaging.selector import UnknownVariableError
+from plasma.flex.messaging.selector.nodes import NUMBER_TYPES
+from plasma.flex.messaging.selector.matcher import compile_pattern
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#: marks a row for which the expression can not be evaluated
+_ERROR = object()
+
+_ARITHMETIC = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.div,
+}
+
+_COMPARISONS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+
+def _variable_names(node, names):
+    if hasattr(node, 'name'):
+        names.add(node.name)
+    for child in node.children():
+        _variable_names(child, names)
+    return names
+
+
+def evaluate_columns(tree, columns, size=None):
+    """
+    Evaluates an expression tree against columns of header values.
+
+    :param tree: the root node of a compiled expression
+    :type tree: :class:`~plasma.flex.messaging.selector.nodes.Node`
+    :param columns: a mapping of variable names to columns of values. All
+        columns must have the same length.
+    :type columns: `dict`
+    :param size: the number of messages. Only required if there are no
+        columns.
+    :type size: `int`
+    :return: a mask with a `True` value for every selected message. The mask
+        is a NumPy array if the expression was evaluated with NumPy, a `list`
+        otherwise.
+    :raise ValueError: The columns do not have the same length.
+    """
+    used = {}
+    for name in _variable_names(tree, set()):
+        if name in columns:
+            used[name] = columns[name]
+
+    for column in columns.itervalues():
+        if size is None:
+            size = len(column)
+        elif len(column) != size:
+            raise ValueError('All columns must have the same length')
+    if size is None:
+        size = 0
+
+    if numpy is not None and used:
+        arrays = _as_arrays(used)
+        if arrays is not None:
+            return _ArrayEvaluator(arrays, size).mask(tree)
+
+    lists = {}
+    for name, column in used.iteritems():
+        if numpy is not None and isinstance(column, numpy.ndarray):
+            column = column.tolist()
+        lists[name] = column
+    return _ListEvaluator(lists, size).mask(tree)
+
+
+def _as_arrays(columns):
+    """
+    Returns the columns as NumPy arrays, or `None` if they can not all be
+    evaluated with NumPy.
+    """
+    found = False
+    arrays = {}
+    for name, column in columns.iteritems():
+        if isinstance(column, numpy.ndarray):
+            found = True
+        else:
+            column = numpy.asarray(column)
+        if column.dtype.kind == 'O' or column.ndim != 1:
+            return None
+        arrays[name] = column
+
+    if not found:
+        return None
+    return arrays
+
+
+class _Evaluator(object):
+    """
+    Walks an expression tree, dispatching to a `visit_<NodeClass>` method
+    for every node.
+    """
+
+    def __init__(self, columns, size):
+        self.columns = columns
+        self.size = size
+
+    def visit(self, node):
+        return getattr(self, 'visit_' + node.__class__.__name__)(node)
+
+    def column(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise UnknownVariableError('Undefined variable: %s' % name)
+
+
+class _ListEvaluator(_Evaluator):
+    """
+    Evaluates expressions on lists of values, with `_ERROR` marking the rows
+    for which the expression can not be evaluated.
+
+    :ivar failed: whether any row has been marked with `_ERROR`
+    """
+
+    failed = False
+
+    def mask(self, tree):
+        return [value is True for value in self.visit(tree)]
+
+    def valid(self, values, types):
+        for value in values:
+            if not isinstance(value, types):
+                return False
+        return True
+
+    def apply(self, operation, types, *columns):
+        """
+        Applies `operation` row by row. A row with an operand that is not of
+        one of `types`, or for which `operation` fails, is an error.
+        """
+        result = []
+        for row in izip(*columns):
+            value = _ERROR
+            for operand in row:
+                if operand is _ERROR or not isinstance(operand, types):
+                    break
+            else:
+                try:
+                    value = operation(*row)
+                except ZeroDivisionError:
+                    pass
+            if value is _ERROR:
+                self.failed = True
+            result.append(value)
+        return result
+
+    def visit_Literal(self, node):
+        return [node.value] * self.size
+
+    def visit_Variable(self, node):
+        # a message without the header can not be evaluated, as
+        # Variable.evaluate raises
+        column = self.column(node.name)
+        for value in column:
+            if value is None:
+                self.failed = True
+                return [_ERROR if value is None else value
+                        for value in column]
+        return column
+
+    def visit_IsNull(self, node):
+        if node.name not in self.columns:
+            return [not node.negated] * self.size
+        if node.negated:
+            return [value is not None for value in self.columns[node.name]]
+        return [value is None for value in self.columns[node.name]]
+
+    def visit_Equality(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if self.failed:
+            if node.operator == '=':
+                return self.apply(operator.eq, object, left, right)
+            return self.apply(operator.ne, object, left, right)
+        if node.operator == '=':
+            return [a == b for a, b in izip(left, right)]
+        return [a != b for a, b in izip(left, right)]
+
+    def visit_Logical(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if not (self.valid(left, bool) and self.valid(right, bool)):
+            return self.decide(node.operator != 'AND', left, right)
+        if node.operator == 'AND':
+            return [a and b for a, b in izip(left, right)]
+        return [a or b for a, b in izip(left, right)]
+
+    def decide(self, decided, left, right):
+        """
+        Evaluates `AND` (`decided` is `False`) or `OR` (`decided` is `True`)
+        row by row. As the right operand is not evaluated when the left one
+        decides the result, only then does an error in it count.
+        """
+        result = []
+        for a, b in izip(left, right):
+            if not isinstance(a, bool):
+                result.append(_ERROR)
+            elif a is decided:
+                result.append(decided)
+            elif not isinstance(b, bool):
+                result.append(_ERROR)
+            else:
+                result.append(b)
+        self.failed = self.failed or _ERROR in result
+        return result
+
+    def visit_Arithmetic(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if not (self.valid(left, NUMBER_TYPES) and
+                self.valid(right, NUMBER_TYPES)):
+            return self.apply(_ARITHMETIC[node.operator], NUMBER_TYPES,
+                              left, right)
+        pairs = izip(left, right)
+        if node.operator == '+':
+            return [a + b for a, b in pairs]
+        elif node.operator == '-':
+            return [a - b for a, b in pairs]
+        elif node.operator == '*':
+            return [a * b for a, b in pairs]
+        try:
+            return [a / b for a, b in pairs]
+        except ZeroDivisionError:
+            return self.apply(operator.div, NUMBER_TYPES, left, right)
+
+    def visit_Comparison(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if not (self.valid(left, NUMBER_TYPES) and
+                self.valid(right, NUMBER_TYPES)):
+            return self.apply(_COMPARISONS[node.operator], NUMBER_TYPES,
+                              left, right)
+        pairs = izip(left, right)
+        if node.operator == '>':
+            return [a > b for a, b in pairs]
+        elif node.operator == '>=':
+            return [a >= b for a, b in pairs]
+        elif node.operator == '<':
+            return [a < b for a, b in pairs]
+        return [a <= b for a, b in pairs]
+
+    def visit_Negation(self, node):
+        values = self.visit(node.operand)
+        if not self.valid(values, NUMBER_TYPES):
+            return self.apply(operator.neg, NUMBER_TYPES, values)
+        return [-value for value in values]
+
+    def visit_Between(self, node):
+        values = self.visit(node.operand)
+        lows = self.visit(node.low)
+        highs = self.visit(node.high)
+        if node.negated:
+            between = lambda value, low, high: value < low or value > high
+        else:
+            between = lambda value, low, high: value >= low and value <= high
+        return self.apply(between, NUMBER_TYPES, values, lows, highs)
+
+    def visit_In(self, node):
+        values = self.visit(node.operand)
+        items = [self.visit(item) for item in node.items]
+        result = []
+        for row in izip(values, *items):
+            value = row[0]
+            if value is _ERROR:
+                result.append(_ERROR)
+                continue
+            # the items are compared in order, until one is equal
+            found = node.negated
+            for item in row[1:]:
+                if item is _ERROR:
+                    found = _ERROR
+                    break
+                if item == value:
+                    found = not node.negated
+                    break
+            result.append(found)
+        self.failed = self.failed or _ERROR in result
+        return result
+
+    def visit_Like(self, node):
+        values = self.visit(node.operand)
+        patterns = self.visit(node.pattern)
+        compiled = node.compiled
+
+        def like(value, pattern):
+            if compiled is None:
+                matches = compile_pattern(pattern, node.escapechar).matches
+            else:
+                matches = compiled.matches
+            return matches(value) != node.negated
+
+        return self.apply(like, basestring, values, patterns)
+
+
+class _ArrayEvaluator(_Evaluator):
+    """
+    Evaluates expressions on NumPy arrays. Literals are kept as scalars and
+    broadcast by NumPy.
+
+    :ivar errors: a mask of the rows for which the expression visited so far
+        can not be evaluated
+    """
+
+    def __init__(self, columns, size):
+        _Evaluator.__init__(self, columns, size)
+        self.errors = numpy.zeros(size, dtype=bool)
+
+    def mask(self, tree):
+        result = self.visit(tree)
+        if numpy.ndim(result) == 0:
+            result = numpy.repeat(result is True or result is numpy.True_,
+                                  self.size)
+        elif result.dtype.kind != 'b':
+            return numpy.zeros(self.size, dtype=bool)
+        return result & ~self.errors
+
+    def broadcast(self, result):
+        if numpy.ndim(result) == 0:
+            return numpy.repeat(bool(result), self.size)
+        return result
+
+    def kind(self, value):
+        if numpy.ndim(value) == 0:
+            if isinstance(value, (bool, numpy.bool_)):
+                return 'b'
+            if isinstance(value, NUMBER_TYPES + (numpy.number,)):
+                return 'f'
+            if isinstance(value, basestring):
+                return 'S'
+            return 'O'
+        return value.dtype.kind
+
+    def check(self, value, kinds):
+        """
+        Returns whether `value` is of one of `kinds`. If not, none of the
+        rows can be evaluated.
+        """
+        if self.kind(value) in kinds:
+            return True
+        self.errors[:] = True
+        return False
+
+    def invalid(self):
+        return numpy.zeros(self.size, dtype=bool)
+
+    def visit_Literal(self, node):
+        return node.value
+
+    def visit_Variable(self, node):
+        return self.column(node.name)
+
+    def visit_IsNull(self, node):
+        # arrays can not hold nulls
+        isnull = node.name not in self.columns
+        return numpy.repeat(isnull != node.negated, self.size)
+
+    def visit_Equality(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if node.operator == '=':
+            return self.broadcast(left == right)
+        return self.broadcast(left != right)
+
+    def visit_Logical(self, node):
+        errors = self.errors
+        self.errors = numpy.zeros(self.size, dtype=bool)
+        left = self.visit(node.left)
+        if not self.check(left, 'b'):
+            left = self.invalid()
+        left_errors = self.errors
+        self.errors = numpy.zeros(self.size, dtype=bool)
+        right = self.visit(node.right)
+        if not self.check(right, 'b'):
+            right = self.invalid()
+        left = self.broadcast(left)
+        # errors of the right operand only count for the rows that the left
+        # operand does not decide, as it is not evaluated otherwise
+        if node.operator == 'AND':
+            self.errors = errors | left_errors | (left & self.errors)
+            return self.broadcast(numpy.logical_and(left, right))
+        self.errors = errors | left_errors | (~left & self.errors)
+        return self.broadcast(numpy.logical_or(left, right))
+
+    def visit_Arithmetic(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if not (self.check(left, 'biuf') and self.check(right, 'biuf')):
+            return self.invalid()
+        if node.operator == '+':
+            return left + right
+        elif node.operator == '-':
+            return left - right
+        elif node.operator == '*':
+            return left * right
+        zero = numpy.asarray(right) == 0
+        if numpy.any(zero):
+            self.errors |= zero
+            right = numpy.where(zero, 1, right)
+        return left / right
+
+    def visit_Comparison(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if not (self.check(left, 'biuf') and self.check(right, 'biuf')):
+            return self.invalid()
+        if node.operator == '>':
+            return left > right
+        elif node.operator == '>=':
+            return left >= right
+        elif node.operator == '<':
+            return left < right
+        return left <= right
+
+    def visit_Negation(self, node):
+        value = self.visit(node.operand)
+        if not self.check(value, 'biuf'):
+            return self.invalid()
+        if self.kind(value) == 'b':
+            value = numpy.asarray(value, dtype=int)
+        return -value
+
+    def visit_Between(self, node):
+        value = self.visit(node.operand)
+        low = self.visit(node.low)
+        high = self.visit(node.high)
+        for operand in (value, low, high):
+            if not self.check(operand, 'biuf'):
+                return self.invalid()
+        if node.negated:
+            return self.broadcast((value < low) | (value > high))
+        return self.broadcast((value >= low) & (value <= high))
+
+    def visit_In(self, node):
+        value = self.visit(node.operand)
+        result = numpy.zeros(self.size, dtype=bool)
+        for item in node.items:
+            result |= self.broadcast(value == self.visit(item))
+        if node.negated:
+            return ~result
+        return result
+
+    def visit_Like(self, node):
+        values = self.visit(node.operand)
+        patterns = self.visit(node.pattern)
+        if not (self.check(values, 'SU') and self.check(patterns, 'SU')):
+            return self.invalid()
+        values = numpy.broadcast_to(values, (self.size,))
+        if node.compiled is not None:
+            matches = node.compiled.matches
+            result = numpy.fromiter([matches(value) for value in values],
+                                    dtype=bool, count=self.size)
+        else:
+            patterns = numpy.broadcast_to(patterns, (self.size,))
+            escapechar = node.escapechar
+            result = numpy.fromiter(
+                [compile_pattern(pattern, escapechar).matches(value)
+                 for value, pattern in izip(values, patterns)],
+                dtype=bool, count=self.size)
+        if node.negated:
+            return ~result
+        return result
@@ -0,0 +1,26 @@
+# Copyright (c) The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+Caching of compiled selector expressions.
+"""
+
+from plasma.util import LRUCache
+
+
+class SelectorCache(LRUCache):
+    """
+    A bounded, thread-safe mapping of expression text to compiled selectors.
+    When the cache is full, the least recently used entry is evicted.
+
+    :ivar maxsize: the maximum number of entries to keep. `0` disables
+        caching.
+    :type maxsize: `int`
+    :ivar hits: number of lookups that found a cached selector
+    :type hits: `int`
+    :ivar misses: number of lookups that did not find a cached selector
+    :type misses: `int`
+    """
+
+    def __init__(self, maxsize=256):
+        LRUCache.__init__(self, maxsize)
@@ -0,0 +1,256 @@
+# Copyright (c) The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+Matching a message against many selectors at once.
+
+Most selectors used by subscriptions are conjunctions that contain at least
+one simple constraint on a header, e.g. `region = 'EU' AND priority > 3`.
+:class:`SelectorIndex` indexes subscriptions by such a constraint, so that
+routing a message only has to evaluate the remainder of the expressions for
+the subscriptions whose indexed constraint matched.
+"""
+
+import bisect
+
+from plasma.flex.messaging.selector import ParseError, nodes, parser
+from plasma.flex.messaging.selector.analysis import (analyze, combine,
+    Equals, OneOf, Range)
+
+_NEG_INF = float('-inf')
+_POS_INF = float('inf')
+
+
+def _selectivity(constraint):
+    """
+    Returns a sort key for choosing the constraint to index a subscription
+    by. Equalities are more selective than ranges, and fewer values are more
+    selective than many.
+    """
+    if isinstance(constraint, Equals):
+        return (0, 1)
+    if isinstance(constraint, OneOf):
+        return (0, len(constraint.values))
+    return (1, 0)
+
+
+class _Subscription(object):
+    """
+    Bookkeeping for a single subscription in a :class:`SelectorIndex`.
+
+    :ivar selector: the compiled selector
+    :ivar constraint: the indexed constraint, or `None`
+    :type constraint: :class:`~plasma.flex.messaging.selector.analysis.Constraint`
+    :ivar residual: the part of the expression that is not covered by the
+        indexed constraint, or `None` if the constraint is the whole
+        expression
+    :ivar range_entry: the entry of this subscription in the range index
+    """
+
+    def __init__(self, selector, constraint, residual):
+        self.selector = selector
+        self.constraint = constraint
+        self.residual = residual
+        self.range_entry = None
+
+
+class SelectorIndex(object):
+    """
+    Matches a set of message headers against the selectors of many
+    subscriptions at once.
+
+    For each subscription, one constraint of the top level conjunction (see
+    :mod:`~plasma.flex.messaging.selector.analysis`) is indexed: equality
+    with a literal, `IN` with a list of literals, or a numeric range from
+    `BETWEEN`, `>`, `>=`, `<` and `<=`. Only the subscriptions whose indexed
+    constraint matches the headers have the rest of their expression
+    evaluated. Subscriptions without an indexable constraint are always
+    evaluated in full.
+
+    A subscription matches when its selector evaluates to `True`. Selectors
+    that fail to evaluate for a set of headers (e.g. because of a missing
+    header or operands of the wrong type) do not match.
+    """
+
+    def __init__(self):
+        self._subscriptions = {}
+        # name -> {value: set of subscription ids}
+        self._equalities = {}
+        # name -> sorted list of (low, serial, subscription id, constraint)
+        self._ranges = {}
+        # ranges without a lower bound:
+        # name -> sorted list of (high, serial, subscription id, constraint)
+        self._upper_ranges = {}
+        self._unindexed = set()
+        self._serial = 0
+
+    def add(self, subscription_id, expression):
+        """
+        Adds (or replaces) the selector of a subscription.
+
+        :param subscription_id: a hashable identifier for the subscription
+        :param expression: a BlazeDS-compatible SQL92 boolean expression
+        :type expression: `str`
+        :raise ParseError: the expression could not be compiled
+        """
+        selector = parser.compile(expression)
+
+        if subscription_id in self._subscriptions:
+            self.remove(subscription_id)
+
+        analysis = analyze(selector)
+        best = None
+        for constraint in analysis.constraints:
+            if not isinstance(constraint, (Equals, OneOf, Range)):
+                continue
+            if best is None or _selectivity(constraint) < _selectivity(best):
+                best = constraint
+
+        if best is None:
+            subscription = _Subscription(selector, None, selector.tree)
+            self._unindexed.add(subscription_id)
+        else:
+            residual = combine([node for node in analysis.conjuncts
+                                if node is not best.node])
+            subscription = _Subscription(selector, best, residual)
+            self._insert(subscription_id, subscription)
+
+        self._subscriptions[subscription_id] = subscription
+
+    def remove(self, subscription_id):
+        """
+        Removes a subscription from the index.
+
+        :raise LookupError: Subscription not found.
+        """
+        try:
+            subscription = self._subscriptions.pop(subscription_id)
+        except KeyError:
+            raise LookupError('Subscription not found')
+
+        constraint = subscription.constraint
+        if constraint is None:
+            self._unindexed.discard(subscription_id)
+        elif isinstance(constraint, Range):
+            if constraint.low is None:
+                index = self._upper_ranges
+            else:
+                index = self._ranges
+            ranges = index[constraint.name]
+            ranges.remove(subscription.range_entry)
+            if not ranges:
+                del index[constraint.name]
+        else:
+            values = self._equalities[constraint.name]
+            for value in self._values(constraint):
+                ids = values.get(value)
+                if ids is None:
+                    continue
+                ids.discard(subscription_id)
+                if not ids:
+                    del values[value]
+            if not values:
+                del self._equalities[constraint.name]
+
+    def match(self, variables):
+        """
+        Returns the ids of all subscriptions whose selector matches the given
+        variables.
+
+        :param variables: a dictionary of variables (message headers) and
+            their values
+        :type variables: `dict`
+        :rtype: `set`
+        """
+        candidates = set()
+
+        for name, values in self._equalities.iteritems():
+            if name not in variables:
+                continue
+            try:
+                ids = values.get(variables[name])
+            except TypeError:
+                # unhashable values never equal a literal
+                continue
+            if ids:
+                candidates.update(ids)
+
+        for name, ranges in self._ranges.iteritems():
+            if name not in variables:
+                continue
+            value = variables[name]
+            if not isinstance(value, nodes.NUMBER_TYPES):
+                continue
+            # only the ranges that start at or below the value can match
+            end = bisect.bisect_right(ranges, (value, _POS_INF))
+            for i in xrange(end):
+                constraint = ranges[i][3]
+                if constraint.contains(value):
+                    candidates.add(ranges[i][2])
+
+        for name, ranges in self._upper_ranges.iteritems():
+            if name not in variables:
+                continue
+            value = variables[name]
+            if not isinstance(value, nodes.NUMBER_TYPES):
+                continue
+            # only the ranges that end at or above the value can match
+            for i in xrange(bisect.bisect_left(ranges, (value, _NEG_INF)),
+                            len(ranges)):
+                constraint = ranges[i][3]
+                if constraint.contains(value):
+                    candidates.add(ranges[i][2])
+
+        matched = set()
+        subscriptions = self._subscriptions
+        for subscription_id in candidates:
+            residual = subscriptions[subscription_id].residual
+            if residual is None or self._evaluate(residual, variables):
+                matched.add(subscription_id)
+
+        for subscription_id in self._unindexed:
+            if self._evaluate(subscriptions[subscription_id].residual,
+                              variables):
+                matched.add(subscription_id)
+
+        return matched
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def __contains__(self, subscription_id):
+        return subscription_id in self._subscriptions
+
+    @staticmethod
+    def _evaluate(tree, variables):
+        try:
+            return tree.evaluate(variables) is True
+        except (ParseError, ZeroDivisionError):
+            return False
+
+    @staticmethod
+    def _values(constraint):
+        if isinstance(constraint, Equals):
+            return [constraint.value]
+        return constraint.values
+
+    def _insert(self, subscription_id, subscription):
+        constraint = subscription.constraint
+        if isinstance(constraint, Range):
+            self._serial += 1
+            if constraint.low is None:
+                high = constraint.high
+                if high is None:
+                    high = _POS_INF
+                entry = (high, self._serial, subscription_id, constraint)
+                index = self._upper_ranges
+            else:
+                entry = (constraint.low, self._serial, subscription_id,
+                         constraint)
+                index = self._ranges
+            subscription.range_entry = entry
+            bisect.insort(index.setdefault(constraint.name, []), entry)
+        else:
+            values = self._equalities.setdefault(constraint.name, {})
+            for value in self._values(constraint):
+                values.setdefault(value, set()).add(subscription_id)
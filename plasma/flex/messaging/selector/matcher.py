@@ -3,52 +3,163 @@
 
 """
 This module contains pattern matching code for the LIKE expression.
+
+Patterns are tokenized once and compiled into a :class:`Pattern`. The common
+shapes `'abc'`, `'abc%'`, `'%abc'` and `'%abc%'` are matched with plain string
+operations, other patterns are translated to an anchored regular expression.
 """
 
+import re
+
+from plasma.util import LRUCache
+
+_TOKEN_TEXT = 0        # match a segment of text exactly
 _TOKEN_ANYCHAR = 1     # match any single character
 _TOKEN_ANYRANGE = 2    # match any number of characters
 
-class Matcher(object):
-    def __init__(self, source, pattern, escapechar):
-        self.srcpos = 0
-        self.srclen = len(source)
-        self.patternpos = 0
-        self.patternlen = len(pattern)
-        self.source = source
+#: Maximum number of compiled patterns to keep in the cache
+MAX_CACHED_PATTERNS = 512
+
+_cache = LRUCache(MAX_CACHED_PATTERNS)
+
+
+def _tokenize(pattern, escapechar):
+    """
+    Splits a LIKE pattern into text segments and wildcard tokens.
+
+    An escape character that does not precede a wildcard is kept as part of
+    the text. Consecutive `%` wildcards are collapsed into one.
+    """
+    tokens = []
+    buffer = []
+    escape = False
+
+    for char in pattern:
+        if char in (u'_', u'%'):
+            if not escape:
+                if buffer:
+                    tokens.append(u''.join(buffer))
+                    buffer = []
+                if char == u'_':
+                    tokens.append(_TOKEN_ANYCHAR)
+                elif not tokens or tokens[-1] != _TOKEN_ANYRANGE:
+                    tokens.append(_TOKEN_ANYRANGE)
+                continue
+            escape = False
+
+        # Insert escape character if nothing was escaped
+        if escape:
+            buffer.append(escapechar)
+            escape = False
+
+        if char == escapechar:
+            escape = True
+        else:
+            buffer.append(char)
+
+    # Insert escape character if nothing was escaped
+    if escape:
+        buffer.append(escapechar)
+    if buffer:
+        tokens.append(u''.join(buffer))
+
+    return tokens
+
+
+class Pattern(object):
+    """
+    A compiled LIKE pattern.
+
+    :ivar pattern: the source pattern
+    :ivar escapechar: the escape character of the pattern
+    """
+
+    def __init__(self, pattern, escapechar):
         self.pattern = pattern
         self.escapechar = escapechar
 
-    def nexttoken(self):
-        escape = False
-        buffer = u''
-        while self.patternpos < self.patternlen:
-            char = self.pattern[self.patternpos]
-            if char in (u'_', u'%'):
-                if not escape:
-                    if buffer:
-                        return buffer
-                    self.patternpos += 1
-                    if char == u'_':
-                        return _TOKEN_ANYCHAR
-                    return _TOKEN_ANYRANGE
-                escape = False
-
-            # Insert escape character if nothing was escaped
-            if escape:
-                buffer += self.escapechar
-                escape = False
-
-            if char == self.escapechar:
-                escape = True
+        tokens = _tokenize(pattern, escapechar)
+        texts = []
+        shape = []
+        for token in tokens:
+            if isinstance(token, basestring):
+                texts.append(token)
+                shape.append(_TOKEN_TEXT)
             else:
-                buffer += char
-            self.patternpos += 1
+                shape.append(token)
 
-        # Insert escape character if nothing was escaped
-        if escape:
-            buffer += self.escapechar
+        if shape == []:
+            self._match = lambda source: source == u''
+        elif shape == [_TOKEN_TEXT]:
+            text = texts[0]
+            self._match = lambda source: source == text
+        elif shape == [_TOKEN_ANYRANGE]:
+            self._match = lambda source: True
+        elif shape == [_TOKEN_TEXT, _TOKEN_ANYRANGE]:
+            text = texts[0]
+            self._match = lambda source: source.startswith(text)
+        elif shape == [_TOKEN_ANYRANGE, _TOKEN_TEXT]:
+            text = texts[0]
+            self._match = lambda source: source.endswith(text)
+        elif shape == [_TOKEN_ANYRANGE, _TOKEN_TEXT, _TOKEN_ANYRANGE]:
+            text = texts[0]
+            self._match = lambda source: text in source
+        elif shape == [_TOKEN_ANYCHAR] * len(shape):
+            length = len(shape)
+            self._match = lambda source: len(source) == length
+        else:
+            regex = []
+            for token in tokens:
+                if token == _TOKEN_ANYCHAR:
+                    regex.append(u'.')
+                elif token == _TOKEN_ANYRANGE:
+                    regex.append(u'.*')
+                else:
+                    regex.append(re.escape(token))
+            regex.append(r'\Z')
+            match = re.compile(u''.join(regex), re.DOTALL).match
+            self._match = lambda source: match(source) is not None
+
+    def matches(self, source):
+        """
+        Matches `source` against the pattern.
+
+        :return: `True` if all of `source` matched the pattern, `False`
+                 otherwise
+        """
+        return self._match(source)
+
+    def __repr__(self):
+        return '<Pattern %r escape %r>' % (self.pattern, self.escapechar)
+
+
+def compile_pattern(pattern, escapechar=u'\\'):
+    """
+    Returns the compiled form of a LIKE pattern. The most recently used
+    compiled patterns are cached.
 
-        return buffer
+    :rtype: :class:`Pattern`
+    """
+    key = (pattern, escapechar)
+    compiled = _cache.get(key)
+    if compiled is None:
+        compiled = Pattern(pattern, escapechar)
+        _cache.put(key, compiled)
+    return compiled
+
+
+class Matcher(object):
+    """
+    Matches a single source string against a LIKE pattern.
+
+    .. seealso:: :func:`compile_pattern` for matching many strings against
+       the same pattern.
+    """
+
+    def __init__(self, source, pattern, escapechar):
+        self.source = source
+        self.pattern = pattern
+        self.escapechar = escapechar
 
     def matches(self):
         """
@@ -57,29 +168,5 @@ class Matcher(object):
         :return: `True` if all of `source` matched the `pattern`,
                  `False` otherwise
         """
-        token = self.nexttoken()
-        while token and self.srcpos <= self.srclen:
-            if token == _TOKEN_ANYCHAR:
-                # Match any character
-                self.srcpos += 1
-                token = self.nexttoken()
-            elif token == _TOKEN_ANYRANGE:
-                token = self.nexttoken()
-                if not token:
-                    # Anything that is left in the source is matched
-                    return True
-                elif isinstance(token, basestring):
-                    # Match everything up to the next segment of text
-                    pos = self.source.find(token, self.srcpos)
-                    if pos == -1:
-                        return False
-                    self.srcpos += (pos - self.srcpos)
-            else:
-                # Got a text segment -- match it exactly with the source
-                length = len(token)
-                if self.source[self.srcpos:self.srcpos + length] != token:
-                    return False
-                self.srcpos += length
-                token = self.nexttoken()
-
-        return self.srcpos == self.srclen
+        return compile_pattern(self.pattern, self.escapechar).matches(
+            self.source)
@@ -0,0 +1,304 @@
+# Copyright (c) The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+Expression tree for compiled selectors.
+
+The grammar in :mod:`~plasma.flex.messaging.selector.sql92grammar` builds a
+tree of these nodes once per expression. The tree can then be evaluated any
+number of times against different sets of variables.
+"""
+
+from plasma.flex.messaging.selector import (IncompatibleTypeError,
+    UnknownVariableError)
+from plasma.flex.messaging.selector.matcher import compile_pattern
+
+NUMBER_TYPES = (int, long, float)
+
+
+class Node(object):
+    """
+    Base class for all selector expression nodes.
+    """
+
+    def evaluate(self, variables):
+        """
+        Evaluates this node using the given variables.
+
+        :param variables: a mapping of variable names to values
+        :type variables: `dict`
+        :return: the value of the expression
+        """
+        raise NotImplementedError
+
+    def children(self):
+        """
+        Returns the direct child nodes of this node.
+
+        :rtype: `tuple`
+        """
+        return ()
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__,
+                            ' '.join([repr(x) for x in self.children()]))
+
+
+class Literal(Node):
+    """
+    A number, boolean or string constant.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, variables):
+        return self.value
+
+    def __repr__(self):
+        return '<Literal %r>' % (self.value,)
+
+
+class Variable(Node):
+    """
+    A reference to a variable (a message header).
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def evaluate(self, variables):
+        try:
+            return variables[self.name]
+        except KeyError:
+            raise UnknownVariableError('Undefined variable: %s' % self.name)
+
+    def __repr__(self):
+        return '<Variable %s>' % (self.name,)
+
+
+class IsNull(Node):
+    """
+    `IS NULL` and `IS NOT NULL` checks.
+    """
+
+    def __init__(self, name, negated=False):
+        self.name = name
+        self.negated = negated
+
+    def evaluate(self, variables):
+        if self.negated:
+            return self.name in variables
+        return self.name not in variables
+
+    def __repr__(self):
+        return '<IsNull %s negated=%r>' % (self.name, self.negated)
+
+
+class BinaryOperator(Node):
+    """
+    Base class for operators with a left and a right operand.
+    """
+
+    def __init__(self, operator, left, right):
+        self.operator = operator
+        self.left = left
+        self.right = right
+
+    def children(self):
+        return (self.left, self.right)
+
+    def __repr__(self):
+        return '<%s %r %s %r>' % (self.__class__.__name__, self.left,
+                                  self.operator, self.right)
+
+
+class Equality(BinaryOperator):
+    """
+    `=` and `<>` operators.
+    """
+
+    def evaluate(self, variables):
+        left = self.left.evaluate(variables)
+        right = self.right.evaluate(variables)
+        if self.operator == '=':
+            return left == right
+        return left != right
+
+
+class Logical(BinaryOperator):
+    """
+    `AND` and `OR` operators.
+
+    The right operand is only evaluated if the left operand does not decide
+    the result.
+    """
+
+    def evaluate(self, variables):
+        left = self.left.evaluate(variables)
+        if not isinstance(left, bool):
+            raise IncompatibleTypeError(
+                u'%s requires boolean operands; got %s' %
+                (self.operator, type(left)))
+        if self.operator == 'AND':
+            if not left:
+                return False
+        elif left:
+            return True
+
+        right = self.right.evaluate(variables)
+        if not isinstance(right, bool):
+            raise IncompatibleTypeError(
+                u'%s requires boolean operands; got %s and %s' %
+                (self.operator, type(left), type(right)))
+        return right
+
+
+class Arithmetic(BinaryOperator):
+    """
+    `+`, `-`, `*` and `/` operators.
+    """
+
+    def evaluate(self, variables):
+        left = self.left.evaluate(variables)
+        right = self.right.evaluate(variables)
+        if (not isinstance(left, NUMBER_TYPES) or
+            not isinstance(right, NUMBER_TYPES)):
+            raise IncompatibleTypeError(
+                '%s requires numeric operands; got %s and %s' %
+                (self.operator, type(left), type(right)))
+        if self.operator == '+':
+            return left + right
+        elif self.operator == '-':
+            return left - right
+        elif self.operator == '*':
+            return left * right
+        return left / right
+
+
+class Comparison(BinaryOperator):
+    """
+    `>`, `>=`, `<` and `<=` operators.
+    """
+
+    def evaluate(self, variables):
+        left = self.left.evaluate(variables)
+        right = self.right.evaluate(variables)
+        if (not isinstance(left, NUMBER_TYPES) or
+            not isinstance(right, NUMBER_TYPES)):
+            raise IncompatibleTypeError(
+                '%s requires numeric operands; got %s and %s' %
+                (self.operator, type(left), type(right)))
+        if self.operator == '>':
+            return left > right
+        elif self.operator == '>=':
+            return left >= right
+        elif self.operator == '<':
+            return left < right
+        return left <= right
+
+
+class Negation(Node):
+    """
+    Unary minus.
+    """
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def children(self):
+        return (self.operand,)
+
+    def evaluate(self, variables):
+        value = self.operand.evaluate(variables)
+        if not isinstance(value, NUMBER_TYPES):
+            raise IncompatibleTypeError(u'Only numbers can be negated')
+        return -value
+
+
+class Between(Node):
+    """
+    `BETWEEN` and `NOT BETWEEN` operators.
+    """
+
+    def __init__(self, operand, low, high, negated=False):
+        self.operand = operand
+        self.low = low
+        self.high = high
+        self.negated = negated
+
+    def children(self):
+        return (self.operand, self.low, self.high)
+
+    def evaluate(self, variables):
+        value = self.operand.evaluate(variables)
+        low = self.low.evaluate(variables)
+        high = self.high.evaluate(variables)
+        if (not isinstance(value, NUMBER_TYPES) or
+            not isinstance(low, NUMBER_TYPES) or
+            not isinstance(high, NUMBER_TYPES)):
+            raise IncompatibleTypeError(u'BETWEEN only works with numbers')
+        if self.negated:
+            return value < low or value > high
+        return value >= low and value <= high
+
+
+class In(Node):
+    """
+    `IN` and `NOT IN` operators.
+    """
+
+    def __init__(self, operand, items, negated=False):
+        self.operand = operand
+        self.items = items
+        self.negated = negated
+
+    def children(self):
+        return (self.operand,) + tuple(self.items)
+
+    def evaluate(self, variables):
+        value = self.operand.evaluate(variables)
+        for item in self.items:
+            if item.evaluate(variables) == value:
+                return not self.negated
+        return self.negated
+
+
+class Like(Node):
+    """
+    `LIKE` and `NOT LIKE` operators.
+
+    :ivar compiled: the compiled pattern, if the pattern is a string literal
+    :type compiled: :class:`~plasma.flex.messaging.selector.matcher.Pattern`
+    """
+
+    def __init__(self, operand, pattern, escapechar, negated=False):
+        self.operand = operand
+        self.pattern = pattern
+        self.escapechar = escapechar
+        self.negated = negated
+        self.compiled = None
+        if (isinstance(pattern, Literal) and
+            isinstance(pattern.value, basestring)):
+            self.compiled = compile_pattern(pattern.value, escapechar)
+
+    def children(self):
+        return (self.operand, self.pattern)
+
+    def evaluate(self, variables):
+        value = self.operand.evaluate(variables)
+        compiled = self.compiled
+        if compiled is None:
+            pattern = self.pattern.evaluate(variables)
+        else:
+            pattern = compiled.pattern
+        if (not isinstance(value, basestring) or
+            not isinstance(pattern, basestring)):
+            raise IncompatibleTypeError(
+                'LIKE requires string operands; got %s and %s' %
+                (type(value), type(pattern)))
+        if compiled is None:
+            compiled = compile_pattern(pattern, self.escapechar)
+        if self.negated:
+            return not compiled.matches(value)
+        return compiled.matches(value)
@@ -9,14 +9,217 @@ language that is used for message filtering.
 .. seealso:: http://livedocs.adobe.com/blazeds/1/blazeds_devguide/help.html?content=messaging_6.html
 """
 
-from ply.yacc import yacc
-from ply.lex import lex
+import threading
 
 from plasma.flex.messaging.selector import sql92grammar, sql92lexer
+from plasma.flex.messaging.selector.cache import SelectorCache
 
+#: Module containing the precomputed parse tables that ship with Plasma.
+TABLES_MODULE = 'plasma.flex.messaging.selector.sql92tab'
+
+# The lexer and parser are built on first use, see build().
+_lexer = None
+_parser = None
+
+# The ply lexer and parser keep their state on the instances, so only one
+# expression can be parsed at a time. Evaluating a compiled selector does not
+# use them and needs no locking.
+_parse_lock = threading.Lock()
+
+#: Compiled selectors, keyed by expression text.
+cache = SelectorCache()
+
+_missing = object()
+
+
+def _build(picklefile=None, write_tables=False):
+    global _lexer, _parser
+
+    from ply.lex import lex
+    from ply.yacc import yacc, NullLogger
+
+    _lexer = lex(module=sql92lexer)
+    if picklefile:
+        _parser = yacc(module=sql92grammar, debug=False,
+                       picklefile=picklefile, errorlog=NullLogger())
+    else:
+        _parser = yacc(module=sql92grammar, debug=False,
+                       tabmodule=TABLES_MODULE, write_tables=write_tables,
+                       errorlog=NullLogger())
+
+
+def build(picklefile=None, write_tables=False):
+    """
+    Builds the lexer and parser for selector expressions.
+
+    This happens automatically the first time an expression is compiled, so
+    importing the selector modules is cheap. The parse tables are loaded from
+    :data:`TABLES_MODULE` if it matches the grammar and the installed ply
+    version, otherwise they are generated in memory.
+
+    :param picklefile: path of a file to cache the parse tables in, e.g. for
+        workers that can not use the shipped tables. The tables are loaded
+        from the file if it is up to date, otherwise they are generated and
+        written to it.
+    :type picklefile: `str`
+    :param write_tables: regenerate the shipped :data:`TABLES_MODULE`. Only
+        needed after changing the grammar.
+    :type write_tables: `bool`
+    """
+    _parse_lock.acquire()
+    try:
+        _build(picklefile, write_tables)
+    finally:
+        _parse_lock.release()
+
+
+class LazyVariables(object):
+    """
+    Adapts a function that fetches variable values on demand to the mapping
+    interface used when evaluating selectors.
+
+    Only the variables that are needed to decide the result of an expression
+    are fetched, and each of them is fetched at most once.
+
+    :ivar getter: a function that takes a variable name and returns its
+        value, or raises `KeyError` if the variable does not exist
+    """
+
+    def __init__(self, getter):
+        self.getter = getter
+        self.values = {}
+
+    def __getitem__(self, name):
+        try:
+            value = self.values[name]
+        except KeyError:
+            try:
+                value = self.getter(name)
+            except KeyError:
+                value = _missing
+            self.values[name] = value
+
+        if value is _missing:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+
+class Selector(object):
+    """
+    A compiled selector expression.
+
+    Parsing is done once, when the selector is compiled. The selector can
+    then be evaluated against any number of variable sets, which makes it
+    suitable for checking every message that is sent to a subscription.
+
+    Selectors are immutable and keep no evaluation state, the variables are
+    passed explicitly to each evaluation. A selector can therefore be
+    evaluated concurrently from many threads or coroutines.
+
+    :ivar expression: the source text of the expression
+    :type expression: `str`
+    :ivar tree: the root node of the expression tree
+    :type tree: :class:`~plasma.flex.messaging.selector.nodes.Node`
+    """
+
+    def __init__(self, expression, tree):
+        self.expression = expression
+        self.tree = tree
+
+    def evaluate(self, variables=None):
+        """
+        Evaluates the expression using the given variables.
+
+        Variables are looked up only when they are needed: `AND`, `OR` and
+        `IN` stop evaluating their operands as soon as the result is known.
+
+        :param variables: a mapping of variables and their values, or a
+            function that returns the value of a variable on demand (see
+            :class:`LazyVariables`)
+        :type variables: `dict` or `callable`
+        :return: result of the expression evaluation
+        """
+        if variables is None:
+            variables = {}
+        elif callable(variables) and not hasattr(variables, '__getitem__'):
+            variables = LazyVariables(variables)
+        return self.tree.evaluate(variables)
+
+    def matches(self, variables=None):
+        """
+        Checks whether the given variables (usually message headers) are
+        selected by this expression.
+
+        :param variables: a mapping of variables and their values, or a
+            function that returns the value of a variable on demand
+        :type variables: `dict` or `callable`
+        :return: `True` if the expression evaluates to `True`, `False`
+                 otherwise
+        :rtype: `bool`
+        """
+        return self.evaluate(variables) is True
+
+    def evaluate_columns(self, columns, size=None):
+        """
+        Evaluates the expression against columns of header values, one
+        operator at a time instead of one message at a time.
+
+        .. seealso:: :func:`~plasma.flex.messaging.selector.batch.evaluate_columns`
+
+        :param columns: a mapping of variable names to equally long lists
+            (or NumPy arrays) of values
+        :type columns: `dict`
+        :param size: the number of messages, if there are no columns
+        :type size: `int`
+        :return: a boolean mask of the selected messages
+        """
+        from plasma.flex.messaging.selector import batch
+
+        return batch.evaluate_columns(self.tree, columns, size)
+
+    def __repr__(self):
+        return '<Selector %r>' % (self.expression,)
+
+
+def compile(expression, log=None):
+    """
+    Compiles the given SQL92 boolean expression into a reusable
+    :class:`Selector`.
+
+    Compiled selectors are kept in :data:`cache`, so compiling an expression
+    that has been seen before does not parse it again. Passing a `log`
+    always parses the expression, so that the debugging output is produced.
+
+    :param expression: A BlazeDS-compatible SQL92 boolean expression
+    :type expression: `str`
+    :param log: logger that receives debugging information
+    :type log: :class:`logging.Logger`
+    :rtype: :class:`Selector`
+    """
+    if log is None:
+        selector = cache.get(expression)
+        if selector is not None:
+            return selector
+
+    _parse_lock.acquire()
+    try:
+        if _parser is None:
+            _build()
+        tree = _parser.parse(expression, lexer=_lexer, debug=log)
+    finally:
+        _parse_lock.release()
+
+    selector = Selector(expression, tree)
+    cache.put(expression, selector)
+    return selector
 
-_lexer = lex(module=sql92lexer)
-_parser = yacc(module=sql92grammar, debug=None, write_tables=False)
 
 def evaluate(expression, variables=None, log=None):
     """
@@ -24,6 +227,9 @@ def evaluate(expression, variables=None, log=None):
 
     ..note:: `BETWEEN` expressions only accept variables and number literals.
 
+    .. seealso:: :func:`compile` for evaluating the same expression
+       repeatedly.
+
     :param expression: A BlazeDS-compatible SQL92 boolean expression
     :type expression: `str`
     :param variables: a dictionary of variables and their values
@@ -33,5 +239,24 @@ def evaluate(expression, variables=None, log=None):
     :return: result of the expression evaluation
     :rtype: `bool`
     """
-    sql92grammar.local.variables = variables or {}
-    return _parser.parse(expression, lexer=_lexer, debug=log)
+    return compile(expression, log).evaluate(variables)
+
+
+def evaluate_columns(expression, columns, size=None, log=None):
+    """
+    Evaluates the given SQL92 boolean expression against columns of header
+    values, e.g. the headers of all the messages in a stored queue.
+
+    :param expression: A BlazeDS-compatible SQL92 boolean expression
+    :type expression: `str`
+    :param columns: a mapping of variable names to equally long lists (or
+        NumPy arrays) of values. `None` in a list marks a missing header.
+    :type columns: `dict`
+    :param size: the number of messages, if there are no columns
+    :type size: `int`
+    :param log: logger that receives debugging information
+    :type log: :class:`logging.Logger`
+    :return: a boolean mask with a `True` value for every selected message
+    :rtype: `list` or :class:`numpy.ndarray`
+    """
+    return compile(expression, log).evaluate_columns(columns, size)
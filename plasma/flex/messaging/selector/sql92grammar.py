@@ -3,15 +3,19 @@
 
 """
 Grammar definition for a subset of SQL92 expressions.
+
+The grammar rules do not evaluate the expression directly, they build a tree
+of :mod:`~plasma.flex.messaging.selector.nodes` that can be evaluated
+repeatedly.
+
+The parse tables for this grammar are shipped in `sql92tab`. After changing
+the grammar, regenerate them with
+:func:`plasma.flex.messaging.selector.parser.build` `(write_tables=True)`.
 """
-import threading
 
 from plasma.flex.messaging.selector.sql92lexer import tokens
-from plasma.flex.messaging.selector import (ParseError, IncompatibleTypeError,
-    UnknownVariableError)
-from plasma.flex.messaging.selector.matcher import Matcher
-
-local = threading.local()
+from plasma.flex.messaging.selector import ParseError
+from plasma.flex.messaging.selector import nodes
 
 precedence = (
     ('nonassoc', 'BETWEEN', 'LIKE'),
@@ -25,67 +29,57 @@ precedence = (
 def p_expression(p):
     """expression : NUMBER
                   | BOOLEAN
-                  | STRING
-                  | variable"""
+                  | STRING"""
+    p[0] = nodes.Literal(p[1])
+
+
+def p_expression_variable(p):
+    """expression : variable"""
     p[0] = p[1]
 
 
 def p_equality(p):
     """expression : expression EQ expression
                   | expression NEQ expression"""
-    if p[2] == '=':
-        p[0] = p[1] == p[3]
-    elif p[2] == '<>':
-        p[0] = p[1] != p[3]
+    p[0] = nodes.Equality(p[2], p[1], p[3])
 
 
 def p_binary_logical_operators(p):
     """expression : expression AND expression
                   | expression OR expression"""
-    if not isinstance(p[1], bool) or not isinstance(p[3], bool):
-        raise IncompatibleTypeError(
-            u'%s requires boolean operands; got %s and %s' %
-            (p[2], type(p[1]), type(p[3])))
-    if p[2] == 'AND':
-        p[0] = p[1] and p[3]
-    elif p[2] == 'OR':
-        p[0] = p[1] or p[3]
+    p[0] = nodes.Logical(p[2], p[1], p[3])
 
 
 def p_between(p):
     """expression : expression BETWEEN between_expr AND between_expr \
                         %prec BETWEEN"""
-    if (not isinstance(p[1], (int, long, float)) or
-        not isinstance(p[3], (int, long, float)) or
-        not isinstance(p[5], (int, long, float))):
-        raise IncompatibleTypeError(u'BETWEEN only works with numbers')
-    p[0] = p[1] >= p[3] and p[1] <= p[5]
+    p[0] = nodes.Between(p[1], p[3], p[5])
 
 
 def p_not_between(p):
     """expression : expression NOT BETWEEN between_expr AND between_expr \
                         %prec BETWEEN"""
-    if (not isinstance(p[1], (int, long, float)) or
-        not isinstance(p[4], (int, long, float)) or
-        not isinstance(p[6], (int, long, float))):
-        raise IncompatibleTypeError(u'BETWEEN only works with numbers')
-    p[0] = p[1] < p[4] or p[1] > p[6]
+    p[0] = nodes.Between(p[1], p[4], p[6], negated=True)
 
 
 def p_between_expr(p):
-    """between_expr : variable
-                    | NUMBER"""
+    """between_expr : variable"""
     p[0] = p[1]
 
 
+def p_between_expr_number(p):
+    """between_expr : NUMBER"""
+    p[0] = nodes.Literal(p[1])
+
+
 def p_is_null(p):
     """expression : VARIABLE IS NULL"""
-    p[0] = p[1] not in local.variables
+    p[0] = nodes.IsNull(p[1])
 
 
 def p_is_not_null(p):
     """expression : VARIABLE IS NOT NULL"""
-    p[0] = p[1] in local.variables
+    p[0] = nodes.IsNull(p[1], negated=True)
 
 
 def p_binary_operators(p):
@@ -93,26 +87,12 @@ def p_binary_operators(p):
                   | expression MINUS expression
                   | expression TIMES expression
                   | expression DIVIDE expression"""
-    if (not isinstance(p[1], (int, long, float)) or
-        not isinstance(p[3], (int, long, float))):
-        raise IncompatibleTypeError(
-            '%s requires numeric operands; got %s and %s' %
-            (p[2], type(p[1]), type(p[3])))
-    if p[2] == '+':
-        p[0] = p[1] + p[3]
-    elif p[2] == '-':
-        p[0] = p[1] - p[3]
-    elif p[2] == '*':
-        p[0] = p[1] * p[3]
-    elif p[2] == '/':
-        p[0] = p[1] / p[3]
+    p[0] = nodes.Arithmetic(p[2], p[1], p[3])
 
 
 def p_expr_uminus(p):
     """expression : MINUS expression %prec UMINUS"""
-    if not isinstance(p[2], (int, long, float)):
-        raise IncompatibleTypeError(u'Only numbers can be negated')
-    p[0] = -p[2]
+    p[0] = nodes.Negation(p[2])
 
 
 def p_num_comparisons(p):
@@ -120,29 +100,17 @@ def p_num_comparisons(p):
                   | expression GTE expression
                   | expression LT expression
                   | expression LTE expression"""
-    if (not isinstance(p[1], (int, long, float)) or
-        not isinstance(p[3], (int, long, float))):
-        raise IncompatibleTypeError(
-            '%s requires numeric operands; got %s and %s' %
-            (p[2], type(p[1]), type(p[3])))
-    if p[2] == '>':
-        p[0] = p[1] > p[3]
-    elif p[2] == '>=':
-        p[0] = p[1] >= p[3]
-    elif p[2] == '<':
-        p[0] = p[1] < p[3]
-    elif p[2] == '<=':
-        p[0] = p[1] <= p[3]
+    p[0] = nodes.Comparison(p[2], p[1], p[3])
 
 
 def p_in(p):
     """expression : expression IN '(' expression_list ')'"""
-    p[0] = p[1] in p[4]
+    p[0] = nodes.In(p[1], p[4])
 
 
 def p_not_in(p):
     """expression : expression NOT IN '(' expression_list ')'"""
-    p[0] = p[1] not in p[5]
+    p[0] = nodes.In(p[1], p[5], negated=True)
 
 
 def p_expression_list(p):
@@ -157,22 +125,12 @@ def p_expression_list(p):
 
 def p_like(p):
     """expression : expression LIKE expression escapechar"""
-    if (not isinstance(p[1], basestring) or
-        not isinstance(p[3], basestring)):
-        raise IncompatibleTypeError(
-            'LIKE requires string operands; got %s and %s' %
-            (type(p[1]), type(p[3])))
-    p[0] = Matcher(p[1], p[3], p[4]).matches()
+    p[0] = nodes.Like(p[1], p[3], p[4])
 
 
 def p_not_like(p):
     """expression : expression NOT LIKE expression escapechar"""
-    if (not isinstance(p[1], basestring) or
-        not isinstance(p[4], basestring)):
-        raise IncompatibleTypeError(
-            'LIKE requires string operands; got %s and %s' %
-            (type(p[1]), type(p[4])))
-    p[0] = not Matcher(p[1], p[4], p[5]).matches()
+    p[0] = nodes.Like(p[1], p[4], p[5], negated=True)
 
 
 def p_escapechar(p):
@@ -188,10 +146,7 @@ def p_parentheses(p):
 
 def p_variable(p):
     """variable : VARIABLE"""
-    try:
-        p[0] = local.variables[p[1]]
-    except KeyError:
-        raise UnknownVariableError('Undefined variable: %s' % p[1])
+    p[0] = nodes.Variable(p[1])
 
 
 # Error rule for syntax errors
@@ -0,0 +1,63 @@
+
+# sql92tab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = "nonassocBETWEENLIKEleftANDORnonassocEQNEQGTGTELTLTEleftPLUSMINUSleftTIMESDIVIDErightUMINUSAND BETWEEN BOOLEAN DIVIDE EQ ESCAPE GT GTE IN IS LIKE LT LTE MINUS NEQ NOT NULL NUMBER OR PLUS STRING TIMES VARIABLEexpression : NUMBER\n                  | BOOLEAN\n                  | STRINGexpression : variableexpression : expression EQ expression\n                  | expression NEQ expressionexpression : expression AND expression\n                  | expression OR expressionexpression : expression BETWEEN between_expr AND between_expr                         %prec BETWEENexpression : expression NOT BETWEEN between_expr AND between_expr                         %prec BETWEENbetween_expr : variablebetween_expr : NUMBERexpression : VARIABLE IS NULLexpression : VARIABLE IS NOT NULLexpression : expression PLUS expression\n                  | expression MINUS expression\n                  | expression TIMES expression\n                  | expression DIVIDE expressionexpression : MINUS expression %prec UMINUSexpression : expression GT expression\n                  | expression GTE expression\n                  | expression LT expression\n                  | expression LTE expressionexpression : expression IN '(' expression_list ')'expression : expression NOT IN '(' expression_list ')'expression_list : expression_list ',' expression\n                       | expressionexpression : expression LIKE expression escapecharexpression : expression NOT LIKE expression escapecharescapechar : ESCAPE STRING\n                  |expression  : '(' expression ')'variable : VARIABLE"
+    
+_lr_action_items = {'IN':([1,2,4,6,7,8,9,10,26,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,22,-19,22,50,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,22,-8,-14,22,-28,22,-9,-24,-30,-29,22,-10,-25,]),'NUMBER':([0,3,5,12,13,14,15,16,17,18,19,20,21,23,24,25,27,44,48,49,53,60,63,66,],[1,1,1,31,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,31,31,1,1,31,]),'NULL':([11,29,],[30,52,]),'MINUS':([0,1,2,3,4,5,6,7,8,9,10,13,14,15,16,17,18,19,20,21,23,24,25,27,28,30,31,33,34,35,36,37,38,39,40,41,42,43,44,45,46,47,48,51,52,55,56,58,60,61,62,63,64,65,68,69,70,],[3,-1,-4,3,-3,3,-33,-2,13,-19,13,3,3,3,3,3,3,3,3,3,3,3,3,3,-32,-13,-12,-33,-11,-16,13,13,-15,13,13,-18,-17,13,3,13,13,13,3,13,-14,13,-28,13,3,-9,-24,3,-30,-29,13,-10,-25,]),'STRING':([0,3,5,13,14,15,16,17,18,19,20,21,23,24,25,27,44,48,57,60,63,],[4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,4,64,4,4,]),')':([1,2,4,6,7,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,54,55,56,58,61,62,64,65,67,68,69,70,],[-1,-4,-3,-33,-2,-19,28,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,-31,-8,-14,62,-27,-28,-31,-9,-24,-30,-29,70,-26,-10,-25,]),'(':([0,3,5,13,14,15,16,17,18,19,20,21,22,23,24,25,27,44,48,50,60,63,],[5,5,5,5,5,5,5,5,5,5,5,5,44,5,5,5,5,5,5,60,5,5,]),'ESCAPE':([1,2,4,6,7,9,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,56,58,61,62,64,65,69,70,],[-1,-4,-3,-33,-2,-19,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,57,-8,-14,-28,57,-9,-24,-30,-29,-10,-25,]),',':([1,2,4,6,7,9,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,54,55,56,58,61,62,64,65,67,68,69,70,],[-1,-4,-3,-33,-2,-19,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,-31,-8,-14,63,-27,-28,-31,-9,-24,-30,-29,63,-26,-10,-25,]),'LT':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,15,-19,15,-32,-13,-12,-33,-11,-16,None,None,-15,None,None,-18,-17,None,None,15,15,15,-14,15,-28,15,-9,-24,-30,-29,15,-10,-25,]),'PLUS':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,16,-19,16,-32,-13,-12,-33,-11,-16,16,16,-15,16,16,-18,-17,16,16,16,16,16,-14,16,-28,16,-9,-24,-30,-29,16,-10,-25,]),'GTE':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,14,-19,14,-32,-13,-12,-33,-11,-16,None,None,-15,None,None,-18,-17,None,None,14,14,14,-14,14,-28,14,-9,-24,-30,-29,14,-10,-25,]),'NEQ':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,17,-19,17,-32,-13,-12,-33,-11,-16,None,None,-15,None,None,-18,-17,None,None,17,17,17,-14,17,-28,17,-9,-24,-30,-29,17,-10,-25,]),'$end':([1,2,4,6,7,8,9,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,56,58,61,62,64,65,69,70,],[-1,-4,-3,-33,-2,0,-19,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,-31,-8,-14,-28,-31,-9,-24,-30,-29,-10,-25,]),'GT':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,18,-19,18,-32,-13,-12,-33,-11,-16,None,None,-15,None,None,-18,-17,None,None,18,18,18,-14,18,-28,18,-9,-24,-30,-29,18,-10,-25,]),'DIVIDE':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,19,-19,19,-32,-13,-12,-33,-11,19,19,19,19,19,19,-18,-17,19,19,19,19,19,-14,19,-28,19,-9,-24,-30,-29,19,-10,-25,]),'IS':([6,],[11,]),'TIMES':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,20,-19,20,-32,-13,-12,-33,-11,20,20,20,20,20,20,-18,-17,20,20,20,20,20,-14,20,-28,20,-9,-24,-30,-29,20,-10,-25,]),'LTE':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,21,-19,21,-32,-13,-12,-33,-11,-16,None,None,-15,None,None,-18,-17,None,None,21,21,21,-14,21,-28,21,-9,-24,-30,-29,21,-10,-25,]),'BETWEEN':([1,2,4,6,7,8,9,10,26,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,12,-19,12,49,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,12,-8,-14,12,-28,12,-9,-24,-30,-29,12,-10,-25,]),'VARIABLE':([0,3,5,12,13,14,15,16,17,18,19,20,21,23,24,25,27,44,48,49,53,60,63,66,],[6,6,6,33,6,6,6,6,6,6,6,6,6,6,6,6,6,6,6,33,33,6,6,33,]),'EQ':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,23,-19,23,-32,-13,-12,-33,-11,-16,None,None,-15,None,None,-18,-17,None,None,23,23,23,-14,23,-28,23,-9,-24,-30,-29,23,-10,-25,]),'AND':([1,2,4,6,7,8,9,10,28,30,31,32,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,59,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,24,-19,24,-32,-13,-12,53,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,24,-8,-14,24,-28,24,66,-9,-24,-30,-29,24,-10,-25,]),'LIKE':([1,2,4,6,7,8,9,10,26,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,25,-19,25,48,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,25,-8,-14,25,-28,25,-9,-24,-30,-29,25,-10,-25,]),'BOOLEAN':([0,3,5,13,14,15,16,17,18,19,20,21,23,24,25,27,44,48,60,63,],[7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,7,]),'NOT':([1,2,4,6,7,8,9,10,11,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,26,-19,26,29,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,26,-8,-14,26,-28,26,-9,-24,-30,-29,26,-10,-25,]),'OR':([1,2,4,6,7,8,9,10,28,30,31,33,34,35,36,37,38,39,40,41,42,43,45,46,47,51,52,55,56,58,61,62,64,65,68,69,70,],[-1,-4,-3,-33,-2,27,-19,27,-32,-13,-12,-33,-11,-16,-21,-22,-15,-6,-20,-18,-17,-23,-5,-7,27,-8,-14,27,-28,27,-9,-24,-30,-29,27,-10,-25,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'variable':([0,3,5,12,13,14,15,16,17,18,19,20,21,23,24,25,27,44,48,49,53,60,63,66,],[2,2,2,34,2,2,2,2,2,2,2,2,2,2,2,2,2,2,2,34,34,2,2,34,]),'expression_list':([44,60,],[54,67,]),'escapechar':([47,58,],[56,65,]),'expression':([0,3,5,13,14,15,16,17,18,19,20,21,23,24,25,27,44,48,60,63,],[8,9,10,35,36,37,38,39,40,41,42,43,45,46,47,51,55,58,55,68,]),'between_expr':([12,49,53,66,],[32,59,61,69,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> expression","S'",1,None,None,None),
+  ('expression -> NUMBER','expression',1,'p_expression','sql92grammar.py',26),
+  ('expression -> BOOLEAN','expression',1,'p_expression','sql92grammar.py',27),
+  ('expression -> STRING','expression',1,'p_expression','sql92grammar.py',28),
+  ('expression -> variable','expression',1,'p_expression_variable','sql92grammar.py',33),
+  ('expression -> expression EQ expression','expression',3,'p_equality','sql92grammar.py',38),
+  ('expression -> expression NEQ expression','expression',3,'p_equality','sql92grammar.py',39),
+  ('expression -> expression AND expression','expression',3,'p_binary_logical_operators','sql92grammar.py',44),
+  ('expression -> expression OR expression','expression',3,'p_binary_logical_operators','sql92grammar.py',45),
+  ('expression -> expression BETWEEN between_expr AND between_expr','expression',5,'p_between','sql92grammar.py',50),
+  ('expression -> expression NOT BETWEEN between_expr AND between_expr','expression',6,'p_not_between','sql92grammar.py',56),
+  ('between_expr -> variable','between_expr',1,'p_between_expr','sql92grammar.py',62),
+  ('between_expr -> NUMBER','between_expr',1,'p_between_expr_number','sql92grammar.py',67),
+  ('expression -> VARIABLE IS NULL','expression',3,'p_is_null','sql92grammar.py',72),
+  ('expression -> VARIABLE IS NOT NULL','expression',4,'p_is_not_null','sql92grammar.py',77),
+  ('expression -> expression PLUS expression','expression',3,'p_binary_operators','sql92grammar.py',82),
+  ('expression -> expression MINUS expression','expression',3,'p_binary_operators','sql92grammar.py',83),
+  ('expression -> expression TIMES expression','expression',3,'p_binary_operators','sql92grammar.py',84),
+  ('expression -> expression DIVIDE expression','expression',3,'p_binary_operators','sql92grammar.py',85),
+  ('expression -> MINUS expression','expression',2,'p_expr_uminus','sql92grammar.py',90),
+  ('expression -> expression GT expression','expression',3,'p_num_comparisons','sql92grammar.py',95),
+  ('expression -> expression GTE expression','expression',3,'p_num_comparisons','sql92grammar.py',96),
+  ('expression -> expression LT expression','expression',3,'p_num_comparisons','sql92grammar.py',97),
+  ('expression -> expression LTE expression','expression',3,'p_num_comparisons','sql92grammar.py',98),
+  ('expression -> expression IN ( expression_list )','expression',5,'p_in','sql92grammar.py',103),
+  ('expression -> expression NOT IN ( expression_list )','expression',6,'p_not_in','sql92grammar.py',108),
+  ('expression_list -> expression_list , expression','expression_list',3,'p_expression_list','sql92grammar.py',113),
+  ('expression_list -> expression','expression_list',1,'p_expression_list','sql92grammar.py',114),
+  ('expression -> expression LIKE expression escapechar','expression',4,'p_like','sql92grammar.py',123),
+  ('expression -> expression NOT LIKE expression escapechar','expression',5,'p_not_like','sql92grammar.py',128),
+  ('escapechar -> ESCAPE STRING','escapechar',2,'p_escapechar','sql92grammar.py',133),
+  ('escapechar -> <empty>','escapechar',0,'p_escapechar','sql92grammar.py',134),
+  ('expression -> ( expression )','expression',3,'p_parentheses','sql92grammar.py',139),
+  ('variable -> VARIABLE','variable',1,'p_variable','sql92grammar.py',144),
+]
@@ -0,0 +1,1395 @@
+# Copyright The Plasma Project.
+# See LICENSE.txt for details.
+
+"""
+The parts of the remoting clients that do not depend on how envelopes are
+sent: the base class of the services, the request queue, result caching,
+metrics, and the incremental encoding and decoding of envelopes.
+
+This module does not depend on Twisted, so that clients for other event
+loops, such as :mod:`plasma.aioclient`, can be used without it. It runs on
+Python 3 with `Py3AMF`_.
+
+.. _Py3AMF: https://pypi.python.org/pypi/Py3AMF
+"""
+
+import copy
+import math
+import threading
+import time
+import zlib
+
+from pyamf import remoting, util
+from pyamf.remoting import get_exception_from_fault
+import pyamf
+
+from plasma.flex.messaging.messages.headers import REQUEST_TIMEOUT
+from plasma.util import LRUCache
+
+try:
+    unicode
+except NameError:
+    # Python 3
+    unicode = basestring = str
+    long = int
+
+# The private functions of pyamf.remoting that encode a single header or
+# body, which PyAMF 0.5.1 to 0.8 and Py3AMF have. Without them, envelopes
+# are encoded by remoting.encode, in one piece.
+_write_header = getattr(remoting, '_write_header', None)
+_write_body = getattr(remoting, '_write_body', None)
+
+# The types of the header values that are encoded without references
+_SCALAR_TYPES = (type(None), bool, int, long, float)
+
+
+# Returned by ResultCache.get for results that are not cached
+_MISSING = object()
+
+
+class RequestTimeoutError(remoting.RemotingError):
+    """
+    Raised when no response to a request was received before its deadline.
+
+    """
+
+
+class ServiceMethodProxy(object):
+    """
+    Serves as a proxy for calling a service method.
+
+    :ivar service: the parent service
+    :type service: :class:`~ServiceProxy`
+    :ivar name: the name of the method
+    :type name: `str` or `None`
+
+    .. seealso:: :meth:`ServiceProxy.__getattr__`
+
+    """
+
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+
+    def __call__(self, *args):
+        """
+        Inform the proxied service that this function has been called.
+        """
+        return self.service._call(self, *args)
+
+    def __str__(self):
+        """
+        Returns the full service name, including the method name if there is
+        one.
+
+        """
+        service_name = str(self.service)
+
+        if self.name is not None:
+            service_name = '%s.%s' % (service_name, self.name)
+
+        return service_name
+
+
+class ServiceProxy(object):
+    """
+    Serves as a service object proxy for RPC calls. Generates
+    :class:`~ServiceMethodProxy` objects for method calls.
+
+    .. seealso:: :class:`~RequestWrapper` for more info.
+
+    :ivar _gw: The parent gateway
+    :type _gw: :class:`~RemotingService`
+    :ivar _name: The name of the service
+    :type _name: `str`
+    :ivar _auto_execute: If set to `True`, when a service method is called,
+        the AMF request is immediately sent to the remote gateway and a
+        response is returned. If set to `False`, a :class:`~RequestWrapper` is
+        returned, waiting for the underlying gateway to fire the
+        :meth:`RemotingService.execute` method.
+    :ivar _timeout: The number of seconds after which calls time out, or
+        `None` for the default timeout of the gateway.
+    :type _timeout: `float`
+    :ivar _idempotent: Whether calls can safely be sent again when it is
+        unknown whether the gateway received them.
+    :type _idempotent: `bool`
+    :ivar _cached: Whether the results of calls can be shared with identical
+        calls. See :meth:`RemotingServiceBase.addRequest`.
+    :type _cached: `bool`
+
+    """
+
+    def __init__(self, gw, name, auto_execute=True, timeout=None,
+                 idempotent=False, cached=False):
+        self._gw = gw
+        self._name = name
+        self._auto_execute = auto_execute
+        self._timeout = timeout
+        self._idempotent = idempotent
+        self._cached = cached
+
+    def __getattr__(self, name):
+        return ServiceMethodProxy(self, name)
+
+    def _call(self, method_proxy, *args):
+        """
+        Executed when a :class:`~ServiceMethodProxy` is called.
+        Adds a request to the underlying gateway. If `_auto_execute` is set to
+        `True`, then the request is called on the remote gateway, either
+        immediately or at the end of the gateway's batch window.
+
+        """
+        d = self._gw.addRequest(method_proxy, *args,
+                                **{'timeout': self._timeout,
+                                   'idempotent': self._idempotent,
+                                   'cached': self._cached})
+        if self._auto_execute:
+            return self._gw._autoExecute(d)
+        return d
+
+    def __call__(self, *args):
+        """
+        This allows services to be 'called' without a method name.
+
+        """
+        return self._call(ServiceMethodProxy(self, None), *args)
+
+    def __str__(self):
+        """
+        Returns a string representation of the name of the service.
+
+        """
+        return self._name
+
+
+class RequestWrapper(object):
+    """
+    A container object that wraps a service method request.
+
+    :ivar id: The id of the request.
+    :type id: `str`
+    :ivar service: The service proxy.
+    :type service: :class:`~ServiceProxy`
+    :ivar args: The args used to invoke the call.
+    :type args: `list`
+    :ivar deferred: Receives the result of the call. A :class:`Deferred`
+        unless another object is passed as the `deferred` keyword argument.
+    :ivar size: The estimated encoded size of the request in bytes, if it
+        was measured.
+    :type size: `int`
+    :ivar deadline: The time after which the request times out, in seconds
+        since the epoch, or `None`.
+    :type deadline: `float`
+    :ivar idempotent: Whether the request can safely be sent again when it
+        is unknown whether the gateway received it.
+    :type idempotent: `bool`
+    :ivar attempts: The number of times the request was sent.
+    :type attempts: `int`
+    :ivar cache_key: The key of the result in the result cache, if the
+        result can be shared with identical calls.
+    :ivar followers: The objects that receive the result of identical calls
+        made while the request was pending, or `None`.
+    :type followers: `list`
+
+    """
+
+    __slots__ = ('id', 'service', 'args', 'deferred', 'size', 'deadline',
+                 'idempotent', 'attempts', 'cache_key', 'followers')
+
+    def __init__(self, id_, service, *args, **kwargs):
+        self.id = id_
+        self.service = service
+        self.args = args
+        self.deferred = kwargs.get('deferred')
+        if self.deferred is None:
+            from twisted.internet.defer import Deferred
+            self.deferred = Deferred()
+        self.size = 0
+        self.deadline = kwargs.get('deadline')
+        self.idempotent = kwargs.get('idempotent', False)
+        self.attempts = 0
+        self.cache_key = kwargs.get('cache_key')
+        self.followers = None
+
+
+class RequestQueue(object):
+    """
+    The pending requests of a service, in the order they were added.
+
+    Requests can be looked up and removed by id or by :class:`Deferred` in
+    constant time. Removed requests leave a hole in the order, which is
+    compacted once there are more holes than requests.
+
+    """
+
+    def __init__(self):
+        self._order = []
+        self._holes = 0
+        self._by_id = {}
+        self._by_deferred = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        for request in self._order:
+            if request is not None:
+                yield request
+
+    def __contains__(self, request):
+        found = self._by_id.get(request.id)
+        return found is not None and found[0] is request
+
+    def append(self, request):
+        """
+        Adds a request to the end of the queue.
+
+        :raise ValueError: A request with the same id is already queued.
+
+        """
+        if request.id in self._by_id:
+            raise ValueError('Duplicate request id %s' % (request.id,))
+        self._by_id[request.id] = (request, len(self._order))
+        self._by_deferred[request.deferred] = request
+        self._order.append(request)
+
+    def get(self, id_):
+        """
+        Returns the request with the given id.
+
+        :raise LookupError: Request not found.
+
+        """
+        try:
+            return self._by_id[id_][0]
+        except KeyError:
+            raise LookupError('Request not found')
+
+    def getByDeferred(self, deferred):
+        """
+        Returns the request whose result is delivered to `deferred`.
+
+        :raise LookupError: Request not found.
+
+        """
+        try:
+            return self._by_deferred[deferred]
+        except KeyError:
+            raise LookupError('Request not found')
+
+    def remove(self, request):
+        """
+        Removes a request from the queue.
+
+        :raise LookupError: Request not found.
+
+        """
+        try:
+            found, position = self._by_id[request.id]
+        except KeyError:
+            raise LookupError('Request not found')
+        if found is not request:
+            raise LookupError('Request not found')
+
+        del self._by_id[request.id]
+        del self._by_deferred[request.deferred]
+        self._order[position] = None
+        self._holes += 1
+
+        if self._holes > len(self._by_id):
+            self._compact()
+
+    def _compact(self):
+        self._order = [r for r in self._order if r is not None]
+        self._holes = 0
+        for position, request in enumerate(self._order):
+            self._by_id[request.id] = (request, position)
+
+
+class ResultCache(LRUCache):
+    """
+    A bounded, thread-safe mapping of remoting calls to their results.
+    Results expire `ttl` seconds after they were stored. When the cache is
+    full, the least recently used result is evicted.
+
+    :ivar maxsize: the maximum number of results to keep
+    :type maxsize: `int`
+    :ivar ttl: the number of seconds results are kept for
+    :type ttl: `float`
+    :ivar hits: number of lookups that found a cached result
+    :type hits: `int`
+    :ivar misses: number of lookups that did not find a cached result
+    :type misses: `int`
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, seconds=time.time):
+        LRUCache.__init__(self, maxsize)
+        self.ttl = ttl
+        self.seconds = seconds
+
+    def get(self, key, default=None):
+        """
+        Returns the cached result for `key`, or `default` if it is not in
+        the cache or has expired.
+
+        """
+        entry = LRUCache.get(self, key, _MISSING)
+        if entry is _MISSING:
+            return default
+        return entry[0]
+
+    def put(self, key, value):
+        """
+        Stores a result, evicting the least recently used result if the
+        cache is full.
+
+        """
+        LRUCache.put(self, key, (value, self.seconds() + self.ttl))
+
+    def _isFresh(self, entry):
+        return entry[1] > self.seconds()
+
+
+class RemotingMetrics(object):
+    """
+    Receives the measures of the work of a remoting service. This class
+    ignores them; subclasses record them, or forward them to a monitoring
+    system.
+
+    Each envelope is measured in phases, in seconds:
+
+     - `queue_wait`: waiting for the dispatch queue,
+     - `encode`: encoding the envelope, except the parts of a streamed
+       envelope that are encoded while it is sent,
+     - `connect`: getting a connection to the gateway, until the request
+       starts to be written,
+     - `first_byte`: writing the request and waiting for the response
+       headers,
+     - `transfer`: receiving the response body, decoding included,
+     - `decode`: decoding the response body,
+     - `dispatch`: delivering the result of one request to its callbacks.
+
+    The other measures are `request_bytes` and `response_bytes`, the sizes
+    of the bodies on the wire, and `batch_size`, the number of requests of
+    an envelope. The counters are `envelopes` and `requests`, the number
+    sent, `errors`, the number of requests that failed, `envelope_errors`,
+    the number of envelopes that got no valid response, `timeouts` and
+    `retries`.
+
+    Not every service measures every phase.
+
+    """
+
+    def observe(self, name, value):
+        """
+        Records one measure of `name`.
+
+        :type value: `float`
+
+        """
+
+    def increment(self, name, count=1):
+        """
+        Adds `count` to the counter `name`.
+
+        :type count: `int`
+
+        """
+
+
+class Histogram(object):
+    """
+    The distribution of the measures of a quantity. The measures are
+    counted in buckets whose bounds grow geometrically, so percentiles are
+    known within a relative error of `precision`, in constant memory.
+
+    :ivar count: the number of measures
+    :type count: `int`
+    :ivar total: the sum of the measures
+    :type total: `float`
+    :ivar min: the smallest measure, or `None`
+    :ivar max: the largest measure, or `None`
+
+    """
+
+    def __init__(self, precision=0.05):
+        self.precision = precision
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self._log_base = math.log(1 + precision)
+        # the number of measures of at most 0, and in the other buckets
+        self._zeros = 0
+        self._buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value <= 0:
+            self._zeros += 1
+            return
+        bucket = int(math.ceil(math.log(value) / self._log_base))
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Returns the measure that `percent` percent of the measures do not
+        exceed, or `None` if there is no measure.
+
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(percent / 100.0 * self.count)))
+        seen = self._zeros
+        if seen >= rank:
+            return self.min
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                bound = (1 + self.precision) ** bucket
+                return max(self.min, min(self.max, bound))
+        return self.max
+
+
+class HistogramMetrics(RemotingMetrics):
+    """
+    Keeps the measures of remoting services in memory, as histograms and
+    counters. It can be shared by services used from different threads.
+
+    :ivar histograms: the histograms of the measures, by name
+    :type histograms: `dict` of :class:`Histogram`
+    :ivar counters: the counters, by name
+    :type counters: `dict`
+
+    """
+
+    def __init__(self, precision=0.05):
+        self.precision = precision
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value):
+        self._lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.precision)
+            histogram.add(value)
+        finally:
+            self._lock.release()
+
+    def increment(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        Returns the statistics of each histogram, and the counters.
+
+        :return: the count, mean, min, max and `percentiles` (as `p50`,
+            `p90`...) of each histogram, and the value of each counter, by
+            name
+        :rtype: `dict`
+
+        """
+        self._lock.acquire()
+        try:
+            summary = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                stats = {'count': histogram.count,
+                         'mean': histogram.mean(),
+                         'min': histogram.min,
+                         'max': histogram.max}
+                for percent in percentiles:
+                    stats['p%s' % (percent,)] = \
+                        histogram.percentile(percent)
+                summary[name] = stats
+            return summary
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.histograms.clear()
+            self.counters.clear()
+        finally:
+            self._lock.release()
+
+
+class RemotingServiceBase(object):
+    """
+    Acts as a client for AMF calls.
+
+    :ivar requests: The pending requests to process.
+    :type requests: :class:`RequestQueue`
+    :ivar request_number: A unique identifier for tracking the number of
+        requests.
+    :ivar amf_version: The AMF version to use.
+        See :data:`ENCODING_TYPES <pyamf.ENCODING_TYPES>`.
+    :type amf_version: `int`
+    :ivar headers: A list of persistent headers to send with each request.
+        They are encoded once and the encoded form is reused until they
+        change.
+    :type headers: :class:`~pyamf.remoting.HeaderCollection`
+    :ivar strict: Whether to use strict AMF en/decoding or not.
+    :type strict: `bool`
+    :ivar batch_window: If not `None`, calls made through an auto executing
+        :class:`ServiceProxy` are not sent immediately, but coalesced with
+        the other calls made within this number of seconds and sent in one
+        envelope.
+    :type batch_window: `float`
+    :ivar max_batch_size: The maximum number of coalesced calls. The batch
+        is sent as soon as it reaches this size.
+    :type max_batch_size: `int`
+    :ivar max_batch_bytes: The maximum estimated encoded size in bytes of the
+        coalesced calls. The batch is sent as soon as it reaches this size.
+    :type max_batch_bytes: `int`
+    :ivar request_timeout: The default number of seconds after which calls
+        time out, or `None`. The time the calls wait in a batch counts.
+    :type request_timeout: `float`
+    :ivar result_cache: The cache of the results of the calls made with
+        `cached=True`, or `None` to not keep them. A cache should not be
+        shared by services of different gateways.
+    :type result_cache: :class:`ResultCache`
+    :ivar metrics: Receives the timings, sizes and error counts of the
+        envelopes. By default they are ignored.
+    :type metrics: :class:`RemotingMetrics`
+
+    """
+
+    def __init__(self, amf_version=pyamf.AMF0, strict=False, logger=None,
+                 batch_window=None, max_batch_size=None, max_batch_bytes=None,
+                 request_timeout=None, result_cache=None, metrics=None):
+        self.amf_version = amf_version
+
+        self.requests = RequestQueue()
+        self.request_number = 1
+        self.headers = remoting.HeaderCollection()
+        self._encoded_headers = None
+        self.strict = strict
+        self.logger = logger
+
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self._batch_bytes = 0
+        self._batch_call = None
+        self.request_timeout = request_timeout
+        self.result_cache = result_cache
+        # the pending cached requests, by cache key
+        self._flights = {}
+        # the requests whose result identical calls share, by the object
+        # that receives the result of the identical call
+        self._followers = {}
+        if metrics is None:
+            metrics = RemotingMetrics()
+        self.metrics = metrics
+
+    def addHeader(self, name, value, must_understand=False):
+        """
+        Sets a persistent AMF header to send with each request.
+
+        :param name: Header name.
+        :type name: `str`
+        :param must_understand: Default is `False`.
+        :type must_understand: `bool`
+
+        """
+        self.headers[name] = value
+        self.headers.set_required(name, must_understand)
+
+    def getService(self, name, auto_execute=True, timeout=None,
+                   idempotent=False, cached=False):
+        """
+        Returns a :class:`~ServiceProxy` for the supplied name. Sets up an
+        object that can have method calls made to it that build the AMF
+        requests.
+
+        :param auto_execute: Default is `True`.
+        :type auto_execute: `bool`
+        :param timeout: The number of seconds after which the calls made
+            through the proxy time out. Defaults to `request_timeout`.
+        :type timeout: `float`
+        :param idempotent: Whether the calls made through the proxy can
+            safely be sent again when it is unknown whether the gateway
+            received them.
+        :type idempotent: `bool`
+        :param cached: Whether the results of the calls made through the
+            proxy can be shared with identical calls.
+        :type cached: `bool`
+        :raise TypeError: `string` type required for `name`.
+        :rtype: :class:`ServiceProxy`
+
+        """
+        if not isinstance(name, basestring):
+            raise TypeError('string type required')
+
+        return ServiceProxy(self, name, auto_execute, timeout, idempotent,
+                            cached)
+
+    def addRequest(self, service, *args, **kwargs):
+        """
+        Adds a request to be sent to the remoting gateway.
+
+        :keyword timeout: The number of seconds after which the request
+            times out. Defaults to `request_timeout`.
+        :keyword idempotent: Whether the request can safely be sent again
+            when it is unknown whether the gateway received it.
+        :keyword cached: Whether the result can be shared with identical
+            calls, i.e. calls of the same service method with the same
+            encoded arguments. If an identical call is pending, no request
+            is added and the result of that call is shared. Otherwise, the
+            result is taken from `result_cache` if it is there, or stored in
+            it once received. Errors are not cached.
+        :return: a :class:`Deferred` that will callback when the invocation
+                 result is available
+
+        """
+        cache_key = None
+        if kwargs.get('cached'):
+            cache_key = self._getCacheKey(service, args)
+            shared = self._shareResult(cache_key)
+            if shared is not None:
+                return shared
+
+        timeout = kwargs.get('timeout')
+        if timeout is None:
+            timeout = self.request_timeout
+        deadline = None
+        if timeout is not None:
+            deadline = self.seconds() + timeout
+
+        request = RequestWrapper('/%d' % self.request_number, service, *args,
+                                 **{'deferred': self._createDeferred(),
+                                    'deadline': deadline,
+                                    'idempotent': kwargs.get('idempotent',
+                                                             False),
+                                    'cache_key': cache_key})
+
+        self.request_number += 1
+        self.requests.append(request)
+        if cache_key is not None:
+            self._flights[cache_key] = request
+
+        if self.max_batch_bytes is not None:
+            request.size = self._measureRequest(request)
+            self._batch_bytes += request.size
+
+        if self.logger:
+            self.logger.debug('Adding request %s%r', request.service, args)
+
+        return request.deferred
+
+    def removeRequest(self, deferred):
+        """
+        Removes a request from the pending request list.
+
+        :raise LookupError: Request not found.
+
+        """
+        try:
+            request = self.requests.getByDeferred(deferred)
+        except LookupError:
+            self._removeFollower(deferred)
+            return
+
+        if self.logger:
+            self.logger.debug('Removing request: %s', request)
+        self.requests.remove(request)
+        self._batch_bytes -= request.size
+
+        if request.followers:
+            # the identical calls still need the request
+            request.deferred = request.followers.pop(0)
+            del self._followers[request.deferred]
+            self.requests.append(request)
+            self._batch_bytes += request.size
+        elif request.cache_key is not None:
+            del self._flights[request.cache_key]
+
+    def _removeFollower(self, deferred):
+        request = self._followers.pop(deferred, None)
+        if request is None:
+            raise LookupError('Request not found')
+        request.followers.remove(deferred)
+
+    def _forgetFollowers(self, request):
+        if request.followers:
+            for deferred in request.followers:
+                self._followers.pop(deferred, None)
+
+    def _getCacheKey(self, service, args):
+        """
+        Returns the key of the result of a call in the result cache. The
+        persistent headers, such as the credentials, are part of the key, as
+        the result may depend on them.
+
+        """
+        body = pyamf.encode(list(args), encoding=self.amf_version)
+        return (str(service), self._getEncodedHeaders().data,
+                body.getvalue())
+
+    def _shareResult(self, cache_key):
+        """
+        Returns the object that receives the result of a call identical to a
+        pending or cached one, or `None` if there is none.
+
+        """
+        request = self._flights.get(cache_key)
+        if request is not None and not self._isDelivered(request):
+            if self.logger:
+                self.logger.debug('Sharing the result of request %s',
+                                  request.id)
+            deferred = self._createDeferred()
+            if request.followers is None:
+                request.followers = []
+            request.followers.append(deferred)
+            self._followers[deferred] = request
+            return deferred
+
+        if self.result_cache is not None:
+            result = self.result_cache.get(cache_key, _MISSING)
+            if result is not _MISSING:
+                deferred = self._createDeferred()
+                self._fireResult(deferred, result)
+                return deferred
+        return None
+
+    def _measureRequest(self, request):
+        """
+        Returns the estimated encoded size of a request in bytes.
+
+        """
+        body = pyamf.encode(list(request.args), encoding=self.amf_version)
+        return len(body.getvalue()) + len(str(request.service)) + \
+            len(request.id)
+
+    def _takeRequests(self):
+        """
+        Removes all the pending requests, so that they can be sent in one
+        envelope. Cancels the pending coalesced execution, if any.
+
+        :rtype: `list`
+
+        """
+        if self._batch_call is not None:
+            self._batch_call.cancel()
+            self._batch_call = None
+
+        requests = list(self.requests)
+        self.requests = RequestQueue()
+        self._batch_bytes = 0
+        return requests
+
+    def _batchReady(self):
+        """
+        Returns whether the pending requests should be sent now, rather
+        than at the end of the batch window.
+
+        """
+        return (self.batch_window is None or
+                (self.max_batch_size is not None and
+                 len(self.requests) >= self.max_batch_size) or
+                (self.max_batch_bytes is not None and
+                 self._batch_bytes >= self.max_batch_bytes))
+
+    def _autoExecute(self, deferred):
+        """
+        Called when a request was added by an auto executing
+        :class:`ServiceProxy`. Executes the pending requests immediately, or
+        schedules their execution at the end of the batch window.
+
+        :param deferred: the object that receives the result of the request
+        :return: what the call of the service method returns, `deferred`
+
+        """
+        if not self.requests:
+            # the result was shared with another call
+            return deferred
+        if self._batchReady():
+            self.execute()
+        elif self._batch_call is None:
+            self._batch_call = self.callLater(self.batch_window,
+                                              self._executeBatch)
+        return deferred
+
+    def _executeBatch(self):
+        self._batch_call = None
+        if self.requests:
+            self.execute()
+
+    def callLater(self, delay, func, *args):
+        """
+        Schedules a call to `func` in `delay` seconds.
+
+        :return: an object with a `cancel` method, like
+            :class:`~twisted.internet.interfaces.IDelayedCall`
+
+        """
+        raise NotImplementedError
+
+    def seconds(self):
+        """
+        Returns the current time in seconds since the epoch.
+
+        """
+        return time.time()
+
+    def _createDeferred(self):
+        """
+        Returns the object that receives the result of a new request. A
+        :class:`~twisted.internet.defer.Deferred` by default.
+
+        """
+        from twisted.internet.defer import Deferred
+        return Deferred()
+
+    def _fireResult(self, deferred, result):
+        deferred.callback(result)
+
+    def _fireError(self, deferred, error):
+        deferred.errback(error)
+
+    def _isFired(self, deferred):
+        return deferred.called
+
+    def _getResultObjects(self, request):
+        """
+        Returns the objects that receive the result of a request.
+
+        """
+        if request.followers:
+            return [request.deferred] + request.followers
+        return [request.deferred]
+
+    def _deliverResult(self, request, result):
+        if request.cache_key is not None:
+            if self._flights.get(request.cache_key) is request:
+                del self._flights[request.cache_key]
+            self._forgetFollowers(request)
+            if self.result_cache is not None:
+                self.result_cache.put(request.cache_key, result)
+        for deferred in self._getResultObjects(request):
+            if not self._isFired(deferred):
+                self._fireResult(deferred, result)
+
+    def _deliverError(self, request, error):
+        """
+        :param error: an exception or a
+            :class:`~twisted.python.failure.Failure`
+
+        """
+        self.metrics.increment('errors')
+        if request.cache_key is not None:
+            if self._flights.get(request.cache_key) is request:
+                del self._flights[request.cache_key]
+            self._forgetFollowers(request)
+        for deferred in self._getResultObjects(request):
+            if not self._isFired(deferred):
+                self._fireError(deferred, error)
+
+    def _isDelivered(self, request):
+        """
+        Returns whether no object awaits the result of the request any more.
+
+        """
+        for deferred in self._getResultObjects(request):
+            if not self._isFired(deferred):
+                return False
+        return True
+
+    def _createAMFRequest(self, requests, deadline=None):
+        """
+        Builds an AMF request :class:`~pyamf.remoting.Envelope` from the
+        stored list of requests. If the envelope has a deadline, the number
+        of seconds left is sent in a `DSRequestTimeout` header.
+
+        :param deadline: the deadline of the whole envelope, if any
+        :rtype: :class:`~pyamf.remoting.Envelope`
+
+        """
+        envelope = remoting.Envelope(self.amf_version)
+
+        if self.logger:
+            self.logger.debug('AMF version: %s', self.amf_version)
+
+        # request ids are unique, so the bodies are appended directly instead
+        # of through Envelope.__setitem__, which scans the existing bodies
+        for request in requests:
+            message = remoting.Request(str(request.service),
+                                       list(request.args))
+            message.envelope = envelope
+            envelope.bodies.append((request.id, message))
+
+        envelope.headers = self.headers
+
+        deadline = self._getDeadline(requests, deadline)
+        if deadline is not None:
+            headers = remoting.HeaderCollection()
+            headers.update(self.headers)
+            headers.required = list(self.headers.required)
+            headers[REQUEST_TIMEOUT.value] = max(0,
+                int(math.ceil(deadline - self.seconds())))
+            envelope.headers = headers
+
+        return envelope
+
+    def _encodeAMFRequest(self, requests, deadline=None):
+        """
+        Builds the AMF request envelope for the requests, and encodes it
+        with the cached encoded form of the persistent headers.
+
+        :param deadline: the deadline of the whole envelope, if any
+        :return: an iterator over the pieces of the encoded envelope
+        :see: :func:`iter_encode`
+
+        """
+        return iter_encode(self._createAMFRequest(requests, deadline),
+                           self.strict, self._getEncodedHeaders())
+
+    def _recordEnvelope(self, requests, encode_time):
+        metrics = self.metrics
+        metrics.increment('envelopes')
+        metrics.increment('requests', len(requests))
+        metrics.observe('batch_size', len(requests))
+        metrics.observe('encode', encode_time)
+
+    def _getEncodedHeaders(self):
+        """
+        Returns the persistent headers in encoded form. They are only
+        encoded again after they changed.
+
+        :return: the encoded headers, or `None` if the installed PyAMF
+            cannot encode headers separately
+        :rtype: :class:`EncodedHeaders`
+
+        """
+        if _write_header is None:
+            return None
+        encoded = self._encoded_headers
+        if (encoded is None or
+            not encoded.matches(self.headers, self.amf_version, self.strict)):
+            encoded = EncodedHeaders(self.headers, self.amf_version,
+                                     self.strict)
+            self._encoded_headers = encoded
+        return encoded
+
+    def _getDeadline(self, requests, deadline=None):
+        """
+        Returns the earliest of `deadline` and the deadlines of the requests
+        that still await their result, or `None` if there is none.
+
+        """
+        for request in requests:
+            if request.deadline is None or self._isDelivered(request):
+                continue
+            if deadline is None or request.deadline < deadline:
+                deadline = request.deadline
+        return deadline
+
+    def _handleAMFResponse(self, envelope, requests):
+        """
+        Handles the AMF response from the server.
+
+        :type response: :class:`~pyamf.remoting.Envelope`
+
+        """
+        if self.logger:
+            self.logger.debug('Response: %s' % envelope)
+
+        self._handleAMFHeaders(envelope)
+
+        pending = dict([(request.id, request) for request in requests])
+        for request_id, response in envelope.iteritems():
+            self._dispatchResponse(pending, request_id, response)
+        self._handleMissingResponses(pending)
+
+    def _handleAMFHeaders(self, envelope):
+        """
+        Handles the headers of the AMF response, before any body.
+
+        :type response: :class:`~pyamf.remoting.Envelope`
+
+        """
+        if remoting.REQUEST_PERSISTENT_HEADER in envelope.headers:
+            data = envelope.headers[remoting.REQUEST_PERSISTENT_HEADER]
+            for k, v in data.items():
+                self.headers[k] = v
+
+    def _dispatchResponse(self, pending, request_id, response):
+        """
+        Fires the :class:`Deferred` of the request answered by `response`.
+
+        :param pending: the requests that are not answered yet, by id
+        :type pending: `dict`
+
+        """
+        request = pending.pop(request_id, None)
+        if request is None or self._isDelivered(request):
+            # the request may have timed out or been cancelled
+            return
+        start = self.seconds()
+        if response.status == remoting.STATUS_OK:
+            self._deliverResult(request, response.body)
+        elif response.status == remoting.STATUS_ERROR:
+            self._deliverError(request, self._getFaultError(response.body))
+        self.metrics.observe('dispatch', self.seconds() - start)
+
+    def _getFaultError(self, fault):
+        """
+        Returns the exception for the error returned by the gateway.
+
+        :param fault: an :class:`~pyamf.remoting.ErrorFault`, or a Flex
+            :class:`~plasma.flex.messaging.messages.ErrorMessage`
+
+        """
+        if hasattr(fault, 'faultCode'):
+            exc_class = pyamf.ERROR_CLASS_MAP.get(fault.faultCode,
+                                                  remoting.RemotingError)
+            return exc_class(fault.faultString)
+        exc_class = get_exception_from_fault(fault)
+        return exc_class(fault.description)
+
+    def _handleMissingResponses(self, pending):
+        for request in pending.values():
+            if self._isDelivered(request):
+                continue
+            self._deliverError(request, remoting.RemotingError(
+                'No response received for request %s' % request.id))
+
+    def _handleAMFError(self, failure, requests):
+        # some requests may have been answered before the error occurred
+        for request in requests:
+            if not self._isDelivered(request):
+                self._deliverError(request, failure)
+
+    def execute(self):
+        """
+        Builds, sends and handles the responses to all requests listed in
+        `self.requests`.
+
+        """
+        raise NotImplementedError
+
+    def setCredentials(self, username, password):
+        """
+        Sets authentication credentials for accessing the remote gateway.
+
+        """
+        self.addHeader('Credentials', dict(userid=unicode(username),
+            password=unicode(password)), True)
+
+
+class EncodedHeaders(object):
+    """
+    The headers of remoting envelopes in encoded form, so that headers sent
+    with every envelope are not encoded again for each of them.
+
+    A copy of the headers is kept, so that :meth:`matches` can tell whether
+    the encoded form is still up to date, even if the values were changed
+    in place.
+
+    :ivar names: the names of the encoded headers
+    :type names: `frozenset`
+    :ivar data: the encoded headers
+    :type data: `str`
+
+    .. seealso:: :func:`iter_encode`
+
+    """
+
+    def __init__(self, headers, amf_version=pyamf.AMF0, strict=False):
+        """
+        :type headers: :class:`~pyamf.remoting.HeaderCollection`
+
+        """
+        self.names = frozenset(headers.keys())
+        self.amf_version = amf_version
+        self.strict = strict
+        self._required = frozenset(headers.required)
+        try:
+            self._values = copy.deepcopy(dict(headers))
+        except Exception:
+            # the headers cannot be compared later
+            self._values = None
+
+        stream = util.BufferedByteStream()
+        encoder = pyamf.get_encoder(pyamf.AMF0, stream, strict=strict)
+        encoder.use_amf3 = amf_version == pyamf.AMF3
+        for name, header in headers.items():
+            _write_header(name, header, int(headers.is_required(name)),
+                          stream, encoder, strict)
+        self.data = stream.getvalue()
+
+    def __len__(self):
+        return len(self.names)
+
+    def matches(self, headers, amf_version=pyamf.AMF0, strict=False):
+        """
+        Returns whether these are the encoded form of `headers`.
+
+        :type headers: :class:`~pyamf.remoting.HeaderCollection`
+
+        """
+        if (self._values is None or amf_version != self.amf_version or
+            strict != self.strict or
+            frozenset(headers.required) != self._required):
+            return False
+        try:
+            return bool(self._values == headers)
+        except Exception:
+            return False
+
+
+def iter_encode(envelope, strict=False, encoded_headers=None):
+    """
+    Encodes a remoting envelope piece by piece. The first piece holds the
+    preamble and the headers, every following piece holds one body, so only
+    one body is held in encoded form at a time.
+
+    The concatenated pieces are the same as the output of
+    :func:`pyamf.remoting.encode`, except that the headers of
+    `encoded_headers` come first. If the installed PyAMF cannot encode the
+    bodies one at a time, the whole envelope is a single piece.
+
+    :type envelope: :class:`~pyamf.remoting.Envelope`
+    :param encoded_headers: headers of the envelope that are already
+        encoded, with the same AMF version and `strict` setting. They are
+        written as they are, and only the other headers are encoded. They
+        are ignored if the envelope does not have all of them, or if any
+        other header could be encoded as a reference: the decoder reads all
+        the headers with the same references, which the encoded headers do
+        not share.
+    :type encoded_headers: :class:`EncodedHeaders`
+    :return: an iterator over the encoded pieces
+    """
+    if _write_header is None or _write_body is None:
+        yield remoting.encode(envelope, strict=strict).getvalue()
+        return
+
+    amf3 = envelope.amfVersion == pyamf.AMF3
+    stream = util.BufferedByteStream()
+    encoder = pyamf.get_encoder(pyamf.AMF0, stream, strict=strict)
+    encoder.use_amf3 = amf3
+
+    headers = envelope.headers
+    encoded = frozenset()
+    if (encoded_headers is not None and
+        encoded_headers.names.issubset(headers.keys())):
+        encoded = encoded_headers.names
+        for name, header in headers.items():
+            if name not in encoded and not _isScalar(header, amf3):
+                encoded = frozenset()
+                break
+    others = [(name, header) for name, header in headers.items()
+              if name not in encoded]
+
+    stream.write_ushort(envelope.amfVersion)
+    stream.write_ushort(len(encoded) + len(others))
+    if encoded:
+        stream.write(encoded_headers.data)
+    for name, header in others:
+        _write_header(name, header, int(headers.is_required(name)), stream,
+                      encoder, strict)
+    stream.write_short(len(envelope))
+
+    for name, message in envelope.iteritems():
+        yield stream.getvalue()
+        stream.truncate()
+        encoder.context.clear()
+        _write_body(name, message, stream, encoder, strict)
+    yield stream.getvalue()
+
+
+def _isScalar(value, amf3=False):
+    """
+    Returns whether `value` is encoded without references. Strings are
+    only referenced in AMF3.
+
+    """
+    if isinstance(value, _SCALAR_TYPES):
+        return True
+    return not amf3 and isinstance(value, basestring)
+
+
+def gzip_pieces(pieces, level=6):
+    """
+    Compresses the pieces of an encoded envelope into the gzip format.
+
+    :return: an iterator over the compressed pieces
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for piece in pieces:
+        data = compressor.compress(piece)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class EnvelopeDecoder(object):
+    """
+    Decodes a remoting response envelope incrementally, as its bytes arrive.
+
+    The headers are decoded together and passed to `headers_received` in an
+    :class:`~pyamf.remoting.Envelope` without bodies. Each body is passed to
+    `body_received`, with its target, as soon as it has been decoded. Its
+    bytes are then dropped from the buffer.
+
+    An incomplete element is decoded again when more bytes arrive. If the
+    envelope declares the length of a body, the decoder waits for all of it.
+    Otherwise it waits until the buffered bytes of the element have doubled,
+    which keeps the total cost of the attempts linear in the size of the
+    response.
+
+    :ivar envelope: the decoded envelope, without its bodies
+    :type envelope: :class:`~pyamf.remoting.Envelope`
+    :ivar complete: whether all the bodies have been decoded
+    :type complete: `bool`
+
+    """
+
+    def __init__(self, headers_received, body_received, strict=False,
+                 logger=None):
+        self.headers_received = headers_received
+        self.body_received = body_received
+        self.strict = strict
+        self.logger = logger
+
+        self.envelope = remoting.Envelope()
+        self.stream = util.BufferedByteStream()
+        self.decoder = None
+        self.complete = False
+
+        self._read = self._readPreamble
+        self._header_count = 0
+        self._body_count = 0
+        self._needed = 0
+
+    def feed(self, data):
+        """
+        Decodes as much of the envelope as possible after adding `data` to
+        the buffer.
+
+        :raise DecodeError: The data is not a valid envelope.
+
+        """
+        stream = self.stream
+        pos = stream.tell()
+        stream.seek(0, 2)
+        stream.write(data)
+        stream.seek(pos)
+
+        if not self.complete and stream.remaining() >= self._needed:
+            self._decode()
+
+    def finish(self):
+        """
+        Called when all the bytes of the response have been fed.
+
+        :raise DecodeError: The envelope is incomplete.
+
+        """
+        if not self.complete:
+            self._needed = 0
+            self._decode()
+        if not self.complete:
+            raise pyamf.DecodeError('Incomplete remoting envelope')
+
+    def _decode(self):
+        stream = self.stream
+        while not self.complete:
+            start = stream.tell()
+            try:
+                self._read()
+            except (IOError, pyamf.EOStream):
+                stream.seek(start)
+                self._needed = max(self._declaredLength(),
+                                   2 * stream.remaining())
+                return
+            self._needed = 0
+
+    def _declaredLength(self):
+        """
+        Returns the length of the body at the current position of the stream
+        if the envelope declares it, 0 otherwise.
+
+        """
+        if self._read != self._readBody:
+            return 0
+
+        stream = self.stream
+        start = stream.tell()
+        try:
+            stream.seek(stream.read_ushort(), 1)
+            stream.seek(stream.read_ushort(), 1)
+            length = stream.read_ulong()
+            end = stream.tell()
+        except IOError:
+            length = 0
+        stream.seek(start)
+
+        if length in (0, 0xffffffff):
+            return 0
+        return end - start + length
+
+    def _readPreamble(self):
+        stream = self.stream
+        amf_version = stream.read_ushort()
+        if amf_version > 0x09:
+            raise pyamf.DecodeError('Malformed stream (amfVersion=%d)' %
+                                    amf_version)
+        self._header_count = stream.read_ushort()
+
+        self.envelope.amfVersion = amf_version
+        self.decoder = pyamf.get_decoder(pyamf.AMF0, stream,
+                                         strict=self.strict)
+        self.decoder.use_amf3 = amf_version == pyamf.AMF3
+        self._read = self._readHeaders
+
+    def _readHeaders(self):
+        # the headers share a decoding context, so they are decoded together
+        self.decoder.context.clear()
+        headers = [remoting._read_header(self.stream, self.decoder,
+                                         self.strict)
+                   for i in range(self._header_count)]
+        self._body_count = self.stream.read_short()
+
+        for name, required, data in headers:
+            self.envelope.headers[name] = data
+            if required:
+                self.envelope.headers.set_required(name)
+        self.stream.consume()
+
+        if self._body_count <= 0:
+            self.complete = True
+        else:
+            self._read = self._readBody
+        self.headers_received(self.envelope)
+
+    def _readBody(self):
+        self.decoder.context.clear()
+        target, message = remoting._read_body(self.stream, self.decoder,
+                                              self.strict, self.logger)
+        self.stream.consume()
+
+        self._body_count -= 1
+        if self._body_count == 0:
+            self.complete = True
+        self.body_received(target, message)
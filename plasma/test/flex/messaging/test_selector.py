@@ -1,6 +1,17 @@
-from nose.tools import raises
+import os
+import shutil
+import tempfile
+import threading
 
-from plasma.flex.messaging.selector.parser import evaluate
+from nose.tools import raises
+from nose.plugins.skip import SkipTest
+
+from plasma.flex.messaging.selector.parser import (evaluate, compile,
+    Selector, LazyVariables)
+from plasma.flex.messaging.selector.cache import SelectorCache
+from plasma.flex.messaging.selector.matcher import (compile_pattern, Matcher,
+    Pattern, MAX_CACHED_PATTERNS)
+from plasma.flex.messaging.selector import parser, sql92grammar, matcher
 from plasma.flex.messaging.selector import (LexerError, IncompatibleTypeError,
     UnknownVariableError, ParseError)
 
@@ -133,6 +144,19 @@ class TestLogicalOperators(object):
         vars['var1'] = False
         assert not evaluate('var1 or var2', vars)
 
+    def test_short_circuit(self):
+        assert not evaluate('false and undefined')
+        assert evaluate('true or undefined')
+        assert not evaluate("1 = 2 and (undefined like 'x')")
+
+    @raises(UnknownVariableError)
+    def test_no_short_circuit(self):
+        evaluate('true and undefined')
+
+    @raises(IncompatibleTypeError)
+    def test_short_circuit_invalid_left_operand(self):
+        evaluate('1 or true')
+
     def test_or_numbers(self):
         assert evaluate('2 + 5 = 8 or 3 + 6 = 9')
         assert not evaluate('7 + 0 = 8 or 4 - 3 = 2')
@@ -217,7 +241,246 @@ class TestLike(object):
         assert evaluate("var1 not like '%stringe'", vars)
         assert evaluate("var1 not like ' my str%'", vars)
 
+    def test_like_repeated_segment(self):
+        assert evaluate("'abab' like '%ab'")
+        assert evaluate("'aXbXc' like 'a%b%c'")
+        assert not evaluate("'aXbXc' like 'a%c%b'")
+
+    def test_like_variable_pattern(self):
+        vars = {'var1': 'my test string', 'var2': '%test%'}
+        assert evaluate('var1 like var2', vars)
+        vars['var2'] = 'test%'
+        assert not evaluate('var1 like var2', vars)
+
     @raises(IncompatibleTypeError)
     def test_invalid_not_like_operands(self):
         vars = {'var1': 'text', 'var2': 0}
         evaluate('var1 not like var2', vars)
+
+
+class TestCompile(object):
+    def test_compile(self):
+        selector = compile("region = 'EU' and priority > 3")
+        assert isinstance(selector, Selector)
+        assert selector.expression == "region = 'EU' and priority > 3"
+
+    def test_reuse(self):
+        selector = compile("region = 'EU' and priority > 3")
+        assert selector.matches({'region': 'EU', 'priority': 5})
+        assert not selector.matches({'region': 'EU', 'priority': 1})
+        assert not selector.matches({'region': 'US', 'priority': 5})
+
+    def test_matches_non_boolean(self):
+        selector = compile('1 + 2')
+        assert selector.evaluate() == 3
+        assert selector.matches() is False
+
+    @raises(ParseError)
+    def test_compile_syntax_error(self):
+        compile('2 > > 2')
+
+    @raises(UnknownVariableError)
+    def test_undefined_variable(self):
+        compile('var1 = 1').matches({'var2': 1})
+
+
+class TestSelectorCache(object):
+    def test_hit_miss(self):
+        cache = SelectorCache()
+        assert cache.get('a = 1') is None
+        cache.put('a = 1', 'compiled')
+        assert cache.get('a = 1') == 'compiled'
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_eviction(self):
+        cache = SelectorCache(maxsize=2)
+        cache.put('a = 1', 1)
+        cache.put('a = 2', 2)
+        cache.get('a = 1')
+        cache.put('a = 3', 3)
+        assert len(cache) == 2
+        assert 'a = 1' in cache
+        assert 'a = 2' not in cache
+        assert 'a = 3' in cache
+
+    def test_disabled(self):
+        cache = SelectorCache(maxsize=0)
+        cache.put('a = 1', 1)
+        assert len(cache) == 0
+        assert cache.get('a = 1') is None
+
+    def test_clear(self):
+        cache = SelectorCache()
+        cache.put('a = 1', 1)
+        cache.get('a = 1')
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.hits == 0
+        assert cache.get('a = 1') is None
+
+    def test_compile_uses_cache(self):
+        expression = "region = 'EU' and priority > 3"
+        parser.cache.clear()
+        first = compile(expression)
+        second = compile(expression)
+        assert first is second
+        assert parser.cache.hits == 1
+        assert parser.cache.misses == 1
+
+
+class TestPattern(object):
+    def test_shapes(self):
+        cases = [
+            ('', '', True), ('', 'a', False),
+            ('abc', 'abc', True), ('abc', 'abcd', False),
+            ('abc%', 'abcdef', True), ('abc%', 'xabc', False),
+            ('%abc', 'xxabc', True), ('%abc', 'abcx', False),
+            ('%abc%', 'xabcx', True), ('%abc%', 'ab', False),
+            ('%', '', True), ('%%', 'x', True),
+            ('___', 'abc', True), ('___', 'ab', False),
+            ('a_c%', 'abcd', True), ('a_c%', 'acd', False),
+            ('%.*%', 'x.*x', True), ('%.*%', 'xx', False),
+            ('a%', 'a\nb', True), ('_', '\n', True),
+        ]
+        for pattern, source, expected in cases:
+            result = compile_pattern(pattern).matches(source)
+            assert result == expected, (pattern, source)
+
+    def test_escape(self):
+        assert compile_pattern('100\\%').matches('100%')
+        assert not compile_pattern('100\\%').matches('1000')
+        assert compile_pattern('a*_b', '*').matches('a_b')
+        assert not compile_pattern('a*_b', '*').matches('axb')
+        # escape characters that do not precede a wildcard are literal
+        assert compile_pattern('a\\nb%').matches('a\\nbc')
+
+    def test_cached(self):
+        assert compile_pattern('abc%') is compile_pattern('abc%')
+        assert compile_pattern('abc%') is not compile_pattern('abc%', '*')
+        assert isinstance(compile_pattern('abc%'), Pattern)
+
+    def test_cache_evicts_least_recent(self):
+        compiled = compile_pattern('abc%')
+        for i in range(MAX_CACHED_PATTERNS):
+            compile_pattern('pattern %d' % (i,))
+            # the pattern stays cached while it is being used
+            assert compile_pattern('abc%') is compiled
+        assert len(matcher._cache) == MAX_CACHED_PATTERNS
+
+    def test_matcher(self):
+        assert Matcher('my test string', '%est%', '\\').matches()
+        assert not Matcher('my test string', 'est', '\\').matches()
+
+
+class TestConcurrency(object):
+    def _run(self, target, count=8):
+        errors = []
+        def run(n):
+            try:
+                target(n)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(n,))
+                   for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors, errors
+
+    def test_concurrent_evaluation(self):
+        selector = compile('var1 = var2 and var1 >= 0')
+        def target(n):
+            for i in range(500):
+                assert selector.matches({'var1': n + i, 'var2': n + i})
+                assert not selector.matches({'var1': n, 'var2': n + 1})
+        self._run(target)
+
+    def test_concurrent_compile(self):
+        parser.cache.clear()
+        def target(n):
+            for i in range(50):
+                vars = {'var1': n * 1000 + i}
+                assert evaluate('var1 = %d' % (n * 1000 + i,), vars)
+        self._run(target)
+
+
+class TestLazyVariables(object):
+    def setup(self):
+        self.fetched = []
+        self.headers = {'region': 'EU', 'priority': 5}
+
+    def getter(self, name):
+        self.fetched.append(name)
+        return self.headers[name]
+
+    def test_only_needed_variables(self):
+        selector = compile("region = 'US' and priority > 3")
+        assert not selector.matches(self.getter)
+        assert self.fetched == ['region']
+
+    def test_fetched_once(self):
+        selector = compile("priority > 3 and priority < 6 and "
+                           "(region in ('EU', 'US'))")
+        assert selector.matches(self.getter)
+        assert self.fetched == ['priority', 'region']
+
+    def test_is_null(self):
+        assert compile('missing is null').matches(self.getter)
+        assert compile('region is not null').matches(self.getter)
+
+    @raises(UnknownVariableError)
+    def test_undefined_variable(self):
+        compile('missing = 1').matches(self.getter)
+
+    def test_mapping(self):
+        variables = LazyVariables(self.getter)
+        assert variables['region'] == 'EU'
+        assert variables['region'] == 'EU'
+        assert 'missing' not in variables
+        assert 'missing' not in variables
+        assert self.fetched == ['region', 'missing']
+
+    def test_in_stops_at_match(self):
+        selector = compile("'EU' in (region, other)")
+        assert selector.matches(self.getter)
+        assert self.fetched == ['region']
+
+
+class TestBuild(object):
+    def setup(self):
+        self.lexer = parser._lexer
+        self.parser = parser._parser
+        self.tempdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        parser._lexer = self.lexer
+        parser._parser = self.parser
+        shutil.rmtree(self.tempdir)
+
+    def test_lazy_build(self):
+        parser._lexer = parser._parser = None
+        assert evaluate('1 < 2')
+        assert parser._parser is not None
+
+    def test_picklefile(self):
+        picklefile = os.path.join(self.tempdir, 'sql92tab.pickle')
+        parser.build(picklefile)
+        assert os.path.exists(picklefile)
+        parser.build(picklefile)
+        assert evaluate("'abc' like 'a%'")
+
+    def test_shipped_tables_up_to_date(self):
+        from ply import yacc
+        from plasma.flex.messaging.selector import sql92tab
+
+        if sql92tab._tabversion != yacc.__tabversion__:
+            raise SkipTest('tables were generated by another ply version')
+
+        pdict = dict([(k, getattr(sql92grammar, k))
+                      for k in dir(sql92grammar)])
+        pinfo = yacc.ParserReflect(pdict, log=yacc.NullLogger())
+        pinfo.get_all()
+        assert pinfo.signature() == sql92tab._lr_signature, (
+            'Regenerate the tables with parser.build(write_tables=True)')
@@ -0,0 +1,76 @@
+from nose.tools import eq_, raises
+
+from plasma.flex.messaging.selector.analysis import (analyze, Equals, OneOf,
+    Range, Null, NotNull)
+from plasma.flex.messaging.selector.parser import compile
+from plasma.flex.messaging.selector import ParseError
+
+
+class TestAnalyze(object):
+    def test_equals(self):
+        analysis = analyze("region = 'EU'")
+        eq_(analysis.constraints, [Equals('region', 'EU')])
+        assert analysis.exact()
+
+    def test_swapped_operands(self):
+        eq_(analyze("'EU' = region").constraints, [Equals('region', 'EU')])
+        eq_(analyze('3 < priority').constraints,
+            [Range('priority', low=3, low_inclusive=False)])
+
+    def test_one_of(self):
+        eq_(analyze("region in ('EU', 'US')").constraints,
+            [OneOf('region', ['EU', 'US'])])
+
+    def test_ranges(self):
+        eq_(analyze('priority between 2 and 4').constraints,
+            [Range('priority', 2, 4)])
+        eq_(analyze('priority >= 2').constraints, [Range('priority', low=2)])
+        eq_(analyze('priority < 2').constraints,
+            [Range('priority', high=2, high_inclusive=False)])
+        eq_(analyze('priority <= 2').constraints, [Range('priority', high=2)])
+
+    def test_null(self):
+        eq_(analyze('region is null').constraints, [Null('region')])
+        eq_(analyze('region is not null').constraints, [NotNull('region')])
+
+    def test_conjunction(self):
+        analysis = analyze("region = 'EU' and priority > 3 and "
+                           "(name like 'a%') and ttl is not null")
+        eq_(analysis.constraints, [
+            Equals('region', 'EU'),
+            Range('priority', low=3, low_inclusive=False),
+            NotNull('ttl')])
+        assert not analysis.exact()
+        eq_(analysis.variables(), set(['region', 'priority', 'ttl']))
+        eq_(analysis.constraints_for('priority'),
+            [Range('priority', low=3, low_inclusive=False)])
+        assert analysis.residual.evaluate({'name': 'abc'})
+        assert not analysis.residual.evaluate({'name': 'xyz'})
+
+    def test_not_constraints(self):
+        for expression in ["region <> 'EU'", "region not in ('EU')",
+                           "region = 'EU' or priority > 3",
+                           'priority not between 1 and 2',
+                           'priority * 2 > 3', 'a = b']:
+            analysis = analyze(expression)
+            eq_(analysis.constraints, [])
+            assert analysis.residual is analysis.selector.tree
+
+    def test_compiled_selector(self):
+        selector = compile("region = 'EU'")
+        assert analyze(selector).selector is selector
+
+    @raises(ParseError)
+    def test_invalid_expression(self):
+        analyze('2 > > 2')
+
+
+class TestRange(object):
+    def test_contains(self):
+        assert Range('x', 1, 3).contains(1)
+        assert Range('x', 1, 3).contains(3)
+        assert not Range('x', 1, 3, low_inclusive=False).contains(1)
+        assert not Range('x', 1, 3, high_inclusive=False).contains(3)
+        assert Range('x', low=1).contains(10 ** 10)
+        assert Range('x', high=1).contains(-10 ** 10)
+        assert not Range('x', high=1).contains(2)
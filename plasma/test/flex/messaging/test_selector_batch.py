@@ -0,0 +1,243 @@
+import random
+
+from nose.tools import eq_, raises
+from nose.plugins.skip import SkipTest
+
+from plasma.flex.messaging.selector.parser import compile, evaluate_columns
+from plasma.flex.messaging.selector.index import SelectorIndex
+from plasma.flex.messaging.selector import UnknownVariableError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+EXPRESSIONS = [
+    "region = 'EU'",
+    "region <> 'EU' and priority > 3",
+    "region in ('EU', 'US') or priority <= 1",
+    "region not in ('EU', 'US')",
+    "priority between 2 and 5",
+    "priority not between 2 and 5",
+    "priority * 2 + 1 = 7",
+    "-priority < -3",
+    "name like 'a%c'",
+    "name not like '%b_'",
+    "ratio >= 0.5 and (priority - 1) / 2 >= 1",
+]
+
+
+def _columns(size, seed=0):
+    rnd = random.Random(seed)
+    return {
+        'region': [rnd.choice(['EU', 'US', 'APAC']) for x in range(size)],
+        'priority': [rnd.randint(0, 7) for x in range(size)],
+        'ratio': [rnd.random() for x in range(size)],
+        'name': [rnd.choice(['abc', 'ac', 'abd', 'xbz']) for x in range(size)],
+    }
+
+
+def _rows(columns, size):
+    # None marks a missing header
+    return [dict([(name, column[i]) for name, column in columns.items()
+                  if column[i] is not None])
+            for i in range(size)]
+
+
+def _number(rnd, depth):
+    choice = rnd.randint(0, depth > 0 and 3 or 1)
+    if choice == 0:
+        return rnd.choice(['a', 'b'])
+    elif choice == 1:
+        return str(rnd.randint(0, 3))
+    elif choice == 2:
+        return '(%s %s %s)' % (_number(rnd, depth - 1), rnd.choice('+-*/'),
+                               _number(rnd, depth - 1))
+    return '-(%s)' % (_number(rnd, depth - 1),)
+
+
+def _condition(rnd, depth):
+    """
+    Returns a random boolean expression over the headers `a` and `b`
+    (numbers), `s` (a string) and `f` (a boolean).
+    """
+    negated = rnd.choice(['', 'NOT '])
+    choice = rnd.randint(0, depth > 0 and 7 or 5)
+    if choice == 0:
+        return '%s %s %s' % (_number(rnd, depth), rnd.choice(['>', '>=',
+                             '<', '<=']), _number(rnd, depth))
+    elif choice == 1:
+        operands = [_number(rnd, depth), 's', "'ab'"]
+        return '%s %s %s' % (rnd.choice(operands), rnd.choice(['=', '<>']),
+                             rnd.choice(operands))
+    elif choice == 2:
+        return "s %sLIKE '%s'" % (negated, rnd.choice(['a%', '%b', '_b']))
+    elif choice == 3:
+        bounds = ['a', 'b', '1', '2']
+        return '%s %sBETWEEN %s AND %s' % (_number(rnd, depth), negated,
+                                          rnd.choice(bounds),
+                                          rnd.choice(bounds))
+    elif choice == 4:
+        items = [rnd.choice(['a', 'b', '1', '2', "'ab'"])
+                 for i in range(rnd.randint(1, 3))]
+        return '%s %sIN (%s)' % (rnd.choice(['a', 's']), negated,
+                                 ', '.join(items))
+    elif choice == 5:
+        return rnd.choice(['f', 'a IS NULL', 'b IS NOT NULL', 'f = a'])
+    return '(%s) %s (%s)' % (_condition(rnd, depth - 1),
+                             rnd.choice(['AND', 'OR']),
+                             _condition(rnd, depth - 1))
+
+
+def _sparse_columns(size, rnd):
+    """
+    Returns columns in which about a third of the headers are missing, and
+    some have the wrong type.
+    """
+    values = {
+        'a': [0, 1, 2, 3, 'x'],
+        'b': [0, 1, 2, 2.5],
+        's': ['ab', 'ba', 'bb', 3],
+        'f': [True, False],
+    }
+    columns = {}
+    for name, choices in values.items():
+        columns[name] = [rnd.choice(choices) for i in range(size)]
+        for i in range(size):
+            if rnd.random() < 0.3:
+                columns[name][i] = None
+    return columns
+
+
+class TestListColumns(object):
+    def test_same_as_evaluation(self):
+        columns = _columns(100)
+        rows = _rows(columns, 100)
+        for expression in EXPRESSIONS:
+            selector = compile(expression)
+            expected = [selector.matches(row) for row in rows]
+            eq_(evaluate_columns(expression, columns), expected)
+
+    def test_nulls(self):
+        columns = {'region': ['EU', None, 'US'], 'priority': [1, 5, None]}
+        eq_(evaluate_columns("region = 'EU'", columns), [True, False, False])
+        eq_(evaluate_columns("region <> 'EU'", columns),
+            [False, False, True])
+        eq_(evaluate_columns('region is null', columns), [False, True, False])
+        eq_(evaluate_columns('region is not null', columns),
+            [True, False, True])
+        # as with evaluate(), a missing header fails the row, unless the
+        # result is decided before it is read
+        eq_(evaluate_columns("region = 'US' or priority > 3", columns),
+            [False, False, True])
+        eq_(evaluate_columns("priority > 3 or region = 'US'", columns),
+            [False, True, False])
+        eq_(evaluate_columns("region in ('EU', priority)", columns),
+            [True, False, False])
+        eq_(evaluate_columns("region = 'EU' and priority > 3", columns),
+            [False, False, False])
+
+    def test_missing_header(self):
+        eq_(evaluate_columns('x = 2 or y = 1', {'x': [None], 'y': [1]}),
+            [False])
+        eq_(evaluate_columns('x in (y, 2)', {'x': [2], 'y': [None]}),
+            [False])
+        eq_(evaluate_columns('x in (2, y)', {'x': [2], 'y': [None]}),
+            [True])
+
+    def test_missing_column_is_null(self):
+        eq_(evaluate_columns('other is null', {'region': ['EU', 'US']}),
+            [True, True])
+
+    def test_literals_only(self):
+        eq_(evaluate_columns('1 < 2', {}, size=3), [True] * 3)
+
+    @raises(UnknownVariableError)
+    def test_unknown_variable(self):
+        evaluate_columns("other = 'EU'", {'region': ['EU']})
+
+    def test_incompatible_types(self):
+        eq_(evaluate_columns('region > 3', {'region': ['EU']}), [False])
+
+    def test_mixed_types(self):
+        columns = {'priority': [1, 'x', 3, None], 'region': ['EU'] * 4}
+        eq_(evaluate_columns('priority > 2', columns),
+            [False, False, True, False])
+        eq_(evaluate_columns('priority between 0 and 5', columns),
+            [True, False, True, False])
+        eq_(evaluate_columns('-priority < 0', columns),
+            [True, False, True, False])
+        eq_(evaluate_columns("priority like '%'", columns),
+            [False, True, False, False])
+
+    def test_division_by_zero(self):
+        columns = {'a': [1, 0, 2]}
+        eq_(evaluate_columns('2 / a >= 1', columns), [True, False, True])
+        eq_(evaluate_columns('2 / a >= 1 or a = 0', columns),
+            [True, False, True])
+
+    def test_errors_as_index(self):
+        # the rows that can not be evaluated are skipped, as by the index
+        columns = {'priority': [1, 'x', 0, 3, 'y'],
+                   'region': ['EU', 'EU', 'US', 'US', 'US']}
+        rows = _rows(columns, 5)
+        for expression in ["region = 'EU' and priority > 2",
+                           "region = 'US' or priority > 2",
+                           "priority > 2 or region = 'US'",
+                           "region = 'US' and 6 / priority > 1",
+                           "6 / priority > 1 or region = 'EU'"]:
+            expected = [SelectorIndex._evaluate(compile(expression).tree, row)
+                        for row in rows]
+            eq_(evaluate_columns(expression, columns), expected, expression)
+
+    def test_random_as_evaluation(self):
+        rnd = random.Random(0)
+        columns = _sparse_columns(50, rnd)
+        rows = _rows(columns, 50)
+        for i in range(300):
+            expression = _condition(rnd, 3)
+            tree = compile(expression).tree
+            expected = [SelectorIndex._evaluate(tree, row) for row in rows]
+            eq_(evaluate_columns(expression, columns), expected, expression)
+
+    @raises(ValueError)
+    def test_different_lengths(self):
+        evaluate_columns('a = b', {'a': [1, 2], 'b': [1]})
+
+
+class TestArrayColumns(object):
+    def setup(self):
+        if numpy is None:
+            raise SkipTest('NumPy is not available')
+
+    def test_same_as_evaluation(self):
+        columns = _columns(100)
+        rows = _rows(columns, 100)
+        arrays = dict([(name, numpy.array(column))
+                       for name, column in columns.items()])
+        for expression in EXPRESSIONS:
+            selector = compile(expression)
+            expected = [selector.matches(row) for row in rows]
+            mask = evaluate_columns(expression, arrays)
+            assert isinstance(mask, numpy.ndarray)
+            eq_(mask.tolist(), expected)
+
+    def test_object_arrays_use_lists(self):
+        columns = {'region': numpy.array(['EU', None], dtype=object)}
+        eq_(evaluate_columns("region = 'EU'", columns), [True, False])
+
+    def test_incompatible_types(self):
+        mask = evaluate_columns('region > 3', {'region': numpy.array(['EU'])})
+        eq_(mask.tolist(), [False])
+
+    def test_division_by_zero(self):
+        columns = {'a': numpy.array([1, 0, 2])}
+        eq_(evaluate_columns('2 / a >= 1', columns).tolist(),
+            [True, False, True])
+        eq_(evaluate_columns('2 / a >= 1 or a = 0', columns).tolist(),
+            [True, False, True])
+        eq_(evaluate_columns('a = 0 or 2 / a >= 1', columns).tolist(),
+            [True, True, True])
+        eq_(evaluate_columns('a > 0 and 2 / a >= 1', columns).tolist(),
+            [True, False, True])
@@ -0,0 +1,114 @@
+import random
+
+from nose.tools import eq_, raises
+
+from plasma.flex.messaging.selector.index import SelectorIndex
+from plasma.flex.messaging.selector.parser import compile
+from plasma.flex.messaging.selector import ParseError
+
+
+class TestSelectorIndex(object):
+    def setup(self):
+        self.index = SelectorIndex()
+
+    def test_equality(self):
+        self.index.add(1, "region = 'EU'")
+        self.index.add(2, "'US' = region")
+        eq_(self.index.match({'region': 'EU'}), set([1]))
+        eq_(self.index.match({'region': 'US'}), set([2]))
+        eq_(self.index.match({'region': 'APAC'}), set())
+        eq_(self.index.match({}), set())
+
+    def test_in(self):
+        self.index.add(1, "region in ('EU', 'US')")
+        eq_(self.index.match({'region': 'US'}), set([1]))
+        eq_(self.index.match({'region': 'APAC'}), set())
+
+    def test_ranges(self):
+        self.index.add('gt', 'priority > 3')
+        self.index.add('gte', 'priority >= 3')
+        self.index.add('lt', '3 > priority')
+        self.index.add('between', 'priority between 2 and 4')
+        eq_(self.index.match({'priority': 3}), set(['gte', 'between']))
+        eq_(self.index.match({'priority': 5}), set(['gt', 'gte']))
+        eq_(self.index.match({'priority': 1}), set(['lt']))
+        eq_(self.index.match({'priority': 'high'}), set())
+
+    def test_upper_ranges(self):
+        self.index.add('lt', 'priority < 3')
+        self.index.add('lte', 'priority <= 3')
+        self.index.add('lte5', 'priority <= 5')
+        self.index.add('gt', 'priority > 3')
+        eq_(self.index.match({'priority': 3}), set(['lte', 'lte5']))
+        eq_(self.index.match({'priority': 2.5}), set(['lt', 'lte', 'lte5']))
+        eq_(self.index.match({'priority': 6}), set(['gt']))
+        eq_(self.index.match({'priority': -100}), set(['lt', 'lte', 'lte5']))
+
+        for subscription_id in ('lt', 'lte', 'lte5'):
+            self.index.remove(subscription_id)
+        eq_(self.index.match({'priority': 1}), set())
+        eq_(self.index._upper_ranges, {})
+
+    def test_residual(self):
+        self.index.add(1, "region = 'EU' and priority > 3 and "
+                          "(name like 'abc%')")
+        eq_(self.index.match({'region': 'EU', 'priority': 5,
+                              'name': 'abcdef'}), set([1]))
+        eq_(self.index.match({'region': 'EU', 'priority': 5,
+                              'name': 'xyz'}), set())
+        # Missing headers do not match
+        eq_(self.index.match({'region': 'EU', 'priority': 5}), set())
+
+    def test_unindexed(self):
+        self.index.add(1, "region = 'EU' or priority > 3")
+        eq_(self.index.match({'region': 'EU', 'priority': 1}), set([1]))
+        eq_(self.index.match({'region': 'US', 'priority': 1}), set())
+
+    def test_replace_and_remove(self):
+        self.index.add(1, "region = 'EU'")
+        self.index.add(1, "region = 'US'")
+        eq_(len(self.index), 1)
+        eq_(self.index.match({'region': 'EU'}), set())
+        eq_(self.index.match({'region': 'US'}), set([1]))
+        self.index.remove(1)
+        assert 1 not in self.index
+        eq_(self.index.match({'region': 'US'}), set())
+
+    @raises(LookupError)
+    def test_remove_unknown(self):
+        self.index.remove(1)
+
+    @raises(ParseError)
+    def test_invalid_expression(self):
+        self.index.add(1, '2 > > 2')
+
+    def test_same_as_evaluation(self):
+        expressions = [
+            "region = 'EU'",
+            "region = 'EU' and priority > 3",
+            "region in ('EU', 'US') and (priority between 2 and 5)",
+            "priority <= 2 and region <> 'US'",
+            "priority * 2 > 6",
+            "region = 'US' or priority < 1",
+            "region is null",
+            "priority > 3 and priority < 6",
+        ]
+        for i, expression in enumerate(expressions):
+            self.index.add(i, expression)
+
+        rnd = random.Random(0)
+        for x in range(200):
+            headers = {}
+            if rnd.random() > 0.1:
+                headers['region'] = rnd.choice(['EU', 'US', 'APAC'])
+            if rnd.random() > 0.1:
+                headers['priority'] = rnd.randint(0, 7)
+
+            expected = set()
+            for i, expression in enumerate(expressions):
+                try:
+                    if compile(expression).matches(headers):
+                        expected.add(i)
+                except ParseError:
+                    pass
+            eq_(self.index.match(headers), expected)
@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright The Plasma Project.
+# See LICENSE.txt for details.
+
+"""Tests for the asyncio remoting client."""
+
+import os.path
+import subprocess
+import sys
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+from pyamf import remoting
+
+from plasma import aioclient
+from plasma.aioclient import asyncio
+
+
+def answer(body):
+    """
+    Returns the encoded response to a remoting request, upper casing the
+    first argument of every call. Calls to `fail` are answered with an error.
+    """
+    request = remoting.decode(body)
+    response = remoting.Envelope(request.amfVersion)
+    for name, message in request.iteritems():
+        if message.target == 'fail':
+            fault = remoting.ErrorFault(code='Error', description='failed')
+            response[name] = remoting.Response(fault,
+                status=remoting.STATUS_ERROR)
+        else:
+            response[name] = remoting.Response(message.body[0].upper())
+    return remoting.encode(response).getvalue()
+
+
+def test_no_twisted():
+    # the client must neither need Twisted nor install its reactor
+    code = ('import sys, plasma.aioclient\n'
+            'sys.exit(len([name for name in sys.modules\n'
+            '              if name.startswith("twisted")]))\n')
+    root = os.path.dirname(os.path.dirname(aioclient.__file__))
+    eq_(subprocess.call([sys.executable, '-c', code], cwd=root), 0)
+
+
+class FakeFuture(object):
+    """
+    A future that runs its callbacks as soon as it is done.
+    """
+
+    def __init__(self):
+        self.state = 'pending'
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.state != 'pending'
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def result(self):
+        return self.value
+
+    def exception(self):
+        return self.error
+
+    def set_result(self, value):
+        self.value = value
+        self._finish('finished')
+
+    def set_exception(self, error):
+        self.error = error
+        self._finish('finished')
+
+    def cancel(self):
+        if self.done():
+            return False
+        self._finish('cancelled')
+        return True
+
+    def add_done_callback(self, callback):
+        if self.done():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def _finish(self, state):
+        assert not self.done()
+        self.state = state
+        for callback in self.callbacks:
+            callback(self)
+
+
+class FakeTimer(object):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def fire(self):
+        self.func(*self.args)
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.written = []
+        self.closed = False
+        self.aborted = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeLoop(object):
+    """
+    Records the timers and the connections, which are only made when the
+    test calls :meth:`connect` or :meth:`refuse`.
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.connecting = []
+
+    def create_future(self):
+        return FakeFuture()
+
+    def call_later(self, delay, func, *args):
+        timer = FakeTimer(func, args)
+        self.timers.append(timer)
+        return timer
+
+    def create_connection(self, factory, host, port, ssl=False):
+        future = FakeFuture()
+        self.connecting.append((factory, future))
+        return future
+
+    def connect(self):
+        factory, future = self.connecting.pop(0)
+        transport = FakeTransport()
+        protocol = factory()
+        protocol.connection_made(transport)
+        future.set_result((transport, protocol))
+        return protocol
+
+    def refuse(self, error):
+        factory, future = self.connecting.pop(0)
+        future.set_exception(error)
+
+
+class Handler(object):
+    """
+    Records what the HTTP protocol passes to a response handler.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.headers = None
+        self.data = []
+        self.reusable = None
+        self.error = None
+
+    def headersReceived(self, status, reason, headers):
+        self.status = status
+        self.headers = headers
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def finished(self, reusable):
+        self.reusable = reusable
+
+    def failed(self, exc):
+        self.error = exc
+
+
+class TestHTTPProtocol(object):
+
+    def setup(self):
+        self.transport = FakeTransport()
+        self.protocol = aioclient._HTTPProtocol()
+        self.protocol.connection_made(self.transport)
+        self.handler = Handler()
+        self.protocol.request(b'POST / HTTP/1.1\r\n\r\n', self.handler)
+
+    def feed(self, data, size=None):
+        if size is None:
+            size = len(data)
+        for i in range(0, len(data), size):
+            self.protocol.data_received(data[i:i + size])
+
+    def test_content_length(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+        eq_(self.handler.status, 200)
+        eq_(b''.join(self.handler.data), b'hello')
+        eq_(self.handler.reusable, True)
+        eq_(self.protocol.handler, None)
+
+    def test_chunked(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                  b'3\r\nhel\r\n2;ext=1\r\nlo\r\n0\r\nX-Trailer: 1\r\n\r\n',
+                  size=1)
+        eq_(b''.join(self.handler.data), b'hello')
+        eq_(self.handler.reusable, True)
+
+    def test_connection_close(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nConnection: close\r\n'
+                  b'Content-Length: 2\r\n\r\nok')
+        eq_(self.handler.reusable, False)
+
+    def test_until_close(self):
+        self.feed(b'HTTP/1.0 200 OK\r\n\r\nhel')
+        self.feed(b'lo')
+        eq_(self.handler.reusable, None)
+        self.protocol.connection_lost(None)
+        eq_(b''.join(self.handler.data), b'hello')
+        eq_(self.handler.reusable, False)
+
+    def test_lost_before_end(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhel')
+        self.protocol.connection_lost(None)
+        assert isinstance(self.handler.error, remoting.RemotingError)
+        eq_(self.handler.reusable, None)
+
+    def test_malformed_chunk_size(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                  b'zz\r\nhello\r\n')
+        assert isinstance(self.handler.error, remoting.RemotingError)
+        assert self.transport.aborted
+        eq_(self.protocol.handler, None)
+
+        # the connection is lost once aborted
+        self.protocol.connection_lost(None)
+        eq_(self.handler.reusable, None)
+
+    def test_chunk_longer_than_size(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+                  b'3\r\nhello\r\n0\r\n\r\n')
+        assert isinstance(self.handler.error, remoting.RemotingError)
+        assert self.transport.aborted
+
+    def test_malformed_head(self):
+        self.feed(b'HTTP/1.1 OK\r\nContent-Length: 5\r\n\r\nhello')
+        assert isinstance(self.handler.error, remoting.RemotingError)
+        eq_(self.handler.status, None)
+
+    def test_negative_length(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nContent-Length: -5\r\n\r\nhello')
+        assert isinstance(self.handler.error, remoting.RemotingError)
+
+    def test_unexpected_data(self):
+        self.feed(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')
+        eq_(self.handler.reusable, True)
+        self.feed(b'junk')
+        assert self.transport.aborted
+
+
+class TestConnectionPool(object):
+
+    key = ('example.com', 80, False)
+
+    def setup(self):
+        self.loop = FakeLoop()
+        self.pool = aioclient.ConnectionPool(self.loop, max_connections=1,
+                                             idle_timeout=10)
+
+    def test_reuse(self):
+        first = self.pool.acquire(self.key)
+        assert not first.done()
+        protocol = self.loop.connect()
+        eq_(first.result(), protocol)
+
+        self.pool.release(self.key, protocol, True)
+        eq_(len(self.loop.timers), 1)
+        second = self.pool.acquire(self.key)
+        eq_(second.result(), protocol)
+        assert self.loop.timers[0].cancelled
+        eq_(self.loop.connecting, [])
+
+    def test_waiting(self):
+        first = self.pool.acquire(self.key)
+        second = self.pool.acquire(self.key)
+        eq_(len(self.loop.connecting), 1)
+        protocol = self.loop.connect()
+        assert not second.done()
+
+        self.pool.release(self.key, first.result(), True)
+        eq_(second.result(), protocol)
+        eq_(self.loop.timers, [])
+
+    def test_not_reusable(self):
+        first = self.pool.acquire(self.key)
+        second = self.pool.acquire(self.key)
+        protocol = self.loop.connect()
+
+        # the waiting request gets a new connection
+        self.pool.release(self.key, protocol, False)
+        assert protocol.transport.closed
+        assert not second.done()
+        other = self.loop.connect()
+        eq_(second.result(), other)
+        eq_(self.pool._open[self.key], 1)
+
+    def test_expire(self):
+        self.pool.acquire(self.key)
+        protocol = self.loop.connect()
+        self.pool.release(self.key, protocol, True)
+        self.loop.timers[0].fire()
+        assert protocol.transport.closed
+        eq_(self.pool._open[self.key], 0)
+
+        self.pool.acquire(self.key)
+        eq_(len(self.loop.connecting), 1)
+
+    def test_closed_while_idle(self):
+        self.pool.acquire(self.key)
+        protocol = self.loop.connect()
+        self.pool.release(self.key, protocol, True)
+        protocol.connection_lost(None)
+
+        future = self.pool.acquire(self.key)
+        assert not future.done()
+        eq_(len(self.loop.connecting), 1)
+
+    def test_connection_refused(self):
+        first = self.pool.acquire(self.key)
+        second = self.pool.acquire(self.key)
+        error = IOError('refused')
+        self.loop.refuse(error)
+        eq_(first.exception(), error)
+
+        # the waiting request tries again
+        protocol = self.loop.connect()
+        eq_(second.result(), protocol)
+
+    def test_close(self):
+        self.pool.acquire(self.key)
+        protocol = self.loop.connect()
+        self.pool.release(self.key, protocol, True)
+        self.pool.close()
+        assert protocol.transport.closed
+        assert self.loop.timers[0].cancelled
+        eq_(self.pool._open[self.key], 0)
+
+
+class TestAsyncioRemotingServiceFakeLoop(object):
+
+    def setup(self):
+        self.loop = FakeLoop()
+        self.service = aioclient.AsyncioRemotingService(
+            'http://example.com/gw', loop=self.loop)
+
+    def respond(self, protocol, head=b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: application/x-amf\r\n'):
+        request = protocol.transport.written[-1]
+        body = answer(request.split(b'\r\n\r\n', 1)[1])
+        protocol.data_received(b'%sContent-Length: %d\r\n\r\n%s'
+                               % (head, len(body), body))
+
+    def test_nothing_pending(self):
+        dispatched = self.service.execute()
+        assert dispatched.done()
+        assert not dispatched.cancelled()
+        eq_(self.loop.connecting, [])
+
+    def test_request(self):
+        future = self.service.getService('foo.uppercase')('hello')
+        protocol = self.loop.connect()
+        request = protocol.transport.written[0]
+        assert request.startswith(b'POST /gw HTTP/1.1\r\n')
+        assert b'Host: example.com\r\n' in request
+
+        self.respond(protocol)
+        eq_(future.result(), 'HELLO')
+        eq_(self.service._batches, set())
+        eq_(len(self.loop.timers), 1)
+
+    def test_malformed_response(self):
+        future = self.service.getService('foo.uppercase')('hello')
+        protocol = self.loop.connect()
+        protocol.data_received(b'HTTP/1.1 200 OK\r\n'
+                               b'Transfer-Encoding: chunked\r\n\r\nzz\r\n')
+        assert isinstance(future.exception(), remoting.RemotingError)
+        assert protocol.transport.aborted
+        eq_(self.service._batches, set())
+        eq_(self.service.pool._open[self.service._connectionKey()], 0)
+
+    def test_http_error(self):
+        future = self.service.getService('foo.uppercase')('hello')
+        protocol = self.loop.connect()
+        protocol.data_received(b'HTTP/1.1 500 Internal Server Error\r\n'
+                               b'Content-Length: 0\r\n\r\n')
+        assert isinstance(future.exception(), remoting.RemotingError)
+
+    def test_connection_refused(self):
+        future = self.service.getService('foo.uppercase')('hello')
+        error = IOError('refused')
+        self.loop.refuse(error)
+        eq_(future.exception(), error)
+
+
+class GatewayProtocol(aioclient._Protocol):
+    """
+    Answers remoting requests like :func:`answer`, with chunked responses.
+    """
+
+    connections = 0
+
+    def connection_made(self, transport):
+        GatewayProtocol.connections += 1
+        self.transport = transport
+        self.buffer = b''
+
+    def data_received(self, data):
+        self.buffer += data
+        head, sep, body = self.buffer.partition(b'\r\n\r\n')
+        if not sep:
+            return
+        for line in head.split(b'\r\n'):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        if len(body) < length:
+            return
+        self.buffer = body[length:]
+        data = answer(body[:length])
+
+        self.transport.write(b'HTTP/1.1 200 OK\r\n'
+                             b'Content-Type: application/x-amf\r\n'
+                             b'Transfer-Encoding: chunked\r\n\r\n')
+        for i in range(0, len(data), 16):
+            chunk = data[i:i + 16]
+            self.transport.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.transport.write(b'0\r\n\r\n')
+
+
+class TestAsyncioRemotingService(object):
+
+    def setup(self):
+        if asyncio is None:
+            raise SkipTest('asyncio is not available')
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(GatewayProtocol, '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.service = aioclient.AsyncioRemotingService(
+            'http://127.0.0.1:%d/gw' % port, loop=self.loop)
+
+    def teardown(self):
+        self.service.close()
+        self.server.close()
+        self.loop.close()
+
+    def wait(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_single_request(self):
+        future = self.service.getService('foo.uppercase')('teststring')
+        assert isinstance(future, asyncio.Future)
+        eq_(self.wait(future), 'TESTSTRING')
+
+    def test_batch_call(self):
+        upper = self.service.getService('foo.uppercase', auto_execute=False)
+        first = upper('to upper case')
+        error = self.service.getService('fail', auto_execute=False)()
+        second = upper('this too')
+        self.service.execute()
+
+        eq_(self.wait(first), 'TO UPPER CASE')
+        eq_(self.wait(second), 'THIS TOO')
+        try:
+            self.wait(error)
+        except remoting.RemotingError as e:
+            eq_(str(e), 'failed')
+        else:
+            assert False, 'Expected a RemotingError'
+
+    def test_connection_reuse(self):
+        upper = self.service.getService('foo.uppercase')
+        connections = GatewayProtocol.connections
+        eq_(self.wait(upper('first')), 'FIRST')
+        eq_(self.wait(upper('second')), 'SECOND')
+        eq_(GatewayProtocol.connections, connections + 1)
+
+    def test_max_connections(self):
+        self.service.pool.max_connections = 1
+        upper = self.service.getService('foo.uppercase')
+        connections = GatewayProtocol.connections
+        futures = [upper(word) for word in ('a', 'b', 'c')]
+        eq_([self.wait(future) for future in futures], ['A', 'B', 'C'])
+        eq_(GatewayProtocol.connections, connections + 1)
+
+    def test_cancel_pending(self):
+        upper = self.service.getService('foo.uppercase', auto_execute=False)
+        future = upper('first')
+        other = upper('second')
+        future.cancel()
+        self.service.execute()
+        eq_(self.wait(other), 'SECOND')
+        eq_(len(self.service.requests), 0)
+
+    def test_cancel_sent(self):
+        future = self.service.getService('foo.uppercase')('first')
+        future.cancel()
+        try:
+            self.wait(future)
+        except asyncio.CancelledError:
+            pass
+        else:
+            assert False, 'Expected a CancelledError'
+
+    def test_batch_window(self):
+        self.service.batch_window = 0.01
+        upper = self.service.getService('foo.uppercase')
+        first = upper('first')
+        second = upper('second')
+        eq_(len(self.service.requests), 2)
+        eq_(self.wait(first), 'FIRST')
+        eq_(self.wait(second), 'SECOND')
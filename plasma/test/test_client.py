@@ -5,13 +5,22 @@
 
 """Tests for Remoting client."""
 
+import httplib
 import logging
+import socket
+import threading
+import zlib
+from StringIO import StringIO
 
 from nose.tools import eq_, raises
-from nose.twistedtools import reactor, deferred
-from twisted.web.server import Site
-from twisted.web.resource import Resource
-from twisted.internet.defer import Deferred, inlineCallbacks
+from nose.twistedtools import reactor, deferred, stop_reactor
+from twisted.web.server import Site, GzipEncoderFactory, NOT_DONE_YET
+from twisted.web.resource import Resource, EncodingResourceWrapper
+from twisted.internet.defer import Deferred, CancelledError, inlineCallbacks
+from twisted.internet.task import Clock, Cooperator
+from twisted.web.client import FileBodyProducer, ResponseNeverReceived
+from twisted.internet.error import ConnectionRefusedError
+from twisted.web.iweb import UNKNOWN_LENGTH
 from pyamf.remoting import RemotingError, Envelope
 from pyamf.remoting.gateway.twisted import TwistedGateway
 from pyamf.remoting.gateway import authenticate
@@ -19,6 +28,9 @@ from pyamf import remoting
 import pyamf
 
 from plasma import client
+import plasma.service
+from plasma.flex.messaging.messages import (ErrorMessage,
+    AcknowledgeMessage, CommandMessage)
 
 
 def setup():
@@ -29,21 +41,41 @@ def setup():
     root.putChild('gw', gateway)
     root.putChild('bad', BadResource())
     root.putChild('badtype', BadContentTypeResource())
-
-    site = Site(root)
+    root.putChild('gzip', EncodingResourceWrapper(gateway,
+                                                  [GzipEncoderFactory()]))
+    root.putChild('gunzip', GunzipResource())
+    root.putChild('badencoding', BadEncodingResource())
+    root.putChild('stall', StallingResource())
+    root.putChild('drop', DroppingResource())
+    root.putChild('hint', RetryHintResource())
+    root.putChild('cluster', ClusterResource())
+
+    site = CountingSite(root)
     reactor.listenTCP(11111, site)
     pyamf.add_error_class(RegisteredError, u'RegisteredError')
 
 
 def teardown():
     pyamf.remove_error_class(RegisteredError)
-    reactor.stop()
+    stop_reactor()
 
 
 def simple_authenticator(userid, password):
     return userid == 'testuser' and password == 'secret'
 
 
+class CountingSite(Site):
+    """
+    Counts the connections made to the test server.
+    """
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        CountingSite.connections += 1
+        return Site.buildProtocol(self, addr)
+
+
 class BadResource(Resource):
 
     def render_POST(self, request):
@@ -51,12 +83,133 @@ class BadResource(Resource):
         return 'ERROR'
 
 
+class GunzipResource(Resource):
+    """
+    Decompresses gzip request bodies for the gateway.
+    """
+
+    isLeaf = True
+    encodings = []
+
+    def render_POST(self, request):
+        encoding = request.getHeader('content-encoding')
+        GunzipResource.encodings.append(encoding)
+        if encoding == 'gzip':
+            body = zlib.decompress(request.content.read(),
+                                   16 + zlib.MAX_WBITS)
+            request.content = StringIO(body)
+        return gateway.render(request)
+
+
+class BadEncodingResource(Resource):
+
+    def render_POST(self, request):
+        request.setHeader('Content-Type', remoting.CONTENT_TYPE)
+        request.setHeader('Content-Encoding', 'br')
+        return 'hello'
+
+
 class BadContentTypeResource(Resource):
 
     def render_POST(self, request):
         return 'hello'
 
 
+class StallingResource(Resource):
+    """
+    Answers all the requests of an envelope but the last one by upper casing
+    their first argument, then stalls without finishing the response.
+    """
+
+    isLeaf = True
+    lost = []
+
+    def render_POST(self, request):
+        envelope = remoting.decode(request.content.read())
+        response = remoting.Envelope(envelope.amfVersion)
+        for name, message in envelope.bodies:
+            response[name] = remoting.Response(message.body[0].upper())
+        pieces = list(client.iter_encode(response))
+
+        request.setHeader('Content-Type', remoting.CONTENT_TYPE)
+        request.write(''.join(pieces[:-1]))
+        StallingResource.lost.append(request.notifyFinish())
+        return NOT_DONE_YET
+
+
+class DroppingResource(Resource):
+    """
+    Closes the connection without answering the first `drops` requests,
+    then passes them to the gateway.
+    """
+
+    isLeaf = True
+    drops = 0
+
+    def render_POST(self, request):
+        if DroppingResource.drops > 0:
+            DroppingResource.drops -= 1
+            request.transport.abortConnection()
+            return NOT_DONE_YET
+        return gateway.render(request)
+
+
+class RetryHintResource(Resource):
+    """
+    Upper cases the first argument of the requests. Requests for `retry` are
+    answered with a retryable error the first time, those for `fail` every
+    time. Records the number of requests of each envelope.
+    """
+
+    isLeaf = True
+    envelopes = []
+
+    def render_POST(self, request):
+        envelope = remoting.decode(request.content.read())
+        RetryHintResource.envelopes.append(len(envelope.bodies))
+        response = remoting.Envelope(envelope.amfVersion)
+        for name, message in envelope.bodies:
+            word = message.body[0]
+            if word == 'fail' or (word == 'retry' and
+                                  len(RetryHintResource.envelopes) == 1):
+                error = ErrorMessage(faultCode='Server.Busy',
+                    faultString='busy',
+                    headers={'DSRetryableErrorHint': True})
+                response[name] = remoting.Response(error,
+                    status=remoting.STATUS_ERROR)
+            else:
+                response[name] = remoting.Response(word.upper())
+
+        request.setHeader('Content-Type', remoting.CONTENT_TYPE)
+        return remoting.encode(response).getvalue()
+
+
+class ClusterResource(Resource):
+    """
+    Answers cluster requests with the urls of two members, and records the
+    operations of the commands it receives.
+    """
+
+    isLeaf = True
+    operations = []
+
+    def render_POST(self, request):
+        envelope = remoting.decode(request.content.read())
+        response = remoting.Envelope(envelope.amfVersion)
+        for name, message in envelope.bodies:
+            command = message.body[0]
+            assert isinstance(command, CommandMessage)
+            ClusterResource.operations.append(command.operation)
+            ack = AcknowledgeMessage(correlationId=command.messageId,
+                body=[{'my-amf': 'http://127.0.0.1:11111/gw'},
+                      {'my-amf': 'http://127.0.0.1:11111/gzip',
+                       'my-rtmp': 'rtmp://127.0.0.1:2037'}])
+            response[name] = remoting.Response(ack)
+
+        request.setHeader('Content-Type', remoting.CONTENT_TYPE)
+        return remoting.encode(response).getvalue()
+
+
 class FooService(object):
 
     def uppercase(self, request, string):
@@ -126,6 +279,15 @@ def test_server_error():
     return y.bar()
 
 
+@raises(RemotingError)
+@deferred()
+def test_bad_content_encoding():
+    service = client.HTTPRemotingService('http://127.0.0.1:11111/badencoding',
+                                         logger=logging)
+    y = service.getService('foo')
+    return y.bar()
+
+
 @raises(RemotingError)
 @deferred()
 def test_bad_content_type():
@@ -135,6 +297,619 @@ def test_bad_content_type():
     return y.bar()
 
 
+class RecordingService(client.RemotingServiceBase):
+    """
+    Records the batches of requests that would be sent, using a fake clock.
+    """
+
+    def __init__(self, **kwargs):
+        client.RemotingServiceBase.__init__(self, **kwargs)
+        self.clock = Clock()
+        self.batches = []
+
+    def callLater(self, delay, func, *args):
+        return self.clock.callLater(delay, func, *args)
+
+    def execute(self):
+        self.batches.append(self._takeRequests())
+
+
+class TestCoalescing(object):
+
+    def test_disabled(self):
+        service = RecordingService()
+        foo = service.getService('foo')
+        foo.bar(1)
+        foo.bar(2)
+        eq_([len(batch) for batch in service.batches], [1, 1])
+
+    def test_window(self):
+        service = RecordingService(batch_window=0.05)
+        foo = service.getService('foo')
+        foo.bar(1)
+        foo.baz(2)
+        eq_(service.batches, [])
+
+        service.clock.advance(0.05)
+        eq_(len(service.batches), 1)
+        eq_([str(r.service) for r in service.batches[0]],
+            ['foo.bar', 'foo.baz'])
+
+        foo.bar(3)
+        service.clock.advance(0.05)
+        eq_([len(batch) for batch in service.batches], [2, 1])
+
+    def test_max_batch_size(self):
+        service = RecordingService(batch_window=0.05, max_batch_size=2)
+        foo = service.getService('foo')
+        foo.bar(1)
+        foo.bar(2)
+        foo.bar(3)
+        eq_([len(batch) for batch in service.batches], [2])
+
+        service.clock.advance(0.05)
+        eq_([len(batch) for batch in service.batches], [2, 1])
+
+    def test_max_batch_bytes(self):
+        service = RecordingService(batch_window=0.05, max_batch_bytes=100)
+        foo = service.getService('foo')
+        foo.bar('x' * 10)
+        eq_(service.batches, [])
+        foo.bar('x' * 100)
+        eq_([len(batch) for batch in service.batches], [2])
+
+    def test_remove_request(self):
+        service = RecordingService(batch_window=0.05, max_batch_bytes=100)
+        d = service.addRequest(service.getService('foo'), 'x' * 80)
+        service.removeRequest(d)
+        eq_(service._batch_bytes, 0)
+
+    def test_explicit_execute(self):
+        service = RecordingService(batch_window=0.05)
+        service.getService('foo').bar(1)
+        service.execute()
+        service.clock.advance(0.05)
+        eq_([len(batch) for batch in service.batches], [1])
+
+    def test_manual_batch_not_affected(self):
+        service = RecordingService(batch_window=0.05)
+        service.getService('foo', auto_execute=False).bar(1)
+        service.clock.advance(0.05)
+        eq_(service.batches, [])
+        eq_(len(service.requests), 1)
+
+
+class TestDispatchQueue(object):
+
+    def setup(self):
+        self.clock = Clock()
+        self.queue = client.DispatchQueue(2, self.clock.seconds)
+
+    def test_unlimited(self):
+        queue = client.DispatchQueue()
+        for i in range(10):
+            eq_(self.fired(queue.acquire()), [0.0])
+        eq_(queue.in_flight, 10)
+        eq_(len(queue), 0)
+
+    def fired(self, d):
+        result = []
+        d.addCallback(result.append)
+        return result
+
+    def test_limit(self):
+        first = self.fired(self.queue.acquire())
+        second = self.fired(self.queue.acquire())
+        third = self.fired(self.queue.acquire())
+        eq_((first, second, third), ([0.0], [0.0], []))
+        eq_(len(self.queue), 1)
+        eq_(self.queue.max_depth, 1)
+
+        self.clock.advance(3)
+        self.queue.release()
+        eq_(third, [3])
+        eq_(len(self.queue), 0)
+        eq_(self.queue.in_flight, 2)
+        eq_(self.queue.dispatched, 3)
+        eq_(self.queue.max_wait, 3)
+        eq_(self.queue.averageWait(), 1)
+
+    def test_order(self):
+        self.queue.acquire()
+        self.queue.acquire()
+        order = []
+        for i in range(3):
+            self.queue.acquire().addCallback(lambda _, i=i: order.append(i))
+        self.queue.release()
+        self.queue.release()
+        self.queue.release()
+        eq_(order, [0, 1, 2])
+
+    def test_cancel(self):
+        self.queue.acquire()
+        self.queue.acquire()
+        d = self.queue.acquire()
+        d.addErrback(lambda failure: None)
+        d.cancel()
+        eq_(len(self.queue), 0)
+        self.queue.release()
+        eq_(self.queue.in_flight, 1)
+
+
+class TestRetryPolicy(object):
+
+    def test_delay(self):
+        policy = client.RetryPolicy(initial_delay=1, max_delay=5,
+                                    jitter=0.5, random=lambda: 0)
+        eq_([policy.getDelay(i) for i in range(1, 6)], [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        policy = client.RetryPolicy(initial_delay=1, jitter=0.5,
+                                    random=lambda: 1)
+        eq_(policy.getDelay(2), 1)
+
+
+class TestEndpointSelector(object):
+
+    def setup(self):
+        self.clock = Clock()
+        self.point = 0
+        self.selector = client.EndpointSelector(
+            ['http://a/gw', 'http://b/gw'], self.clock.seconds,
+            lambda: self.point, decay=0.5, cooldown=5, max_cooldown=15)
+        self.a, self.b = self.selector
+
+    def test_single_url(self):
+        selector = client.EndpointSelector('http://a/gw')
+        eq_(len(selector), 1)
+        eq_(selector.select().url.hostname, 'a')
+
+    @raises(ValueError)
+    def test_no_url(self):
+        client.EndpointSelector([])
+
+    def test_latency_weight(self):
+        self.selector.recordSuccess(self.a, 0.1)
+        self.selector.recordSuccess(self.b, 0.3)
+        self.point = 0.74
+        assert self.selector.select() is self.a
+        self.point = 0.76
+        assert self.selector.select() is self.b
+
+    def test_unmeasured(self):
+        self.selector.recordSuccess(self.a, 0.2)
+        self.point = 0.49
+        assert self.selector.select() is self.a
+        self.point = 0.51
+        assert self.selector.select() is self.b
+
+    def test_moving_average(self):
+        self.selector.recordSuccess(self.a, 0.5)
+        self.selector.recordSuccess(self.a, 1.5)
+        eq_(self.a.latency, 1.0)
+        self.selector.recordFailure(self.a)
+        eq_((self.a.error_rate, self.a.failures), (0.5, 1))
+        self.selector.recordSuccess(self.a, 0.2)
+        eq_((self.a.error_rate, self.a.failures), (0.25, 0))
+
+    def test_error_rate_weight(self):
+        self.selector.recordSuccess(self.a, 0.1)
+        self.selector.recordSuccess(self.b, 0.1)
+        self.selector.recordFailure(self.a)
+        self.point = 0.33
+        assert self.selector.select() is self.a
+        self.point = 0.34
+        assert self.selector.select() is self.b
+
+    def test_down(self):
+        self.selector.recordFailure(self.a, down=True)
+        eq_(self.selector.available(), [self.b])
+        assert self.selector.select() is self.b
+        self.clock.advance(5)
+        eq_(self.selector.available(), [self.a, self.b])
+
+    def test_cooldown(self):
+        for i in range(3):
+            self.selector.recordFailure(self.a, down=True)
+        eq_(self.a.down_until, 15)
+        self.selector.recordFailure(self.b, down=True)
+        eq_(self.selector.available(), [])
+        assert self.selector.select() is self.b
+        self.selector.recordSuccess(self.a, 0.1)
+        eq_(self.a.down_until, None)
+
+    def test_exclude(self):
+        assert self.selector.select([self.a]) is self.b
+        assert self.selector.select([self.a, self.b]) is self.a
+
+    def test_update(self):
+        self.selector.recordSuccess(self.b, 0.1)
+        self.selector.update(['http://b/gw', 'http://c/gw'])
+        eq_([e.url.hostname for e in self.selector], ['b', 'c'])
+        assert self.selector.endpoints[0] is self.b
+
+
+class TestHistogram(object):
+
+    def test_empty(self):
+        histogram = client.Histogram()
+        eq_(histogram.percentile(50), None)
+        eq_(histogram.mean(), 0.0)
+
+    def test_percentile(self):
+        histogram = client.Histogram(precision=0.01)
+        for i in range(1, 101):
+            histogram.add(i / 1000.0)
+        eq_((histogram.count, histogram.min, histogram.max),
+            (100, 0.001, 0.1))
+        assert abs(histogram.mean() - 0.0505) < 1e-9
+        for percent in (1, 50, 90, 99):
+            value = histogram.percentile(percent)
+            assert abs(value / (percent / 1000.0) - 1) <= 0.01, value
+        eq_(histogram.percentile(100), 0.1)
+
+    def test_zero(self):
+        histogram = client.Histogram()
+        histogram.add(0)
+        histogram.add(0)
+        histogram.add(2)
+        eq_(histogram.percentile(50), 0)
+        eq_(histogram.percentile(100), 2)
+
+
+class TestHistogramMetrics(object):
+
+    def test_summary(self):
+        metrics = client.HistogramMetrics()
+        metrics.observe('encode', 0.5)
+        metrics.observe('encode', 1.5)
+        metrics.increment('errors')
+        metrics.increment('errors', 2)
+
+        summary = metrics.summary(percentiles=(50,))
+        eq_(summary['errors'], 3)
+        eq_(summary['encode']['count'], 2)
+        eq_(summary['encode']['mean'], 1.0)
+        eq_(summary['encode']['max'], 1.5)
+        assert abs(summary['encode']['p50'] - 0.5) <= 0.5 * 0.05
+
+        metrics.clear()
+        eq_(metrics.summary(), {})
+
+    def test_default(self):
+        service = client.HTTPRemotingService('http://example.org')
+        assert type(service.metrics) is client.RemotingMetrics
+        service.metrics.observe('encode', 1)
+        service.metrics.increment('errors')
+
+
+class TestResultCache(object):
+
+    def setup(self):
+        self.now = 0
+        self.cache = client.ResultCache(maxsize=2, ttl=10,
+                                        seconds=lambda: self.now)
+
+    def test_get(self):
+        self.cache.put('a', None)
+        eq_(self.cache.get('a', 'missing'), None)
+        eq_(self.cache.get('b', 'missing'), 'missing')
+        eq_((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_ttl(self):
+        self.cache.put('a', 1)
+        self.now = 9
+        eq_(self.cache.get('a'), 1)
+        self.now = 10
+        eq_(self.cache.get('a'), None)
+        assert 'a' not in self.cache
+
+    def test_lru(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+        assert 'a' in self.cache
+        assert 'b' not in self.cache
+        eq_(len(self.cache), 2)
+
+    def test_disabled(self):
+        self.cache.maxsize = 0
+        self.cache.put('a', 1)
+        eq_(len(self.cache), 0)
+
+    def test_clear(self):
+        self.cache.put('a', 1)
+        self.cache.get('a')
+        self.cache.clear()
+        eq_(len(self.cache), 0)
+        eq_(self.cache.hits, 0)
+
+
+class TestRequestQueue(object):
+
+    def setup(self):
+        self.queue = client.RequestQueue()
+        self.requests = [client.RequestWrapper('/%d' % i, 'foo', i)
+                         for i in range(5)]
+        for request in self.requests:
+            self.queue.append(request)
+
+    def test_order(self):
+        eq_(list(self.queue), self.requests)
+        eq_(len(self.queue), 5)
+
+    def test_lookup(self):
+        request = self.requests[2]
+        assert self.queue.get('/2') is request
+        assert self.queue.getByDeferred(request.deferred) is request
+        assert request in self.queue
+
+    def test_remove(self):
+        self.queue.remove(self.requests[1])
+        self.queue.remove(self.requests[3])
+        eq_(list(self.queue), [self.requests[i] for i in (0, 2, 4)])
+        eq_(len(self.queue), 3)
+        assert self.requests[1] not in self.queue
+
+    def test_compact(self):
+        for request in self.requests[:4]:
+            self.queue.remove(request)
+        eq_(list(self.queue), self.requests[4:])
+        assert len(self.queue._order) < 5
+        assert self.queue.get('/4') is self.requests[4]
+
+        request = client.RequestWrapper('/5', 'foo')
+        self.queue.append(request)
+        self.queue.remove(self.requests[4])
+        eq_(list(self.queue), [request])
+
+    @raises(LookupError)
+    def test_remove_missing(self):
+        self.queue.remove(client.RequestWrapper('/1', 'foo'))
+
+    @raises(LookupError)
+    def test_get_missing(self):
+        self.queue.get('/9')
+
+    @raises(ValueError)
+    def test_duplicate_id(self):
+        self.queue.append(client.RequestWrapper('/1', 'foo'))
+
+    @raises(AttributeError)
+    def test_slots(self):
+        self.requests[0].foo = 'bar'
+
+
+class TestEnvelopeDecoder(object):
+
+    def setup(self):
+        self.headers = []
+        self.bodies = []
+
+    def create_decoder(self, strict=False):
+        return client.EnvelopeDecoder(self.headers.append,
+                                      lambda *body: self.bodies.append(body),
+                                      strict)
+
+    def create_response(self, amf_version=pyamf.AMF0, strict=False):
+        envelope = Envelope(amf_version)
+        envelope.headers['Name'] = u'value'
+        envelope.headers['Required'] = [1, 2]
+        envelope.headers.set_required('Required')
+        envelope['/1'] = remoting.Response(u'\xe9t\xe9')
+        envelope['/2'] = remoting.Response({'a': [1, 2.5, None]})
+        envelope['/3'] = remoting.Response(u'x' * 1000)
+        return remoting.encode(envelope, strict=strict).getvalue()
+
+    def check_bodies(self):
+        eq_([target for target, message in self.bodies], ['/1', '/2', '/3'])
+        eq_([message.body for target, message in self.bodies],
+            [u'\xe9t\xe9', {'a': [1, 2.5, None]}, u'x' * 1000])
+
+    def test_whole(self):
+        decoder = self.create_decoder()
+        decoder.feed(self.create_response())
+        assert decoder.complete
+        decoder.finish()
+
+        eq_(len(self.headers), 1)
+        eq_(self.headers[0].headers, {'Name': u'value', 'Required': [1, 2]})
+        assert self.headers[0].headers.is_required('Required')
+        self.check_bodies()
+
+    def test_byte_by_byte(self):
+        for amf_version in (pyamf.AMF0, pyamf.AMF3):
+            for strict in (False, True):
+                self.setup()
+                decoder = self.create_decoder(strict)
+                for byte in self.create_response(amf_version, strict):
+                    decoder.feed(byte)
+                decoder.finish()
+                eq_(decoder.envelope.amfVersion, amf_version)
+                self.check_bodies()
+
+    def test_incremental(self):
+        data = self.create_response()
+        decoder = self.create_decoder()
+        decoder.feed(data[:-500])
+        eq_(len(self.headers), 1)
+        eq_(len(self.bodies), 2)
+        assert not decoder.complete
+
+        decoder.feed(data[-500:])
+        decoder.finish()
+        assert decoder.complete
+        self.check_bodies()
+
+    def test_buffer_released(self):
+        data = self.create_response()
+        decoder = self.create_decoder()
+        decoder.feed(data[:-500])
+        assert len(decoder.stream) < len(data) - 500
+
+    def test_declared_length(self):
+        data = self.create_response(strict=True)
+        decoder = self.create_decoder(strict=True)
+        decoder.feed(data[:-900])
+        eq_(decoder._needed, len(decoder.stream) - decoder.stream.tell() +
+            900)
+
+    @raises(pyamf.DecodeError)
+    def test_incomplete(self):
+        decoder = self.create_decoder()
+        decoder.feed(self.create_response()[:-1])
+        decoder.finish()
+
+    @raises(pyamf.DecodeError)
+    def test_malformed(self):
+        self.create_decoder().feed('\x00\x10\x00\x00')
+
+    def test_no_bodies(self):
+        decoder = self.create_decoder()
+        decoder.feed(remoting.encode(Envelope(pyamf.AMF0)).getvalue())
+        assert decoder.complete
+        eq_(len(self.headers), 1)
+
+
+class TestEnvelopeEncoding(object):
+
+    def create_request(self, amf_version=pyamf.AMF0):
+        envelope = Envelope(amf_version)
+        envelope.headers['Credentials'] = {'userid': u'user'}
+        envelope.headers.set_required('Credentials')
+        envelope['/1'] = remoting.Request('foo.bar', [u'\xe9t\xe9', 1])
+        envelope['/2'] = remoting.Request('foo.baz', [{'a': [1, None]}])
+        return envelope
+
+    def test_iter_encode(self):
+        for amf_version in (pyamf.AMF0, pyamf.AMF3):
+            for strict in (False, True):
+                envelope = self.create_request(amf_version)
+                pieces = list(client.iter_encode(envelope, strict))
+                eq_(len(pieces), 3)
+                eq_(''.join(pieces),
+                    remoting.encode(envelope, strict=strict).getvalue())
+
+    def test_encoded_headers(self):
+        for amf_version in (pyamf.AMF0, pyamf.AMF3):
+            for strict in (False, True):
+                envelope = self.create_request(amf_version)
+                encoded = client.EncodedHeaders(envelope.headers,
+                                                amf_version, strict)
+                eq_(len(encoded), 1)
+                data = ''.join(client.iter_encode(envelope, strict, encoded))
+                eq_(data, remoting.encode(envelope, strict=strict).getvalue())
+
+        envelope.headers['Extra'] = [1, 2]
+        data = ''.join(client.iter_encode(envelope, True, encoded))
+        decoded = remoting.decode(data)
+        eq_(decoded.headers, {'Credentials': {'userid': u'user'},
+                              'Extra': [1, 2]})
+        assert decoded.headers.is_required('Credentials')
+        eq_(len(decoded), 2)
+
+        # headers that the envelope does not have any more are not written
+        del envelope.headers['Credentials']
+        decoded = remoting.decode(''.join(
+            client.iter_encode(envelope, True, encoded)))
+        eq_(decoded.headers, {'Extra': [1, 2]})
+
+    def test_encoded_headers_references(self):
+        for amf_version in (pyamf.AMF0, pyamf.AMF3):
+            envelope = self.create_request(amf_version)
+            encoded = client.EncodedHeaders(envelope.headers, amf_version)
+            # the other headers are written with their own references
+            shared = {'b': 1}
+            envelope.headers['Shared'] = [shared, shared]
+            envelope.headers['Strings'] = [u'user', u'user']
+            envelope.headers['Timeout'] = 10
+            data = ''.join(client.iter_encode(envelope, False, encoded))
+            eq_(data, remoting.encode(envelope).getvalue())
+            decoded = remoting.decode(data)
+            eq_(decoded.headers['Shared'], [shared, shared])
+            eq_(decoded.headers['Strings'], [u'user', u'user'])
+
+            # scalars never are references
+            del envelope.headers['Shared']
+            del envelope.headers['Strings']
+            data = ''.join(client.iter_encode(envelope, False, encoded))
+            assert data.startswith(
+                remoting.encode(envelope).getvalue()[:4] + encoded.data)
+            eq_(remoting.decode(data).headers,
+                {'Credentials': {'userid': u'user'}, 'Timeout': 10})
+
+    def test_iter_encode_without_private_api(self):
+        write_header = plasma.service._write_header
+        plasma.service._write_header = None
+        try:
+            envelope = self.create_request(pyamf.AMF0)
+            eq_(list(client.iter_encode(envelope)),
+                [remoting.encode(envelope).getvalue()])
+            remoting_service = client.BlockingRemotingService(
+                'http://example.org')
+            eq_(remoting_service._getEncodedHeaders(), None)
+        finally:
+            plasma.service._write_header = write_header
+
+    def test_producer(self):
+        written = []
+        consumer = type('Consumer', (object,), {'write': written.append})()
+        cooperator = Cooperator(scheduler=lambda f: f(), started=True)
+        producer = client.EnvelopeProducer(iter(['a', 'b', 'c']), cooperator)
+        eq_(producer.length, UNKNOWN_LENGTH)
+
+        done = []
+        producer.startProducing(consumer).addCallback(done.append)
+        eq_(written, ['a', 'b', 'c'])
+        eq_(done, [None])
+
+    def test_stream_threshold(self):
+        service = client.HTTPRemotingService('http://example.org',
+                                             stream_threshold=200)
+        envelope = self.create_request()
+        producer, encoding = service._createBodyProducer(
+            client.iter_encode(envelope))
+        assert isinstance(producer, FileBodyProducer)
+        eq_(encoding, None)
+
+        envelope['/3'] = remoting.Request('foo.bar', ['x' * 300])
+        producer, encoding = service._createBodyProducer(
+            client.iter_encode(envelope))
+        assert isinstance(producer, client.EnvelopeProducer)
+
+    def test_gzip_pieces(self):
+        envelope = self.create_request()
+        pieces = list(client.gzip_pieces(client.iter_encode(envelope)))
+        eq_(zlib.decompress(''.join(pieces), 16 + zlib.MAX_WBITS),
+            remoting.encode(envelope).getvalue())
+
+    def test_compress_threshold(self):
+        service = client.HTTPRemotingService('http://example.org',
+                                             compress_threshold=200)
+        envelope = self.create_request()
+        producer, encoding = service._createBodyProducer(
+            client.iter_encode(envelope))
+        eq_(encoding, None)
+
+        envelope['/3'] = remoting.Request('foo.bar', ['x' * 300])
+        producer, encoding = service._createBodyProducer(
+            client.iter_encode(envelope))
+        eq_(encoding, 'gzip')
+        assert producer.length < 200
+
+    def test_accept_encoding(self):
+        service = client.HTTPRemotingService('http://example.org')
+        headers = service._getRequestHeaders()
+        eq_(headers.getRawHeaders('Accept-Encoding'), ['gzip, deflate'])
+        assert not headers.hasHeader('Content-Encoding')
+
+        service.accept_compressed = False
+        headers = service._getRequestHeaders('gzip')
+        assert not headers.hasHeader('Accept-Encoding')
+        eq_(headers.getRawHeaders('Content-Encoding'), ['gzip'])
+
+
 class TestHTTPRemotingServiceDry(object):
 
     def setup(self):
@@ -174,10 +949,235 @@ class TestHTTPRemotingServiceDry(object):
         foo = self.service.getService('foo')
         self.service.getService(foo)
 
+    def testResponseDispatch(self):
+        foo = self.service.getService('foo', auto_execute=False)
+        deferreds = [foo.bar(i) for i in range(3)]
+        requests = self.service._takeRequests()
+        results = []
+        for d in deferreds:
+            d.addBoth(results.append)
+
+        envelope = Envelope()
+        envelope['/3'] = remoting.Response('three')
+        envelope['/1'] = remoting.Response('one')
+        self.service._handleAMFResponse(envelope, requests)
+        eq_(results[:2], ['three', 'one'])
+        assert results[2].check(RemotingError)
+
     @raises(LookupError)
     def testRemoveNonexistentRequest(self):
         self.service.removeRequest(Deferred())
 
+    def testRequestTimeoutHeader(self):
+        self.service.addHeader('Persistent', 1, True)
+        foo = self.service.getService('foo', auto_execute=False, timeout=30)
+        foo.bar()
+        self.service.getService('foo', auto_execute=False).baz()
+        requests = self.service._takeRequests()
+
+        envelope = self.service._createAMFRequest(requests)
+        eq_(envelope.headers['DSRequestTimeout'], 30)
+        assert envelope.headers.is_required('Persistent')
+        assert 'DSRequestTimeout' not in self.service.headers
+
+        deadline = self.service.seconds() + 10
+        envelope = self.service._createAMFRequest(requests, deadline)
+        eq_(envelope.headers['DSRequestTimeout'], 10)
+
+    def testEncodedHeaders(self):
+        self.service.setCredentials('user', 'secret')
+        encoded = self.service._getEncodedHeaders()
+        assert self.service._getEncodedHeaders() is encoded
+        eq_(encoded.names, frozenset(['Credentials']))
+
+        self.service.addHeader('Persistent', 1)
+        encoded = self.service._getEncodedHeaders()
+        eq_(encoded.names, frozenset(['Credentials', 'Persistent']))
+
+        envelope = Envelope()
+        envelope.headers[remoting.REQUEST_PERSISTENT_HEADER] = {'Other': 2}
+        self.service._handleAMFResponse(envelope, [])
+        assert self.service._getEncodedHeaders() is not encoded
+        encoded = self.service._getEncodedHeaders()
+
+        self.service.amf_version = pyamf.AMF3
+        assert self.service._getEncodedHeaders() is not encoded
+
+    def testHeadersChangedDirectly(self):
+        self.service.addHeader('a', 1)
+        self.service.addHeader('b', {'c': [1]})
+        self.service.getService('foo', auto_execute=False).bar()
+        requests = self.service._takeRequests()
+        ''.join(self.service._encodeAMFRequest(requests))
+
+        del self.service.headers['b']
+        self.service.headers['a'] = 99
+        envelope = remoting.decode(
+            ''.join(self.service._encodeAMFRequest(requests)))
+        eq_(envelope.headers, {'a': 99})
+
+        self.service.addHeader('b', {'c': [1]})
+        ''.join(self.service._encodeAMFRequest(requests))
+        self.service.headers['b']['c'].append(2)
+        self.service.headers.set_required('a')
+        envelope = remoting.decode(
+            ''.join(self.service._encodeAMFRequest(requests)))
+        eq_(envelope.headers, {'a': 99, 'b': {'c': [1, 2]}})
+        assert envelope.headers.is_required('a')
+
+    def testEncodeAMFRequest(self):
+        self.service.addHeader('Persistent', {'a': 1}, True)
+        self.service.getService('foo', auto_execute=False).bar(u'x')
+        requests = self.service._takeRequests()
+        deadline = self.service.seconds() + 10
+        for i in range(2):
+            data = ''.join(self.service._encodeAMFRequest(requests,
+                                                          deadline))
+            envelope = remoting.decode(data)
+            eq_(envelope.headers, {'Persistent': {'a': 1},
+                                   'DSRequestTimeout': 10})
+            assert envelope.headers.is_required('Persistent')
+            eq_(envelope['/1'].body, [u'x'])
+
+    def testNoRequestTimeoutHeader(self):
+        self.service.getService('foo', auto_execute=False).bar()
+        envelope = self.service._createAMFRequest(
+            self.service._takeRequests())
+        assert envelope.headers is self.service.headers
+
+    def testCancelPendingRequest(self):
+        foo = self.service.getService('foo', auto_execute=False)
+        d = foo.bar()
+        other = foo.baz()
+        d.cancel()
+        eq_(list(self.service.requests)[0].deferred, other)
+        eq_(len(self.service.requests), 1)
+        d.addErrback(lambda failure: failure.trap(CancelledError))
+
+    def testSharedResult(self):
+        self.service.result_cache = client.ResultCache()
+        foo = self.service.getService('foo', auto_execute=False, cached=True)
+        first = foo.bar(1)
+        second = foo.bar(1)
+        other = foo.bar(2)
+        eq_(len(self.service.requests), 2)
+        results = []
+        for d in (first, second, other):
+            d.addCallback(results.append)
+
+        envelope = Envelope()
+        envelope['/1'] = remoting.Response('one')
+        envelope['/2'] = remoting.Response('two')
+        self.service._handleAMFResponse(envelope,
+                                        self.service._takeRequests())
+        eq_(results, ['one', 'one', 'two'])
+
+        # later calls are answered from the cache
+        foo.bar(1).addCallback(results.append)
+        eq_(results[-1], 'one')
+        eq_(len(self.service.requests), 0)
+
+    def testSharedError(self):
+        foo = self.service.getService('foo', auto_execute=False, cached=True)
+        first = foo.bar(1)
+        second = foo.bar(1)
+        failures = []
+        for d in (first, second):
+            d.addErrback(failures.append)
+
+        self.service._handleAMFResponse(Envelope(),
+                                        self.service._takeRequests())
+        eq_(len(failures), 2)
+        # errors are not cached
+        foo.bar(1)
+        eq_(len(self.service.requests), 1)
+
+    def testUncachedCalls(self):
+        foo = self.service.getService('foo', auto_execute=False)
+        foo.bar(1)
+        foo.bar(1)
+        eq_(len(self.service.requests), 2)
+
+    def testCancelSharedRequest(self):
+        foo = self.service.getService('foo', auto_execute=False, cached=True)
+        first = foo.bar(1)
+        second = foo.bar(1)
+        third = foo.bar(1)
+        first.cancel()
+        first.addErrback(lambda failure: failure.trap(CancelledError))
+        self.service.removeRequest(third)
+
+        eq_(len(self.service.requests), 1)
+        request = list(self.service.requests)[0]
+        eq_(request.deferred, second)
+        eq_(request.followers, [])
+
+        self.service.removeRequest(second)
+        eq_(len(self.service.requests), 0)
+        eq_(self.service._flights, {})
+        eq_(self.service._followers, {})
+
+    def testDeliveredFollowers(self):
+        foo = self.service.getService('foo', auto_execute=False, cached=True)
+        first = foo.bar(1)
+        second = foo.bar(1)
+        eq_(len(self.service._followers), 1)
+        self.service._handleAMFResponse(Envelope(),
+                                        self.service._takeRequests())
+        errors = []
+        first.addErrback(lambda failure: errors.append(
+            failure.trap(RemotingError)))
+        second.addErrback(lambda failure: errors.append(
+            failure.trap(RemotingError)))
+        eq_(errors, [RemotingError, RemotingError])
+        eq_(self.service._followers, {})
+
+    def testCachedCredentials(self):
+        self.service.result_cache = client.ResultCache()
+        foo = self.service.getService('foo', auto_execute=False, cached=True)
+        self.service.setCredentials('alice', 'secret')
+        results = []
+        foo.bar(1).addCallback(results.append)
+        envelope = Envelope()
+        envelope['/1'] = remoting.Response('alice')
+        self.service._handleAMFResponse(envelope,
+                                        self.service._takeRequests())
+
+        # the result of another user is neither cached nor shared
+        self.service.setCredentials('bob', 'secret')
+        foo.bar(1).addCallback(results.append)
+        eq_(len(self.service.requests), 1)
+        self.service.setCredentials('alice', 'secret')
+        foo.bar(1).addCallback(results.append)
+        eq_(len(self.service.requests), 1)
+        eq_(results, ['alice', 'alice'])
+
+    def testSendErrorReleasesSlot(self):
+        service = client.HTTPRemotingService('http://example.org',
+                                             max_in_flight=1)
+        # the envelopes fail before they are sent
+        service._agent = None
+        foo = service.getService('foo', auto_execute=False)
+        errors = []
+        for i in range(2):
+            foo.bar(i).addErrback(errors.append)
+            service.execute()
+            eq_(service.dispatcher.in_flight, 0)
+            eq_(len(service.dispatcher), 0)
+        eq_(len(errors), 2)
+        eq_(service.dispatcher.dispatched, 2)
+
+    def testLateResponse(self):
+        foo = self.service.getService('foo', auto_execute=False)
+        d = foo.bar()
+        requests = self.service._takeRequests()
+        d.cancel()
+        d.addErrback(lambda failure: failure.trap(CancelledError))
+
+        envelope = Envelope()
+        envelope['/1'] = remoting.Response('late')
+        self.service._handleAMFResponse(envelope, requests)
+
 
 class TestHTTPRemotingServiceLive():
 
@@ -194,6 +1194,9 @@ class TestHTTPRemotingServiceLive():
                                                   logger=logging,
                                                   user_agent='UnitTester')
 
+    def teardown(self):
+        self.service.close()
+
     @deferred(2)
     @inlineCallbacks
     def test_single_request(self):
@@ -295,3 +1298,589 @@ class TestHTTPRemotingServiceLive():
         req1 = self.service.addRequest(upper, 'str')
         self.service.removeRequest(req1)
         eq_(len(self.service.requests), 0)
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_connection_reuse(self):
+        upper = self.service.getService('foo.uppercase')
+        connections = CountingSite.connections
+
+        result = yield upper('first')
+        eq_(result, 'FIRST')
+        result = yield upper('second')
+        eq_(result, 'SECOND')
+        eq_(CountingSite.connections, connections + 1)
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_close(self):
+        upper = self.service.getService('foo.uppercase')
+        connections = CountingSite.connections
+
+        yield upper('first')
+        yield self.service.close()
+        result = yield upper('second')
+        eq_(result, 'SECOND')
+        eq_(CountingSite.connections, connections + 2)
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_shared_pool(self):
+        other = client.HTTPRemotingService('http://127.0.0.1:11111/gw',
+                                           pool=self.service.pool)
+        connections = CountingSite.connections
+
+        yield self.service.getService('foo.uppercase')('first')
+        result = yield other.getService('foo.uppercase')('second')
+        eq_(result, 'SECOND')
+        eq_(CountingSite.connections, connections + 1)
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_coalesced_calls(self):
+        self.service.batch_window = 0.01
+        upper = self.service.getService('foo.uppercase')
+
+        d1 = upper('first')
+        d2 = upper('second')
+        eq_(len(self.service.requests), 2)
+        result1 = yield d1
+        result2 = yield d2
+        eq_((result1, result2), ('FIRST', 'SECOND'))
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_max_in_flight(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/gw',
+                                             max_in_flight=1)
+        upper = service.getService('foo.uppercase')
+
+        deferreds = [upper(word) for word in ('a', 'b', 'c')]
+        eq_(service.dispatcher.in_flight, 1)
+        eq_(len(service.dispatcher), 2)
+        for d, word in zip(deferreds, ('A', 'B', 'C')):
+            result = yield d
+            eq_(result, word)
+        eq_(service.dispatcher.dispatched, 3)
+        eq_(service.dispatcher.max_depth, 2)
+        eq_(service.dispatcher.in_flight, 0)
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_streamed_request(self):
+        self.service.stream_threshold = 0
+        upper = self.service.getService('foo.uppercase')
+        d1 = self.service.addRequest(upper, 'x' * 10000)
+        d2 = self.service.addRequest(upper, 'second')
+        self.service.execute()
+
+        result = yield d1
+        eq_(result, 'X' * 10000)
+        result = yield d2
+        eq_(result, 'SECOND')
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_request_timeout(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/stall',
+                                             request_timeout=0.1)
+        try:
+            yield service.getService('foo')('first')
+        except client.RequestTimeoutError, e:
+            eq_(str(e), 'Request /1 timed out')
+        else:
+            assert False, 'Expected a RequestTimeoutError'
+
+        # the connection is closed
+        try:
+            yield StallingResource.lost[-1]
+        except Exception:
+            pass
+        eq_(service._batches, {})
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_partial_timeout(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/stall')
+        upper = service.getService('foo.uppercase', auto_execute=False)
+        first = upper('first')
+        second = service.addRequest(upper, 'second', timeout=0.1)
+        service.execute()
+
+        result = yield first
+        eq_(result, 'FIRST')
+        try:
+            yield second
+        except client.RequestTimeoutError:
+            pass
+        else:
+            assert False, 'Expected a RequestTimeoutError'
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_batch_timeout(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/stall')
+        upper = service.getService('foo.uppercase', auto_execute=False)
+        first = upper('first')
+        second = upper('second')
+        service.execute(timeout=0.1)
+
+        result = yield first
+        eq_(result, 'FIRST')
+        try:
+            yield second
+        except client.RequestTimeoutError:
+            pass
+        else:
+            assert False, 'Expected a RequestTimeoutError'
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_cancel_sent_request(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/stall')
+        lost = len(StallingResource.lost)
+        d = service.getService('foo.uppercase')('first')
+        while len(StallingResource.lost) == lost:
+            wait = Deferred()
+            reactor.callLater(0.01, wait.callback, None)
+            yield wait
+        d.cancel()
+        try:
+            yield d
+        except CancelledError:
+            pass
+        else:
+            assert False, 'Expected a CancelledError'
+
+        try:
+            yield StallingResource.lost[-1]
+        except Exception:
+            pass
+        else:
+            assert False, 'Expected the connection to be closed'
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_queued_timeout(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/stall',
+                                             max_in_flight=1)
+        upper = service.getService('foo.uppercase')
+        stalled = service.addRequest(upper, 'first', timeout=0.2)
+        service.execute()
+        queued = service.addRequest(upper, 'second', timeout=0.1)
+        service.execute()
+        eq_(len(service.dispatcher), 1)
+
+        for d in (queued, stalled):
+            try:
+                yield d
+            except client.RequestTimeoutError:
+                pass
+            else:
+                assert False, 'Expected a RequestTimeoutError'
+        try:
+            yield StallingResource.lost[-1]
+        except Exception:
+            pass
+        eq_(len(service.dispatcher), 0)
+        eq_(service.dispatcher.in_flight, 0)
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_retry_idempotent(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/drop',
+            retry_policy=client.RetryPolicy(initial_delay=0.01))
+        DroppingResource.drops = 2
+        upper = service.getService('foo.uppercase', idempotent=True)
+        result = yield upper('first')
+        eq_(result, 'FIRST')
+        eq_(DroppingResource.drops, 0)
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_no_retry_unknown_delivery(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/drop',
+            retry_policy=client.RetryPolicy(initial_delay=0.01))
+        DroppingResource.drops = 1
+        try:
+            yield service.getService('foo.uppercase')('first')
+        except ResponseNeverReceived:
+            pass
+        else:
+            assert False, 'Expected a ResponseNeverReceived'
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_retry_connection_refused(self):
+        delays = []
+
+        def random():
+            delays.append(None)
+            return 0
+
+        service = client.HTTPRemotingService('http://127.0.0.1:11112/gw',
+            retry_policy=client.RetryPolicy(max_attempts=3,
+                                            initial_delay=0.01,
+                                            random=random))
+        try:
+            yield service.getService('foo.uppercase')('first')
+        except ConnectionRefusedError:
+            pass
+        else:
+            assert False, 'Expected a ConnectionRefusedError'
+        eq_(len(delays), 2)
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_failover(self):
+        service = client.HTTPRemotingService(['http://127.0.0.1:11112/gw',
+                                              'http://127.0.0.1:11111/gw'])
+        service.endpoints.random = lambda: 0
+        dead, alive = service.endpoints
+
+        result = yield service.getService('foo.uppercase')('first')
+        eq_(result, 'FIRST')
+        assert dead.down_until is not None
+        eq_(dead.failures, 1)
+        assert alive.latency is not None
+        eq_(alive.failures, 0)
+
+        # the gateway that could not be reached is not tried again yet
+        result = yield service.getService('foo.uppercase')('second')
+        eq_(result, 'SECOND')
+        eq_(dead.failures, 1)
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_failover_not_idempotent(self):
+        service = client.HTTPRemotingService(['http://127.0.0.1:11111/drop',
+                                              'http://127.0.0.1:11111/gw'])
+        service.endpoints.random = lambda: 0
+        DroppingResource.drops = 2
+        try:
+            yield service.getService('foo.uppercase')('first')
+        except ResponseNeverReceived:
+            pass
+        else:
+            assert False, 'Expected a ResponseNeverReceived'
+
+        service.endpoints.random = lambda: 0
+        result = yield service.getService('foo.uppercase',
+                                          idempotent=True)('second')
+        eq_(result, 'SECOND')
+        eq_(DroppingResource.drops, 0)
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_metrics(self):
+        metrics = client.HistogramMetrics()
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/gzip',
+                                             metrics=metrics)
+        upper = service.getService('foo.uppercase', auto_execute=False)
+        error = service.getService('foo.dummy', auto_execute=False)
+        results = [upper('x' * 1000), error(), upper('y')]
+        service.execute()
+        for d in results:
+            yield d.addErrback(lambda failure: None)
+        # the last result is measured once its callbacks have run
+        yield service.close()
+
+        summary = metrics.summary()
+        eq_(sorted(metrics.histograms), ['batch_size', 'connect', 'decode',
+            'dispatch', 'encode', 'first_byte', 'queue_wait',
+            'request_bytes', 'response_bytes', 'transfer'])
+        eq_(summary['batch_size']['max'], 3)
+        eq_(summary['dispatch']['count'], 3)
+        eq_((summary['envelopes'], summary['requests'], summary['errors']),
+            (1, 3, 1))
+        # the response is compressed
+        assert summary['response_bytes']['max'] < 1000
+        assert summary['request_bytes']['max'] > 1000
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_discover_endpoints(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/cluster')
+        del ClusterResource.operations[:]
+        urls = yield service.discoverEndpoints()
+        eq_(urls, ['http://127.0.0.1:11111/gw',
+                   'http://127.0.0.1:11111/gzip'])
+        eq_(ClusterResource.operations, [7])
+        eq_([e.url.path for e in service.endpoints], ['/gw', '/gzip'])
+
+        result = yield service.getService('foo.uppercase')('word')
+        eq_(result, 'WORD')
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_retry_hint(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/hint',
+            retry_policy=client.RetryPolicy(max_attempts=2,
+                                            initial_delay=0.01))
+        del RetryHintResource.envelopes[:]
+        upper = service.getService('foo.uppercase', auto_execute=False)
+        first = upper('first')
+        retried = upper('retry')
+        failed = upper('fail')
+        service.execute()
+
+        result = yield first
+        eq_(result, 'FIRST')
+        result = yield retried
+        eq_(result, 'RETRY')
+        try:
+            yield failed
+        except RemotingError, e:
+            eq_(str(e), 'busy')
+        else:
+            assert False, 'Expected a RemotingError'
+        # only the failed requests were sent again
+        eq_(RetryHintResource.envelopes, [3, 2])
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_cached_calls(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/hint',
+                                             result_cache=client.ResultCache())
+        del RetryHintResource.envelopes[:]
+        upper = service.getService('foo.uppercase', cached=True)
+        first = upper('word')
+        second = upper('word')
+
+        result = yield first
+        eq_(result, 'WORD')
+        result = yield second
+        eq_(result, 'WORD')
+        result = yield upper('word')
+        eq_(result, 'WORD')
+        eq_(RetryHintResource.envelopes, [1])
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_compressed_response(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/gzip')
+        upper = service.getService('foo.uppercase')
+        d1 = service.addRequest(upper, 'x' * 10000)
+        d2 = service.addRequest(upper, 'second')
+        service.execute()
+
+        result = yield d1
+        eq_(result, 'X' * 10000)
+        result = yield d2
+        eq_(result, 'SECOND')
+        yield service.close()
+
+    @deferred(2)
+    @inlineCallbacks
+    def test_compressed_request(self):
+        service = client.HTTPRemotingService('http://127.0.0.1:11111/gunzip',
+                                             compress_threshold=1000)
+        upper = service.getService('foo.uppercase')
+        del GunzipResource.encodings[:]
+
+        result = yield upper('small')
+        eq_(result, 'SMALL')
+        result = yield upper('x' * 10000)
+        eq_(result, 'X' * 10000)
+        service.stream_threshold = 0
+        result = yield upper('y' * 10000)
+        eq_(result, 'Y' * 10000)
+        eq_(GunzipResource.encodings, [None, 'gzip', 'gzip'])
+        yield service.close()
+
+
+class TestBlockingRemotingService(object):
+
+    @classmethod
+    def setup_class(cls):
+        gateway.addService(FooService, 'foo')
+
+    @classmethod
+    def teardown_class(cls):
+        gateway.removeService(FooService)
+
+    def setup(self):
+        self.service = client.BlockingRemotingService(
+            'http://127.0.0.1:11111/gw', user_agent='UnitTester', timeout=2)
+
+    def teardown(self):
+        self.service.close()
+
+    def test_single_request(self):
+        upper = self.service.getService('foo.uppercase')
+        eq_(upper('teststring'), 'TESTSTRING')
+
+    def test_metrics(self):
+        self.service.metrics = metrics = client.HistogramMetrics()
+        upper = self.service.getService('foo.uppercase')
+        eq_(upper('first'), 'FIRST')
+        eq_(upper('second'), 'SECOND')
+
+        eq_(sorted(metrics.histograms), ['batch_size', 'connect', 'decode',
+            'dispatch', 'encode', 'first_byte', 'request_bytes',
+            'response_bytes', 'transfer'])
+        # the connection was reused
+        eq_(metrics.histograms['connect'].count, 1)
+        eq_(metrics.histograms['first_byte'].count, 2)
+        eq_(metrics.counters, {'envelopes': 2, 'requests': 2})
+
+    @raises(RegisteredError)
+    def test_error(self):
+        self.service.getService('foo.reg_error')()
+
+    def test_batch_call(self):
+        upper = self.service.getService('foo.uppercase', auto_execute=False)
+        error = self.service.getService('foo.dummy', auto_execute=False)
+        first = upper('to upper case')
+        failed = error()
+        second = upper('this too')
+        assert isinstance(first, client.CallResult)
+        assert not first.done()
+
+        self.service.execute()
+        eq_(first.result(), 'TO UPPER CASE')
+        eq_(second.result(), 'THIS TOO')
+        eq_(str(failed.exception()), 'test error')
+        eq_(len(self.service.requests), 0)
+
+    @raises(RemotingError)
+    def test_result_timeout(self):
+        upper = self.service.getService('foo.uppercase', auto_execute=False)
+        upper('never sent').result(0.01)
+
+    def test_connection_reuse(self):
+        upper = self.service.getService('foo.uppercase')
+        connections = CountingSite.connections
+        eq_(upper('first'), 'FIRST')
+        eq_(upper('second'), 'SECOND')
+        eq_(CountingSite.connections, connections + 1)
+
+    def test_close(self):
+        upper = self.service.getService('foo.uppercase')
+        connections = CountingSite.connections
+        upper('first')
+        self.service.close()
+        eq_(upper('second'), 'SECOND')
+        eq_(CountingSite.connections, connections + 2)
+
+    def test_closed_connection(self):
+        upper = self.service.getService('foo.uppercase')
+        upper('first')
+        self.service._local.connection.sock.shutdown(socket.SHUT_RDWR)
+        eq_(upper('second'), 'SECOND')
+
+    def test_dropped_after_sending(self):
+        service = client.BlockingRemotingService(
+            'http://127.0.0.1:11111/drop', timeout=2)
+        DroppingResource.drops = 0
+        eq_(service.getService('foo.uppercase')('first'), 'FIRST')
+
+        # the gateway may have received the envelope
+        DroppingResource.drops = 1
+        try:
+            service.getService('foo.uppercase')('second')
+        except (httplib.BadStatusLine, socket.error):
+            pass
+        else:
+            assert False, 'Expected the request to fail'
+        eq_(DroppingResource.drops, 0)
+
+        eq_(service.getService('foo.uppercase')('third'), 'THIRD')
+        DroppingResource.drops = 1
+        upper = service.getService('foo.uppercase', idempotent=True)
+        eq_(upper('fourth'), 'FOURTH')
+        eq_(DroppingResource.drops, 0)
+        service.close()
+
+    def test_compressed_response(self):
+        service = client.BlockingRemotingService(
+            'http://127.0.0.1:11111/gzip')
+        upper = service.getService('foo.uppercase')
+        eq_(upper('x' * 10000), 'X' * 10000)
+        service.close()
+
+    @raises(RemotingError)
+    def test_server_error(self):
+        service = client.BlockingRemotingService('http://127.0.0.1:11111/bad')
+        service.getService('foo')()
+
+    def test_threads(self):
+        upper = self.service.getService('foo.uppercase')
+        words = ['word%d' % i for i in range(20)]
+        results = {}
+
+        def work(offset):
+            for word in words[offset::4]:
+                results[word] = upper(word)
+
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(results, dict([(word, word.upper()) for word in words]))
+
+    def test_cached_calls(self):
+        self.service.result_cache = client.ResultCache()
+        upper = self.service.getService('foo.uppercase', cached=True)
+        connections = CountingSite.connections
+        eq_(upper('first'), 'FIRST')
+        self.service.close()
+        eq_(upper('first'), 'FIRST')
+        eq_(CountingSite.connections, connections + 1)
+
+    def test_headers_snapshot(self):
+        self.service.addHeader('a', 1)
+        self.service.getService('foo', auto_execute=False).bar()
+        pieces = self.service._encodeAMFRequest(self.service._takeRequests())
+
+        envelope = Envelope()
+        envelope.headers[remoting.REQUEST_PERSISTENT_HEADER] = {'a': 2}
+        self.service._handleAMFHeaders(envelope)
+        eq_(remoting.decode(''.join(pieces)).headers, {'a': 1})
+        eq_(self.service.headers, {'a': 2})
+
+    def test_response_headers_locked(self):
+        envelope = Envelope()
+        envelope.headers[remoting.REPLACE_GATEWAY_URL] = 'http://example.net'
+        envelope.headers[remoting.REQUEST_PERSISTENT_HEADER] = {'a': 2}
+        thread = threading.Thread(target=self.service._handleAMFHeaders,
+                                  args=(envelope,))
+        self.service._lock.acquire()
+        try:
+            thread.start()
+            thread.join(0.05)
+            eq_(self.service.url.geturl(), 'http://127.0.0.1:11111/gw')
+            eq_(self.service.headers, {})
+        finally:
+            self.service._lock.release()
+        thread.join()
+        eq_(self.service.url.geturl(), 'http://example.net')
+        eq_(self.service.headers, {'a': 2})
+
+    def test_batch_window(self):
+        self.service.batch_window = 0.05
+        upper = self.service.getService('foo.uppercase')
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(upper('x')))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(results, ['X'] * 3)
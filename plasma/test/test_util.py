@@ -61,3 +61,40 @@ class ConstantTestCase(unittest.TestCase):
 
         x = util.Constant(1234)
         self.assertEquals(repr(x), '1234')
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """
+    Tests for :class:`util.LRUCache`
+    """
+
+    def test_get(self):
+        cache = util.LRUCache()
+        cache.put('a', None)
+
+        self.assertEquals(cache.get('a', 'missing'), None)
+        self.assertEquals(cache.get('b', 'missing'), 'missing')
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def test_eviction(self):
+        cache = util.LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        cache.put('a', 4)
+
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get('a'), 4)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+
+    def test_stale(self):
+        cache = util.LRUCache()
+        cache._isFresh = lambda value: value > 0
+        cache.put('a', 0)
+        cache.put('b', 1)
+
+        self.assertEquals(cache.get('a'), None)
+        self.assertFalse('a' in cache)
+        self.assertEquals(cache.get('b'), 1)
@@ -5,8 +5,13 @@
 Plasma utility classes and helper functions.
 """
 
+import threading
+
 import pyamf
 
+# Indexes into the linked list entries of LRUCache
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
 
 class Constant(object):
     """
@@ -35,6 +40,125 @@ class Constant(object):
         return repr(self.value)
 
 
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping. When the cache is full, the least
+    recently used entry is evicted.
+
+    Subclasses can expire entries by overriding :meth:`_isFresh`.
+
+    :ivar maxsize: the maximum number of entries to keep. `0` disables
+        caching.
+    :type maxsize: `int`
+    :ivar hits: number of lookups that found an entry
+    :type hits: `int`
+    :ivar misses: number of lookups that did not find an entry
+    :type misses: `int`
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        # Circular doubly linked list, ordered from least to most recently
+        # used. The root entry itself never holds a value.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for `key`, or `default` if it is not in the
+        cache.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and not self._isFresh(entry[_VALUE]):
+                self._unlink(entry)
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self._unlink(entry)
+            self._append(entry)
+            return entry[_VALUE]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used entry if the cache
+        is full.
+        """
+        if self.maxsize <= 0:
+            return
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry[_VALUE] = value
+                self._unlink(entry)
+                self._append(entry)
+                return
+
+            while len(self._entries) >= self.maxsize:
+                oldest = self._root[_NEXT]
+                self._unlink(oldest)
+                del self._entries[oldest[_KEY]]
+
+            entry = [None, None, key, value]
+            self._append(entry)
+            self._entries[key] = entry
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """
+        Removes all entries and resets the hit/miss counters.
+        """
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            root = self._root
+            root[:] = [root, root, None, None]
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _isFresh(self, value):
+        """
+        Returns whether a cached value can still be used. Stale values are
+        removed when they are looked up.
+        """
+        return True
+
+    def _append(self, entry):
+        root = self._root
+        last = root[_PREV]
+        entry[_PREV] = last
+        entry[_NEXT] = root
+        last[_NEXT] = entry
+        root[_PREV] = entry
+
+    def _unlink(self, entry):
+        entry[_PREV][_NEXT] = entry[_NEXT]
+        entry[_NEXT][_PREV] = entry[_PREV]
+
+
 def to_amf(obj, encoder):
     return obj.value
 